@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""Throughput of `mirror_images` against a local image server and an in-memory
+bucket. Run from the repository root with `python -m benchmarks.bench_mirror`."""
+
+import argparse
+import tempfile
+import time
+
+from loca_vision.coord import Coord
+from loca_vision.image_cache import ImageCache
+from loca_vision.mirror import make_session, mirror_images
+from loca_vision.wiki_monument import WikiMonument
+
+from .fakes import FakeImageServer, MemoryBucket
+
+
+def make_monuments(server: FakeImageServer, n: int, images: int):
+    return [
+        WikiMonument(
+            f"Monument {m}",
+            "",
+            Coord(41.3, -72.9),
+            [server.url(f"{m}/{i}.jpg") for i in range(images)],
+        )
+        for m in range(n)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--monuments", type=int, default=50)
+    parser.add_argument("--images", type=int, default=4)
+    parser.add_argument("--size", type=int, default=200_000)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--upload-latency", type=float, default=0.02)
+    args = parser.parse_args()
+
+    with FakeImageServer(args.size, args.latency) as server:
+        for downloads, uploads in [(1, 1), (4, 4), (8, 8), (16, 8), (32, 16)]:
+            monuments = make_monuments(server, args.monuments, args.images)
+            bucket = MemoryBucket(latency=args.upload_latency)
+            session = make_session(downloads)
+
+            start = time.perf_counter()
+            results = mirror_images(
+                monuments, bucket, downloads, uploads, session=session
+            )
+            elapsed = time.perf_counter() - start
+
+            ok = sum(r.ok for r in results)
+            mb = ok * args.size / 1e6
+            print(
+                f"downloads={downloads:>2} uploads={uploads:>2}: "
+                f"{ok}/{len(results)} images in {elapsed:6.2f}s "
+                f"({ok / elapsed:7.1f} img/s, {mb / elapsed:6.1f} MB/s)"
+            )
+
+        with tempfile.TemporaryDirectory() as tmp, ImageCache(tmp) as cache:
+            bucket = MemoryBucket(latency=args.upload_latency)
+            for run in ["cold", "warm"]:
+                monuments = make_monuments(server, args.monuments, args.images)
+                before = server.requests
+
+                start = time.perf_counter()
+                results = mirror_images(monuments, bucket, 16, 8, cache=cache)
+                elapsed = time.perf_counter() - start
+
+                print(
+                    f"cached, {run} run: {sum(r.ok for r in results)}/{len(results)} "
+                    f"images in {elapsed:6.2f}s, {server.requests - before} downloads, "
+                    f"{len(bucket.blobs)} blobs"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""Latency and throughput of the crawl, mirror, CSV and search paths, entirely
+offline: Wikipedia, the image hosts, Cloud Storage and Product Search are all
+replaced by the stand-ins in `benchmarks.fakes`. Run from the repository root
+with `python -m benchmarks.bench_offline`.
+
+Each workload is run at every dataset size: `search_monuments_nearby` (and the
+older three-pass lookup) over that many pages, `upload_images_from_monuments` and `monuments_to_csv` over that
+many monuments, and that many `get_similar_products_file` queries."""
+
+import argparse
+import base64
+import os
+import time
+from typing import Callable, List
+
+import numpy as np
+
+from loca_vision import clients, gcloud, metrics, wiki_parser
+from loca_vision.coord import Coord
+from loca_vision.wiki_monument import WikiMonument
+
+from .fakes import FakeImageAnnotator, FakeImageServer, FakeWikiAPI, MemoryStorage
+
+CENTER = Coord(41.31, -72.92)
+SPREAD = 5000
+
+
+def report(name: str, size: int, samples: List[float], items: int, unit: str):
+    """Prints the median and 99th percentile of the per-call `samples` (in
+    seconds), and the throughput of `items` per call."""
+    p50, p99 = np.percentile(samples, [50, 99]) * 1e3
+    rate = items * len(samples) / sum(samples)
+    print(
+        f"{name:28} size={size:>5}  p50 {p50:9.1f} ms  p99 {p99:9.1f} ms  "
+        f"{rate:9.1f} {unit}/s"
+    )
+
+
+def timed(f: Callable[[], object], repeat: int) -> List[float]:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 500])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--images", type=int, default=3, help="images per monument")
+    parser.add_argument("--image-size", type=int, default=50_000)
+    parser.add_argument("--wiki-latency", type=float, default=0.02)
+    parser.add_argument("--image-latency", type=float, default=0.01)
+    parser.add_argument("--upload-latency", type=float, default=0.005)
+    parser.add_argument("--search-latency", type=float, default=0.05)
+    parser.add_argument("--query", default="tests/lipstick1.jpg")
+    parser.add_argument(
+        "--metrics", action="store_true", help="print per-stage metrics at the end"
+    )
+    args = parser.parse_args()
+
+    for key in ["IMAGE_BUCKET", "CSV_BUCKET", "PRODUCT_SET_ID", "PROJECT_ID"]:
+        os.environ.setdefault(key, f"bench-{key.lower().replace('_', '-')}")
+    clients.config.reload()
+    sink = metrics.add_sink(metrics.PrometheusSink()) if args.metrics else None
+    annotator = FakeImageAnnotator(latency=args.search_latency)
+    clients.register("image_annotator", annotator)
+
+    with open(args.query, "rb") as f:
+        query = base64.b64encode(f.read()).decode()
+
+    with FakeImageServer(args.image_size, args.image_latency) as images:
+        for size in args.sizes:
+            with FakeWikiAPI(
+                size,
+                args.images,
+                CENTER,
+                SPREAD,
+                args.wiki_latency,
+                image_url=images.url,
+            ) as wiki:
+                wiki_parser.BASE_URL = wiki.url
+                monuments = []
+                samples = timed(
+                    lambda: monuments.append(
+                        wiki_parser.search_monuments_nearby(CENTER, SPREAD, size)
+                    ),
+                    args.repeat,
+                )
+                report("search_monuments_nearby", size, samples, size, "monuments")
+
+                # the three sequential passes it replaced, for comparison
+                samples = timed(
+                    lambda: wiki_parser.get_monuments(
+                        wiki_parser.geosearch_pages(CENTER, SPREAD, size)
+                    ),
+                    args.repeat,
+                )
+                report("geosearch + get_monuments", size, samples, size, "monuments")
+
+            storage = MemoryStorage(args.upload_latency)
+            clients.register("storage", storage)
+            mirrored = []
+
+            def upload():
+                # fresh copies, since the upload replaces their URLs
+                batch = [
+                    WikiMonument(m.name, m.desc, m.coord, list(m.image_urls))
+                    for m in monuments[0]
+                ]
+                mirrored[:] = gcloud.upload_images_from_monuments(batch, bar=False)
+
+            samples = timed(upload, args.repeat)
+            report(
+                "upload_images_from_monuments",
+                size,
+                samples,
+                size * args.images,
+                "images",
+            )
+
+            samples = timed(lambda: gcloud.monuments_to_csv(mirrored), args.repeat)
+            report("monuments_to_csv", size, samples, size * args.images, "rows")
+
+            # the first query imports the Vision library
+            gcloud.get_similar_products_file(query, None, 3)
+            samples = [
+                timed(lambda: gcloud.get_similar_products_file(query, None, 3), 1)[0]
+                for _ in range(size)
+            ]
+            report("get_similar_products_file", size, samples, 1, "queries")
+
+    wiki_parser.BASE_URL = "https://en.wikipedia.org/w/api.php"
+    clients.reset()
+    if sink is not None:
+        metrics.remove_sink(sink)
+        print(sink.exposition())
+
+
+if __name__ == "__main__":
+    main()
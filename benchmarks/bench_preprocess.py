@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""Bytes saved and encode time of `prepare_image` over the sample query photos.
+Run from the repository root with `python -m benchmarks.bench_preprocess`."""
+
+import argparse
+import glob
+import time
+
+from loca_vision.preprocess import MAX_SIDE, QUALITY, prepare_image, prepare_images
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("images", nargs="*", default=sorted(glob.glob("tests/*.jpg")))
+    parser.add_argument("--max-side", type=int, default=MAX_SIDE)
+    parser.add_argument("--quality", type=int, default=QUALITY)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    datas = []
+    for path in args.images:
+        with open(path, "rb") as f:
+            datas.append(f.read())
+
+    total_in = total_out = 0
+    for path, data in zip(args.images, datas):
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            prepared = prepare_image(data, args.max_side, args.quality)
+        elapsed = (time.perf_counter() - start) / args.repeat
+
+        total_in += len(data)
+        total_out += len(prepared.data)
+        print(
+            f"{path:24} {len(data) / 1e3:8.1f} kB -> {len(prepared.data) / 1e3:7.1f} kB "
+            f"({1 - len(prepared.data) / len(data):6.1%} saved) "
+            f"{prepared.size[0]}x{prepared.size[1]} in {elapsed * 1e3:6.1f} ms, "
+            f"gps {prepared.gps}"
+        )
+
+    print(
+        f"{'total':24} {total_in / 1e3:8.1f} kB -> {total_out / 1e3:7.1f} kB "
+        f"({1 - total_out / total_in:6.1%} saved)"
+    )
+
+    batch = datas * args.repeat
+    start = time.perf_counter()
+    prepare_images(batch, args.max_side, args.quality)
+    elapsed = time.perf_counter() - start
+    print(
+        f"process pool: {len(batch)} images in {elapsed:.2f}s ({len(batch) / elapsed:.1f} img/s)"
+    )
+
+
+if __name__ == "__main__":
+    main()
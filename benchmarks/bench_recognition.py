@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""Accuracy and latency of local recognition over the reference images. Run from
+the repository root with `python -m benchmarks.bench_recognition`.
+
+Every query is expected to be recognized as `--expected`. Two kinds of negative
+queries, which should all fall back to Product Search, count false accepts:
+
+- synthetic images of nothing in particular (noise, lines, text, stripes), and
+- off-catalog photos: the queries again, against the index without `--expected`.
+
+Product Search is faked here, so the run stays offline."""
+
+import argparse
+import base64
+import glob
+import io
+import os
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+from loca_vision import clients
+from loca_vision.recognition import LocalIndex, recognize
+
+from .fakes import FakeImageAnnotator
+
+
+def synthetic_images(n: int, seed: int = 0):
+    """`n` JPEGs that look like nothing in the reference images."""
+    rng = np.random.default_rng(seed)
+
+    def color():
+        return tuple(int(c) for c in rng.integers(0, 256, 3))
+
+    for i in range(n):
+        kind = i % 4
+        if kind == 0:
+            noise = (rng.random((480, 640, 3)) * 255).astype(np.uint8)
+            image = Image.fromarray(noise).filter(ImageFilter.GaussianBlur(2 + i % 8))
+        elif kind == 1:
+            image = Image.new("RGB", (640, 480), color())
+            draw = ImageDraw.Draw(image)
+            for _ in range(60):
+                points = [int(p) for p in rng.integers(0, 480, 4)]
+                draw.line(points, fill=color(), width=int(rng.integers(1, 6)))
+        elif kind == 2:
+            image = Image.new("RGB", (640, 480), "white")
+            draw = ImageDraw.Draw(image)
+            for _ in range(40):
+                xy = (int(rng.integers(0, 600)), int(rng.integers(0, 460)))
+                draw.text(xy, f"Lorem ipsum {rng.integers(1000)}", fill=color())
+        else:
+            size = int(rng.integers(8, 40))
+            stripes = (np.indices((480, 640)).sum(0) // size % 2 * 255).astype(np.uint8)
+            image = Image.fromarray(stripes).rotate(float(rng.integers(0, 45)))
+
+        buffer = io.BytesIO()
+        image.convert("RGB").save(buffer, "JPEG")
+        yield f"synthetic-{i}", buffer.getvalue()
+
+
+def without(index: LocalIndex, product: str) -> LocalIndex:
+    """The index with one product left out."""
+    left_out = index.products.index(product)
+    bounds = list(index.starts) + [len(index.descriptors)]
+    keep = [i for i in range(len(index)) if i != left_out]
+    sizes = [bounds[i + 1] - bounds[i] for i in keep]
+    images = index.hash_products != left_out
+    return LocalIndex(
+        [index.products[i] for i in keep],
+        np.concatenate([[0], np.cumsum(sizes)[:-1]]),
+        np.concatenate([index.descriptors[bounds[i] : bounds[i + 1]] for i in keep]),
+        index.hashes[images],
+        [keep.index(p) for p in index.hash_products[images]],
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "queries", nargs="*", default=sorted(glob.glob("tests/lipstick*.jpg"))
+    )
+    parser.add_argument("--reference", default="test_reference")
+    parser.add_argument("--expected", default="lipstick-tank")
+    parser.add_argument("--synthetic", type=int, default=12)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    for key in ["PRODUCT_SET_ID", "PROJECT_ID"]:
+        os.environ.setdefault(key, f"bench-{key.lower().replace('_', '-')}")
+    clients.config.reload()
+    clients.register("image_annotator", FakeImageAnnotator(latency=0.1))
+
+    start = time.perf_counter()
+    index = LocalIndex.build(args.reference)
+    elapsed = time.perf_counter() - start
+    print(
+        f"indexed {len(index)} products, {len(index.hashes)} images in {elapsed:.2f}s "
+        f"({index.nbytes / 1e3:.0f} kB in memory)"
+    )
+
+    photos = []
+    for path in args.queries:
+        with open(path, "rb") as f:
+            photos.append((path, f.read()))
+    off_catalog = without(index, args.expected)
+
+    # (label, image, index, expected product, or None if it should fall back)
+    queries = [(path, data, index, args.expected) for path, data in photos]
+    queries += [
+        (name, data, index, None) for name, data in synthetic_images(args.synthetic)
+    ]
+    queries += [
+        (f"{path} (off-catalog)", data, off_catalog, None) for path, data in photos
+    ]
+
+    correct = false_accepts = negatives = 0
+    samples = []
+    for label, data, queried, expected in queries:
+        b64 = base64.b64encode(data).decode()
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            recognition = recognize(b64, queried)
+            samples.append(time.perf_counter() - start)
+
+        if recognition.source == "local":
+            top = recognition.matches[0]
+            answer = (
+                f"{top.product} (score {top.score:.2f}, {top.votes} votes, "
+                f"coverage {top.coverage:.3f})"
+            )
+        else:
+            top = None
+            answer = "not confident, asked Product Search"
+
+        if expected is None:
+            negatives += 1
+            false_accepts += top is not None
+            correct += top is None
+        else:
+            correct += top is not None and top.product == expected
+        print(f"{label:38} {answer}")
+
+    p50, p99 = np.percentile(samples, [50, 99]) * 1e3
+    print(
+        f"accuracy {correct}/{len(queries)}, "
+        f"false accepts {false_accepts}/{negatives} negatives; "
+        f"latency p50 {p50:.1f} ms, p99 {p99:.1f} ms"
+    )
+    clients.reset()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""Query latency of `SpatialIndex` against a linear scan with `CoordArray`. Run
+from the repository root with `python -m benchmarks.bench_spatial_index`.
+
+Points are clustered around a few hundred "cities", which is closer to real
+monument data than a uniform spread."""
+
+import argparse
+import time
+
+import numpy as np
+
+from loca_vision.coord_array import CoordArray
+from loca_vision.spatial_index import SpatialIndex
+
+
+def make_points(n: int, rng) -> CoordArray:
+    cities = 300
+    centers_lat = rng.uniform(-60, 70, cities)
+    centers_lon = rng.uniform(-180, 180, cities)
+    which = rng.integers(0, cities, n)
+    return CoordArray(
+        np.clip(centers_lat[which] + rng.normal(0, 0.3, n), -90, 90),
+        (centers_lon[which] + rng.normal(0, 0.3, n) + 180) % 360 - 180,
+    )
+
+
+def timeit(f, queries) -> float:
+    """Mean milliseconds per query."""
+    start = time.perf_counter()
+    for q in queries:
+        f(q)
+    return (time.perf_counter() - start) / len(queries) * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+    )
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--radius", type=float, default=2_000)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    for n in args.sizes:
+        points = make_points(n, rng)
+        points.radians
+
+        start = time.perf_counter()
+        index = SpatialIndex()
+        index.extend(points, range(n))
+        build = time.perf_counter() - start
+
+        queries = points[rng.integers(0, n, args.queries)].to_coords()
+
+        scan_radius = timeit(
+            lambda q: np.flatnonzero(points.distance(q) <= args.radius), queries
+        )
+        scan_knn = timeit(
+            lambda q: np.argpartition(points.distance(q), args.k)[: args.k], queries
+        )
+        index_radius = timeit(lambda q: index.within(q, args.radius), queries)
+        index_knn = timeit(lambda q: index.nearest(q, args.k), queries)
+
+        print(
+            f"n={n:>9,}  build {build * 1e3:8.1f} ms | "
+            f"radius {args.radius:g} m: scan {scan_radius:8.3f} ms, index {index_radius:8.3f} ms | "
+            f"{args.k}-NN: scan {scan_knn:8.3f} ms, index {index_knn:8.3f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+"""Local stand-ins for the external services, so the benchmarks run offline."""
+
+from __future__ import annotations
+
+import base64
+import hashlib
+import io
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from typing import Callable, Dict, List
+from urllib.parse import parse_qs, urlparse
+
+from loca_vision.coord import EARTH_RADIUS, Coord
+
+
+class FakeImageServer:
+    """Serves `size` bytes of image data for any GET, after `latency` seconds.
+
+    Use it as a context manager; `url(path)` gives the address of an image."""
+
+    def __init__(self, size: int = 200_000, latency: float = 0.05):
+        self.size = size
+        self.latency = latency
+        self.payload = bytes(range(256)) * (size // 256) + bytes(size % 256)
+        self.requests = 0
+        self._lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                with server._lock:
+                    server.requests += 1
+                time.sleep(server.latency)
+                self.send_response(200)
+                self.send_header("Content-Type", "image/jpeg")
+                self.send_header("Content-Length", str(len(server.payload)))
+                self.end_headers()
+                self.wfile.write(server.payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def url(self, path: str) -> str:
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}/{path.lstrip('/')}"
+
+    def __enter__(self) -> FakeImageServer:
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class MemoryBlob:
+    def __init__(self, bucket: MemoryBucket, name: str):
+        self.bucket = bucket
+        self.name = name
+
+    def upload_from_string(self, data, content_type=None):
+        time.sleep(self.bucket.latency)
+        if isinstance(data, str):
+            data = data.encode()
+        with self.bucket._lock:
+            self.bucket.blobs[self.name] = bytes(data)
+
+    def exists(self) -> bool:
+        return self.name in self.bucket.blobs
+
+    def download_as_bytes(self) -> bytes:
+        return self.bucket.blobs[self.name]
+
+    @property
+    def md5_hash(self) -> str:
+        return base64.b64encode(hashlib.md5(self.download_as_bytes()).digest()).decode()
+
+    crc32c = None
+
+    def open(self, mode: str = "r", **kwargs):
+        """Like `Blob.open`, but only for writing: the blob appears on close."""
+        if "w" not in mode:
+            raise ValueError("MemoryBlob can only be opened for writing")
+        blob = self
+
+        class Writer(io.BytesIO if "b" in mode else io.StringIO):
+            def close(self):
+                if not self.closed:
+                    blob.upload_from_string(self.getvalue())
+                super().close()
+
+            def __exit__(self, exc_type, *exc):
+                # like a resumable upload, abandoned on errors
+                if exc_type is not None:
+                    super().close()
+                self.close()
+
+        return Writer()
+
+
+class MemoryBucket:
+    """An in-memory stand-in for `google.cloud.storage.Bucket`. Every upload
+    sleeps for `latency` seconds to mimic the round trip."""
+
+    def __init__(self, name: str = "bench-bucket", latency: float = 0.02):
+        self.name = name
+        self.latency = latency
+        self.blobs: Dict[str, bytes] = {}
+        self._lock = threading.Lock()
+
+    def blob(self, name: str) -> MemoryBlob:
+        return MemoryBlob(self, name)
+
+
+class MemoryStorage:
+    """A stand-in for `storage.Client`, with a `MemoryBucket` per name."""
+
+    def __init__(self, latency: float = 0.02):
+        self.latency = latency
+        self.buckets: Dict[str, MemoryBucket] = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, name: str) -> MemoryBucket:
+        with self._lock:
+            if name not in self.buckets:
+                self.buckets[name] = MemoryBucket(name, self.latency)
+            return self.buckets[name]
+
+    def list_blobs(self, name: str) -> List[MemoryBlob]:
+        bucket = self.bucket(name)
+        with bucket._lock:
+            return [bucket.blob(blob) for blob in sorted(bucket.blobs)]
+
+
+class _Server:
+    """Runs a handler class on a local port while used as a context manager."""
+
+    def __init__(self, handler):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}/w/api.php"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class FakeWikiAPI(_Server):
+    """The parts of the MediaWiki API that `wiki_parser` uses (geosearch, and
+    extracts, page images, coordinates, images and imageinfo by page ID, title
+    or the geosearch and images generators), over `pages` made-up pages
+    scattered within `spread` meters of `center`, each with `images` images.
+    Every request takes `latency` seconds.
+
+    Image URLs come from `image_url(title)`, e.g. a `FakeImageServer`'s `url`.
+    Point `wiki_parser.BASE_URL` at `url` while it runs."""
+
+    # pages per request that get intros, like the real API
+    EXLIMIT = 20
+
+    def __init__(
+        self,
+        pages: int = 1000,
+        images: int = 3,
+        center: Coord = Coord(41.31, -72.92),
+        spread: float = 5000,
+        latency: float = 0.05,
+        image_url: Callable[[str], str] = lambda title: f"https://upload.invalid/{title}",
+        seed: int = 0,
+    ):
+        self.latency = latency
+        self.image_url = image_url
+        self.requests = 0
+        self._lock = threading.Lock()
+
+        rng = random.Random(seed)
+        self.pages: Dict[int, dict] = {}
+        for pageid in range(1, pages + 1):
+            # uniform over the disc
+            r = spread * math.sqrt(rng.random())
+            theta = rng.uniform(0, 2 * math.pi)
+            lat = center.lat + math.degrees(r * math.cos(theta) / EARTH_RADIUS)
+            lon = center.lon + math.degrees(
+                r * math.sin(theta) / EARTH_RADIUS / math.cos(math.radians(center.lat))
+            )
+            title = f"Monument {pageid}"
+            self.pages[pageid] = {
+                "pageid": pageid,
+                "ns": 0,
+                "title": title,
+                "extract": f"{title} is a made-up landmark. " * 5,
+                "pageimage": f"{title}_0.jpg".replace(" ", "_"),
+                "coordinates": [
+                    {"lat": lat, "lon": lon, "primary": True, "globe": "earth"}
+                ],
+                "images": [
+                    {"ns": 6, "title": f"File:{title} {i}.jpg"} for i in range(images)
+                ],
+            }
+
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                with api._lock:
+                    api.requests += 1
+                time.sleep(api.latency)
+                params = {k: v[-1] for k, v in parse_qs(urlparse(self.path).query).items()}
+                body = json.dumps(api.respond(params)).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        super().__init__(Handler)
+
+    def respond(self, params: Dict[str, str]) -> dict:
+        if params.get("list") == "geosearch":
+            return self._geosearch(params)
+        if params.get("generator") == "geosearch":
+            hits = self._geosearch({k[1:]: v for k, v in params.items()})
+            pageids = [hit["pageid"] for hit in hits["query"]["geosearch"]]
+            return self._pages(params, sorted(pageids))
+        if params.get("generator") == "images":
+            titles = []
+            for pageid in params["pageids"].split("|"):
+                page = self.pages.get(int(pageid), {})
+                titles.extend(im["title"] for im in page.get("images", []))
+            return self._imageinfo(params, list(dict.fromkeys(titles)))
+        if "pageids" in params:
+            pageids = [int(pageid) for pageid in params["pageids"].split("|")]
+            return self._pages(params, pageids)
+        if params.get("prop") == "imageinfo":
+            return self._imageinfo(params, params["titles"].split("|"))
+        return {"error": {"code": "badparams", "info": f"unsupported: {params}"}}
+
+    def _geosearch(self, params: Dict[str, str]) -> dict:
+        lat, lon = map(float, params["gscoord"].split("|"))
+        radius, limit = float(params["gsradius"]), int(params["gslimit"])
+        hits = []
+        for page in self.pages.values():
+            c = page["coordinates"][0]
+            p1, p2 = math.radians(lat), math.radians(c["lat"])
+            h = (
+                math.sin((p2 - p1) / 2) ** 2
+                + math.cos(p1) * math.cos(p2) * math.sin(math.radians(c["lon"] - lon) / 2) ** 2
+            )
+            dist = 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(h)))
+            if dist <= radius:
+                hits.append(
+                    {
+                        "pageid": page["pageid"],
+                        "ns": 0,
+                        "title": page["title"],
+                        "lat": c["lat"],
+                        "lon": c["lon"],
+                        "dist": round(dist, 1),
+                        "primary": "",
+                    }
+                )
+        hits.sort(key=lambda hit: hit["dist"])
+        return {"batchcomplete": "", "query": {"geosearch": hits[:limit]}}
+
+    def _pages(self, params: Dict[str, str], pageids: List[int]) -> dict:
+        """The pages with their props, and intros for only `EXLIMIT` of them at a
+        time, continued with `excontinue` as MediaWiki does."""
+        offset = int(params.get("excontinue", 0))
+        pages = []
+        for i, pageid in enumerate(pageids):
+            page = self.pages.get(pageid, {"pageid": pageid, "missing": True})
+            if offset:
+                # the other props were all in the first response
+                page = {
+                    k: page[k]
+                    for k in ("pageid", "ns", "title", "extract")
+                    if k in page
+                }
+            else:
+                page = dict(page)
+            if not offset <= i < offset + self.EXLIMIT:
+                page.pop("extract", None)
+            pages.append(page)
+
+        json = {"query": {"pages": pages}}
+        if offset + self.EXLIMIT < len(pageids):
+            json["continue"] = {"excontinue": offset + self.EXLIMIT, "continue": "||"}
+        else:
+            json["batchcomplete"] = True
+        return json
+
+    def _imageinfo(self, params: Dict[str, str], titles: List[str]) -> dict:
+        width = int(params.get("iiurlwidth", 0))
+        pages = []
+        for title in titles:
+            info = {
+                "url": self.image_url(title),
+                "size": 4_000_000,
+                "width": 4000,
+                "height": 3000,
+                "mime": "image/jpeg",
+            }
+            if width:
+                name = title.split(":", 1)[-1]
+                info["thumburl"] = self.image_url(f"thumb/{width}px-{name}")
+                info["thumbwidth"] = min(width, info["width"])
+                info["thumbheight"] = info["thumbwidth"] * 3 // 4
+                info["thumbmime"] = "image/jpeg"
+            pages.append({"ns": 6, "title": title, "imageinfo": [info]})
+        return {"batchcomplete": True, "query": {"pages": pages}}
+
+
+class FakeImageAnnotator:
+    """A stand-in for `vision.ImageAnnotatorClient.product_search` that answers
+    every query with the same `results` products after `latency` seconds."""
+
+    def __init__(self, results: int = 3, latency: float = 0.1):
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+        self.results: List[SimpleNamespace] = [
+            SimpleNamespace(
+                score=1 - i / 10,
+                image=f"projects/bench/locations/us-east1/products/monument-{i}/referenceImages/0",
+                product=SimpleNamespace(
+                    name=f"projects/bench/locations/us-east1/products/monument-{i}",
+                    display_name=f"Monument {i}",
+                    description="",
+                    product_labels=[],
+                ),
+            )
+            for i in range(results)
+        ]
+
+    def product_search(self, image, image_context=None, max_results=None):
+        with self._lock:
+            self.requests += 1
+        time.sleep(self.latency)
+        return SimpleNamespace(
+            product_search_results=SimpleNamespace(
+                index_time="2022-01-01T00:00:00Z",
+                results=self.results[:max_results],
+            )
+        )
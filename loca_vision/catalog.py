@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""A columnar, memory-mapped catalog of monuments.
+
+A list of `WikiMonument`s costs hundreds of bytes of Python objects per
+monument before any of its text, and loading one from JSON means parsing and
+building all of them up front. A catalog file instead keeps each field as a
+column:
+
+- latitudes and longitudes as float64 arrays,
+- names and descriptions as UTF-8 blobs, with an array of offsets saying where
+  each one starts and ends,
+- image URLs as one blob of all of them, with offsets per URL, and the index of
+  each monument's first URL.
+
+Opening a catalog maps the file into memory and reads nothing else, so it's
+instant whatever the size, and the operating system pages in only what's used.
+Indexing gives a lazy `MonumentView`, which decodes a field when it's read;
+`coords` gives every coordinate as a `CoordArray` without copying.
+
+Convert to and from the JSON of `WikiMonument.to_json` (a list, or NDJSON as
+written by `monument_store`) with `python -m loca_vision.catalog`."""
+
+from __future__ import annotations
+
+import argparse
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+from array import array
+from typing import IO, Dict, Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+from .coord import Coord
+from .coord_array import CoordArray
+from .monument_store import read_monuments, write_monuments
+from .wiki_monument import WikiMonument
+
+MAGIC = b"LOCACAT\0"
+VERSION = 1
+
+# in file order; every section starts at a multiple of 8 bytes
+SECTIONS: Tuple[Tuple[str, str], ...] = (
+    ("lat", "<f8"),
+    ("lon", "<f8"),
+    ("name_offsets", "<u8"),
+    ("desc_offsets", "<u8"),
+    ("url_starts", "<u8"),
+    ("url_offsets", "<u8"),
+    ("names", "u1"),
+    ("descs", "u1"),
+    ("urls", "u1"),
+)
+
+# magic, version, monument count, then the offset and byte length of each section
+HEADER = struct.Struct("<8sIQ" + "QQ" * len(SECTIONS))
+
+
+def _align(n: int) -> int:
+    return (n + 7) & ~7
+
+
+class _Blob:
+    """A string column being written: the UTF-8 bytes go to a temporary file,
+    and their end offsets are kept in memory, 8 bytes per string."""
+
+    def __init__(self, directory: str):
+        self.file = tempfile.TemporaryFile(dir=directory)
+        self.offsets = array("Q", [0])
+
+    def append(self, text: str):
+        data = text.encode("utf-8")
+        self.file.write(data)
+        self.offsets.append(self.offsets[-1] + len(data))
+
+
+def write_catalog(path: str, monuments: Iterable[WikiMonument]) -> int:
+    """Writes the monuments as a catalog file and returns how many there were.
+    They're streamed: only the coordinates and offsets, not the text, are held
+    in memory until the end."""
+    directory = os.path.dirname(os.path.abspath(path))
+    lat, lon = array("d"), array("d")
+    url_starts = array("Q", [0])
+    names, descs, urls = _Blob(directory), _Blob(directory), _Blob(directory)
+
+    try:
+        for mon in monuments:
+            lat.append(mon.coord.lat)
+            lon.append(mon.coord.lon)
+            names.append(mon.name)
+            descs.append(mon.desc)
+            for url in mon.image_urls:
+                urls.append(url)
+            url_starts.append(len(urls.offsets) - 1)
+
+        arrays = {
+            "lat": lat,
+            "lon": lon,
+            "name_offsets": names.offsets,
+            "desc_offsets": descs.offsets,
+            "url_starts": url_starts,
+            "url_offsets": urls.offsets,
+        }
+        blobs = {"names": names, "descs": descs, "urls": urls}
+
+        # lay the sections out after the header
+        layout: List[int] = []
+        position = _align(HEADER.size)
+        for name, _ in SECTIONS:
+            size = (
+                len(arrays[name]) * arrays[name].itemsize
+                if name in arrays
+                else blobs[name].offsets[-1]
+            )
+            layout += [position, size]
+            position = _align(position + size)
+
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(lat), *layout))
+            for (name, _), offset in zip(SECTIONS, layout[::2]):
+                f.write(b"\0" * (offset - f.tell()))
+                if name in arrays:
+                    # `array` is in native byte order; the format is little-endian
+                    column = np.asarray(arrays[name]).astype(dict(SECTIONS)[name])
+                    f.write(column.tobytes())
+                else:
+                    blobs[name].file.seek(0)
+                    shutil.copyfileobj(blobs[name].file, f)
+        os.replace(tmp, path)
+    finally:
+        for blob in (names, descs, urls):
+            blob.file.close()
+
+    return len(lat)
+
+
+class MonumentView:
+    """A monument in a catalog, read lazily: each field is decoded from the
+    mapped file when it's accessed. Reads like a `WikiMonument`; use
+    `to_monument` for a real one."""
+
+    __slots__ = ("_catalog", "_index")
+
+    def __init__(self, catalog: Catalog, index: int):
+        self._catalog = catalog
+        self._index = index
+
+    @property
+    def name(self) -> str:
+        return self._catalog.name(self._index)
+
+    @property
+    def desc(self) -> str:
+        return self._catalog.desc(self._index)
+
+    @property
+    def coord(self) -> Coord:
+        return self._catalog.coord(self._index)
+
+    @property
+    def image_urls(self) -> List[str]:
+        return self._catalog.image_urls(self._index)
+
+    slug = WikiMonument.slug
+    to_json = WikiMonument.to_json
+
+    def to_monument(self) -> WikiMonument:
+        return WikiMonument(self.name, self.desc, self.coord, self.image_urls)
+
+    def __repr__(self):
+        return f"MonumentView({self._index}, {self.name!r})"
+
+
+class Catalog:
+    """A catalog file opened for reading. Opening maps the file and reads only
+    the header; use it as a context manager, or `close` it, to unmap it.
+
+    `coords` is a view of the mapped file. Arrays taken from it that are still
+    referenced when the catalog is closed keep the file mapped, and stay
+    valid, until they're garbage collected; copy them to keep them
+    independently of the file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, count, *layout = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            self._map.close()
+            raise ValueError(f"{path} is not a monument catalog")
+        if version != VERSION:
+            self._map.close()
+            raise ValueError(f"{path} is a version {version} catalog, not {VERSION}")
+
+        self._count = count
+        self._closed = False
+        self._columns: Dict[str, np.ndarray] = {}
+        for (name, dtype), offset, size in zip(SECTIONS, layout[::2], layout[1::2]):
+            dtype = np.dtype(dtype)
+            self._columns[name] = np.frombuffer(
+                self._map, dtype, size // dtype.itemsize, offset
+            )
+        self.coords = CoordArray(self._columns["lat"], self._columns["lon"])
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _column(self, name: str) -> np.ndarray:
+        if self._closed:
+            raise ValueError("the catalog is closed")
+        return self._columns[name]
+
+    def _text(self, blob: str, offsets: str, i: int) -> str:
+        start, end = self._column(offsets)[i : i + 2]
+        return self._column(blob)[start:end].tobytes().decode("utf-8")
+
+    def name(self, i: int) -> str:
+        return self._text("names", "name_offsets", i)
+
+    def desc(self, i: int) -> str:
+        return self._text("descs", "desc_offsets", i)
+
+    def coord(self, i: int) -> Coord:
+        return Coord(float(self._column("lat")[i]), float(self._column("lon")[i]))
+
+    def image_urls(self, i: int) -> List[str]:
+        first, last = self._column("url_starts")[i : i + 2]
+        return [self._text("urls", "url_offsets", j) for j in range(first, last)]
+
+    def __getitem__(self, i: int) -> MonumentView:
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError("catalog index out of range")
+        return MonumentView(self, i)
+
+    def __iter__(self) -> Iterator[MonumentView]:
+        return (MonumentView(self, i) for i in range(self._count))
+
+    def monuments(self) -> Iterator[WikiMonument]:
+        """Every monument, as a `WikiMonument`."""
+        return (view.to_monument() for view in self)
+
+    def close(self):
+        self._closed = True
+        # the column views must go before the map can be closed
+        self._columns.clear()
+        self.coords = None
+        try:
+            self._map.close()
+        except BufferError:
+            # some of `coords` is still in use: the map goes when it does
+            pass
+
+    def __enter__(self) -> Catalog:
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_json_monuments(path: str) -> Iterator[WikiMonument]:
+    """The monuments in a JSON file: one `to_json` per line if the name ends in
+    `.ndjson`, and a list of them otherwise."""
+    if path.endswith(".ndjson"):
+        return read_monuments(path)
+    with open(path, "r", encoding="utf-8") as f:
+        return iter([WikiMonument.from_json(obj) for obj in json.load(f)])
+
+
+def _write_json_list(f: IO[str], monuments: Iterable[WikiMonument]) -> int:
+    count = 0
+    f.write("[")
+    for mon in monuments:
+        f.write(",\n" if count else "\n")
+        f.write(json.dumps(mon.to_json(), ensure_ascii=False))
+        count += 1
+    f.write("\n]\n")
+    return count
+
+
+def write_json_monuments(path: str, monuments: Iterable[WikiMonument]) -> int:
+    """Writes the monuments as NDJSON if the name ends in `.ndjson`, and as a
+    list otherwise, one monument at a time. Returns how many there were."""
+    if path.endswith(".ndjson"):
+        return write_monuments(path, monuments, append=False)
+    with open(path, "w", encoding="utf-8") as f:
+        return _write_json_list(f, monuments)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m loca_vision.catalog",
+        description="Converts monuments between JSON (a list, or NDJSON if the "
+        "name ends in .ndjson) and the catalog format.",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    to_catalog = commands.add_parser("to-catalog", help="JSON to catalog")
+    to_catalog.add_argument("json")
+    to_catalog.add_argument("catalog")
+    from_catalog = commands.add_parser("from-catalog", help="catalog to JSON")
+    from_catalog.add_argument("catalog")
+    from_catalog.add_argument("json")
+    args = parser.parse_args()
+
+    if args.command == "to-catalog":
+        count = write_catalog(args.catalog, read_json_monuments(args.json))
+    else:
+        with Catalog(args.catalog) as catalog:
+            count = write_json_monuments(args.json, catalog.monuments())
+    print(count, "monuments")
+
+
+if __name__ == "__main__":
+    main()
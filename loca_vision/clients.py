@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""Configuration and Google Cloud clients, created only when first needed.
+
+Building a client sets up a channel and authenticates, and importing
+`google.cloud` at all is slow, so nothing here happens at import time. Each
+client is built on first use and then shared by every thread for the rest of
+the process, as are the buckets made from the storage client (the mirror's
+upload threads share one). A forked worker gets fresh clients rather than its
+parent's channels."""
+
+from __future__ import annotations
+
+import os
+import threading
+from typing import Any, Callable, Dict, Iterator, Mapping, Optional
+
+
+class _Config(Mapping):
+    """The `.env` file overlaid with the environment, read on first access."""
+
+    def __init__(self):
+        self._values: Optional[Dict[str, str]] = None
+        self._lock = threading.Lock()
+
+    def _load(self) -> Dict[str, str]:
+        if self._values is None:
+            with self._lock:
+                if self._values is None:
+                    from dotenv import dotenv_values
+
+                    values = {**dotenv_values(".env"), **os.environ}
+                    if "GOOGLE_APPLICATION_CREDENTIALS" in values:
+                        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = values[
+                            "GOOGLE_APPLICATION_CREDENTIALS"
+                        ]
+                    self._values = values
+        return self._values
+
+    def reload(self):
+        """Forgets the loaded values, so the next access reads them again."""
+        with self._lock:
+            self._values = None
+
+    def __getitem__(self, key: str) -> str:
+        return self._load()[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._load())
+
+    def __len__(self) -> int:
+        return len(self._load())
+
+    def __repr__(self):
+        return "config(not loaded)" if self._values is None else repr(self._values)
+
+
+config = _Config()
+
+_lock = threading.Lock()
+_shared: Dict[str, Any] = {}
+_pid = os.getpid()
+
+
+def _shared_client(name: str, factory: Callable[[], Any]) -> Any:
+    global _pid
+    client = _shared.get(name)
+    if client is not None and _pid == os.getpid():
+        return client
+
+    with _lock:
+        if _pid != os.getpid():
+            _shared.clear()
+            _pid = os.getpid()
+        if name not in _shared:
+            config._load()
+            _shared[name] = factory()
+        return _shared[name]
+
+
+def product_search_client():
+    """The process's `vision.ProductSearchClient`."""
+
+    def factory():
+        from google.cloud import vision
+
+        return vision.ProductSearchClient()
+
+    return _shared_client("product_search", factory)
+
+
+def image_annotator_client():
+    """The process's `vision.ImageAnnotatorClient`."""
+
+    def factory():
+        from google.cloud import vision
+
+        return vision.ImageAnnotatorClient()
+
+    return _shared_client("image_annotator", factory)
+
+
+def storage_client():
+    """The process's `storage.Client`."""
+
+    def factory():
+        from google.cloud import storage
+
+        return storage.Client()
+
+    return _shared_client("storage", factory)
+
+
+def register(name: str, client: Any):
+    """Makes every thread use `client` for the named client ("product_search",
+    "image_annotator" or "storage"), e.g. to point the library at a stand-in."""
+    with _lock:
+        _shared[name] = client
+
+
+def reset():
+    """Drops every client, so they are rebuilt on next use."""
+    with _lock:
+        _shared.clear()
@@ -4,10 +4,15 @@ Earth reference point for now, and don't sweat the fine details too much."""
 
 from __future__ import annotations
 
+# mean Earth radius, in meters
+EARTH_RADIUS = 6_371_008.8
+
 
 class Coord:
     """A geographical point on the face of the Earth."""
 
+    __slots__ = ("lat", "lon")
+
     def __init__(self, lat: float, lon: float):
         self.lat = lat
         self.lon = lon
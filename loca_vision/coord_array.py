@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""Many geographical coordinates at once, stored as NumPy arrays.
+
+`CoordArray` is to a list of `Coord`s what a column is to a list of rows: all the
+latitudes in one contiguous float64 array and all the longitudes in another, so
+that distances, bearings and filters run as vectorized NumPy operations instead
+of Python loops. Distances are great-circle distances on a spherical Earth, in
+meters, and angles are in degrees."""
+
+from __future__ import annotations
+
+from typing import Iterable, Iterator, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from .coord import EARTH_RADIUS, Coord
+from .wiki_monument import WikiMonument
+
+
+def haversine(lat1, lon1, lat2, lon2) -> np.ndarray:
+    """Great-circle distance in meters between points given in radians. Broadcasts
+    like any NumPy operation."""
+    sin_dlat = np.sin((lat2 - lat1) / 2)
+    sin_dlon = np.sin((lon2 - lon1) / 2)
+    h = sin_dlat * sin_dlat + np.cos(lat1) * np.cos(lat2) * sin_dlon * sin_dlon
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(h, 0.0, 1.0)))
+
+
+class CoordArray:
+    """A sequence of coordinates backed by contiguous latitude and longitude arrays."""
+
+    def __init__(self, lat, lon):
+        self.lat = np.ascontiguousarray(lat, dtype=np.float64)
+        self.lon = np.ascontiguousarray(lon, dtype=np.float64)
+        if self.lat.shape != self.lon.shape or self.lat.ndim != 1:
+            raise ValueError("lat and lon must be 1-dimensional and the same length")
+        self._radians: Optional[Tuple[np.ndarray, np.ndarray]] = None
+
+    @classmethod
+    def from_coords(cls, coords: Iterable[Coord]) -> CoordArray:
+        coords = list(coords)
+        return cls(
+            np.fromiter((c.lat for c in coords), np.float64, len(coords)),
+            np.fromiter((c.lon for c in coords), np.float64, len(coords)),
+        )
+
+    @classmethod
+    def from_monuments(cls, monuments: Iterable[WikiMonument]) -> CoordArray:
+        return cls.from_coords(mon.coord for mon in monuments)
+
+    def to_coords(self) -> Sequence[Coord]:
+        return [
+            Coord(lat, lon) for lat, lon in zip(self.lat.tolist(), self.lon.tolist())
+        ]
+
+    @property
+    def radians(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Latitudes and longitudes in radians, computed once."""
+        if self._radians is None:
+            self._radians = (np.radians(self.lat), np.radians(self.lon))
+        return self._radians
+
+    def __len__(self) -> int:
+        return len(self.lat)
+
+    def __getitem__(self, key) -> Union[Coord, CoordArray]:
+        """An integer gives a `Coord`; a slice, index array or mask a `CoordArray`."""
+        if isinstance(key, (int, np.integer)):
+            return Coord(float(self.lat[key]), float(self.lon[key]))
+        return CoordArray(self.lat[key], self.lon[key])
+
+    def __iter__(self) -> Iterator[Coord]:
+        return iter(self.to_coords())
+
+    def __repr__(self):
+        return f"CoordArray({len(self)} points)"
+
+    def distance(self, coord: Coord) -> np.ndarray:
+        """Distance in meters from the point to every coordinate."""
+        lat, lon = self.radians
+        return haversine(np.radians(coord.lat), np.radians(coord.lon), lat, lon)
+
+    def pairwise(
+        self, other: Optional[CoordArray] = None, chunk_size: int = 1024
+    ) -> np.ndarray:
+        """The `len(self)` by `len(other)` matrix of distances in meters, computed
+        `chunk_size` rows at a time to bound the size of the temporaries. Compares
+        the array with itself if `other` isn't given."""
+        other = self if other is None else other
+        lat1, lon1 = self.radians
+        lat2, lon2 = other.radians
+        out = np.empty((len(self), len(other)))
+        for i in range(0, len(self), chunk_size):
+            rows = slice(i, i + chunk_size)
+            out[rows] = haversine(
+                lat1[rows, None], lon1[rows, None], lat2[None, :], lon2[None, :]
+            )
+        return out
+
+    def bearing(self, coord: Coord) -> np.ndarray:
+        """Initial bearing in degrees clockwise from north from the point to every
+        coordinate, in [0, 360)."""
+        lat1, lon1 = np.radians(coord.lat), np.radians(coord.lon)
+        lat2, lon2 = self.radians
+        dlon = lon2 - lon1
+        y = np.sin(dlon) * np.cos(lat2)
+        x = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(dlon)
+        return np.degrees(np.arctan2(y, x)) % 360
+
+    def bbox(self) -> Tuple[Coord, Coord]:
+        """The south-west and north-east corners of the smallest box around the
+        coordinates (ignoring the antimeridian)."""
+        if len(self) == 0:
+            raise ValueError("empty CoordArray has no bounding box")
+        return (
+            Coord(float(self.lat.min()), float(self.lon.min())),
+            Coord(float(self.lat.max()), float(self.lon.max())),
+        )
+
+    def within_bbox(self, sw: Coord, ne: Coord) -> np.ndarray:
+        """Mask of the coordinates inside the box with the given corners. A box with
+        `sw.lon > ne.lon` is taken to cross the antimeridian."""
+        lat_ok = (self.lat >= sw.lat) & (self.lat <= ne.lat)
+        if sw.lon <= ne.lon:
+            return lat_ok & (self.lon >= sw.lon) & (self.lon <= ne.lon)
+        return lat_ok & ((self.lon >= sw.lon) | (self.lon <= ne.lon))
+
+    def within(self, coord: Coord, radius: float) -> np.ndarray:
+        """Mask of the coordinates no more than `radius` meters from the point.
+
+        Only coordinates in the latitude band the circle spans have their distance
+        computed, which keeps this fast for small radii over large arrays."""
+        dlat = np.degrees(radius / EARTH_RADIUS)
+        band = np.flatnonzero(np.abs(self.lat - coord.lat) <= dlat)
+
+        lat, lon = self.radians
+        d = haversine(
+            np.radians(coord.lat), np.radians(coord.lon), lat[band], lon[band]
+        )
+        mask = np.zeros(len(self), dtype=bool)
+        mask[band[d <= radius]] = True
+        return mask
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""Choosing which of a monument's images are worth making reference images.
+
+Wikipedia pages pull in much more than photos of their subject: logos, maps,
+flags, icons, and several crops or copies of the same photo. Every one of them
+that gets uploaded makes the product set bigger and slower to index, and the
+off-topic ones make matches worse. Curation downloads each candidate image and
+decodes it (in a process pool, since decoding is CPU-bound) to prune:
+
+- tiny images, with a side under `MIN_SIDE` pixels, which are mostly icons,
+- extreme aspect ratios, beyond `MAX_ASPECT`, which are mostly banners and strips,
+- graphics, where a handful of flat colors cover most of the image (`GRAPHIC_SHARE`),
+- near-duplicates, whose perceptual hashes are within `DUPLICATE_DISTANCE` bits
+  of a better image of the same monument,
+
+and then keeps the best `KEEP` of the rest: the page image first, if it made
+it, then the highest resolution. Every pruned image is reported with why."""
+
+from __future__ import annotations
+
+import io
+import multiprocessing
+from collections import Counter, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Deque, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import requests
+from PIL import Image
+
+from . import metrics
+from .http_scheduler import get_scheduler
+from .image_cache import ImageCache
+from .imagehash import hamming, phash
+from .mirror import CHUNK_SIZE, TooLarge, make_session
+from .wiki_monument import WikiMonument
+from .wiki_parser import MAX_IMAGE_BYTES
+
+MIN_SIDE = 200
+MAX_ASPECT = 3.0
+
+# share of the pixels that the 8 most common (coarsely quantized) colors may
+# cover before the image counts as a graphic; photos rarely come near it
+GRAPHIC_SHARE = 0.9
+
+DUPLICATE_DISTANCE = 8
+
+# reference images kept per monument
+KEEP = 10
+
+
+class ImageStats(NamedTuple):
+    """What curation needs to know about a decoded image."""
+
+    width: int
+    height: int
+    hash: int
+    graphic_share: float
+
+
+class Pruned(NamedTuple):
+    """An image left out of a monument's reference images, and why."""
+
+    monument: str
+    url: str
+    reason: str
+
+
+def inspect_image(data: bytes) -> Optional[ImageStats]:
+    """The size, perceptual hash and flatness of the image, or None if it can't
+    be decoded. Decodes at reduced scale where the format allows."""
+    try:
+        image = Image.open(io.BytesIO(data))
+        width, height = image.size
+        image.draft("RGB", (64, 64))
+        small = image.convert("RGB").resize((64, 64))
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+    # 3 bits per channel, then how much of the image its 8 commonest colors cover
+    pixels = np.asarray(small, np.uint8) >> 5
+    codes = (
+        (pixels[..., 0].astype(np.int32) << 6) | (pixels[..., 1] << 3) | pixels[..., 2]
+    )
+    counts = np.sort(np.bincount(codes.ravel(), minlength=512))[::-1]
+    share = float(counts[:8].sum() / codes.size)
+    return ImageStats(width, height, phash(small), share)
+
+
+def rejection(stats: ImageStats) -> Optional[str]:
+    """Why the image shouldn't be a reference image on its own merits, if it
+    shouldn't."""
+    short, long = sorted((stats.width, stats.height))
+    if short < MIN_SIDE:
+        return "tiny"
+    if long > MAX_ASPECT * short:
+        return "aspect"
+    if stats.graphic_share > GRAPHIC_SHARE:
+        return "graphic"
+    return None
+
+
+def choose(
+    urls: List[str], stats: List[Optional[ImageStats]], keep: int = KEEP
+) -> Tuple[List[str], List[Tuple[str, str]]]:
+    """Picks the images of one monument, given their stats in the same order
+    (None for an image that couldn't be inspected, which is kept). Returns
+    the URLs kept, in order of preference, and `(url, reason)` for the rest."""
+    pruned = []
+    candidates = []
+    for i, (url, s) in enumerate(zip(urls, stats)):
+        reason = rejection(s) if s is not None else None
+        if reason:
+            pruned.append((url, reason))
+        else:
+            candidates.append((i, url, s))
+
+    # the page image (listed first) leads, then the highest resolution
+    def preference(candidate):
+        i, _, s = candidate
+        return (i != 0, -(s.width * s.height) if s else 0, i)
+
+    kept: List[Tuple[str, Optional[ImageStats]]] = []
+    for _, url, s in sorted(candidates, key=preference):
+        if s is not None and any(
+            k is not None and hamming(s.hash, k.hash) <= DUPLICATE_DISTANCE
+            for _, k in kept
+        ):
+            pruned.append((url, "duplicate"))
+        elif len(kept) >= keep:
+            pruned.append((url, "surplus"))
+        else:
+            kept.append((url, s))
+
+    return [url for url, _ in kept], pruned
+
+
+class _Fetcher:
+    """Downloads images through the shared scheduler, and the image cache if
+    there is one, so the mirror can take them from there instead of fetching
+    them again."""
+
+    def __init__(self, max_downloads: int, timeout: float, cache: Optional[ImageCache]):
+        self.session = make_session(max_downloads)
+        self.timeout = timeout
+        self.cache = cache
+
+    def _download(self, url: str) -> bytes:
+        with metrics.timer("request_seconds", stage="curate"):
+            r = get_scheduler().request(
+                "GET", url, session=self.session, timeout=self.timeout, stream=True
+            )
+        with r:
+            metrics.count("requests", stage="curate", status=r.status_code)
+            r.raise_for_status()
+            chunks, size = [], 0
+            for chunk in r.iter_content(CHUNK_SIZE):
+                size += len(chunk)
+                if size > MAX_IMAGE_BYTES:
+                    raise TooLarge(f"{url} is over {MAX_IMAGE_BYTES} bytes")
+                chunks.append(chunk)
+        metrics.count("bytes", size, stage="curate")
+        return b"".join(chunks)
+
+    def fetch(self, url: str) -> bytes:
+        cache = self.cache
+        if cache is None:
+            return self._download(url)
+
+        sha = cache.digest_for(url)
+        data = sha and cache.get_bytes(sha)
+        if data:
+            metrics.count("cache_hits", stage="curate")
+            return data
+        data = self._download(url)
+        cache.record_source(url, cache.put_bytes(data))
+        return data
+
+
+def iter_curated(
+    monuments: Iterable[WikiMonument],
+    keep: int = KEEP,
+    workers: Optional[int] = None,
+    max_downloads: int = 8,
+    timeout: float = 10,
+    cache: Optional[ImageCache] = None,
+    window: int = 16,
+) -> Iterator[Tuple[WikiMonument, List[Pruned]]]:
+    """Curates the images of a stream of monuments, generating each monument
+    (with its URLs narrowed down to the ones kept) along with what was pruned,
+    in input order.
+
+    Images are downloaded `max_downloads` at a time and decoded in a pool of
+    `workers` processes (by default one per CPU), with at most `window`
+    monuments in flight. Images that fail to download are kept, for the mirror
+    to try again; images already in Cloud Storage are kept as they are. With a
+    cache, the downloads are stored in it, so mirroring with the same cache
+    doesn't download them again."""
+    fetcher = _Fetcher(max_downloads, timeout, cache)
+
+    # forking copies whatever locks the process's other threads (the other stages
+    # of a pipeline, say) hold at the time, so the workers come from a server
+    # process started clean instead
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context(
+        "forkserver" if "forkserver" in methods else "spawn"
+    )
+
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=context
+    ) as processes, ThreadPoolExecutor(max_workers=max_downloads) as threads:
+
+        def inspect(url: str) -> Tuple[bool, Optional[ImageStats]]:
+            """Whether the image could be downloaded, and its stats if so."""
+            try:
+                data = fetcher.fetch(url)
+            except requests.RequestException as e:
+                metrics.event("curate_fetch_failed", source=url, error=str(e))
+                return False, None
+            # each thread waits on its image, so only `max_downloads` are in memory
+            return True, processes.submit(inspect_image, data).result()
+
+        def finish(mon: WikiMonument, jobs: List[Tuple[str, Optional[Future]]]):
+            urls, stats, dropped = [], [], []
+            for url, job in jobs:
+                fetched, s = job.result() if job else (False, None)
+                if fetched and s is None:
+                    dropped.append((url, "undecodable"))
+                else:
+                    urls.append(url)
+                    stats.append(s)
+
+            mon.image_urls, rest = choose(urls, stats, keep)
+            pruned = [Pruned(mon.name, url, reason) for url, reason in dropped + rest]
+            for p in pruned:
+                metrics.count("images", stage="curate", reason=p.reason)
+                metrics.event(
+                    "image_pruned", monument=p.monument, url=p.url, reason=p.reason
+                )
+            metrics.count("images", len(mon.image_urls), stage="curate", reason="kept")
+            return mon, pruned
+
+        pending: Deque[Tuple[WikiMonument, list]] = deque()
+        for mon in monuments:
+            jobs = [
+                (url, None if url.startswith("gs") else threads.submit(inspect, url))
+                for url in mon.image_urls
+            ]
+            pending.append((mon, jobs))
+            if len(pending) >= window:
+                yield finish(*pending.popleft())
+
+        while pending:
+            yield finish(*pending.popleft())
+
+
+def curate(
+    monuments: Iterable[WikiMonument], **kwargs
+) -> Tuple[List[WikiMonument], List[Pruned]]:
+    """Curates the monuments' images all at once, returning the monuments and
+    everything pruned. Takes the same options as `iter_curated`."""
+    curated, pruned = [], []
+    for mon, dropped in iter_curated(monuments, **kwargs):
+        curated.append(mon)
+        pruned.extend(dropped)
+    return curated, pruned
+
+
+def summary(pruned: Iterable[Pruned]) -> Dict[str, int]:
+    """How many images were pruned for each reason."""
+    return dict(Counter(p.reason for p in pruned))
@@ -1,276 +1,648 @@
 #!/usr/bin/env python3
 """Interface dealing with Google Cloud."""
 
-from google.cloud import storage
-from google.cloud import vision
-from typing import MutableSequence, Sequence
-from requests.exceptions import ConnectionError
-from slugify import slugify
-
-from dotenv import dotenv_values
-import os
-import requests
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    MutableSequence,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+from . import metrics
+from .clients import (
+    config,
+    image_annotator_client,
+    product_search_client,
+    storage_client,
+)
+from .geocell import cell_labels, geo_filter
+from .image_cache import ImageCache
+from .mirror import apply_results, iter_mirrored, mirror_images
 from .wiki_monument import WikiMonument
-from .wiki_parser import headers
 from tqdm import tqdm
-import hashlib
-import re
 import base64
+import csv
 import hashlib
+import io
+import itertools
+import re
+import time
+import uuid
 
-config = {**dotenv_values(".env"), **os.environ}
+if TYPE_CHECKING:
+    from .search_cache import SearchCache
 
-os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = config["GOOGLE_APPLICATION_CREDENTIALS"]
+
+def _report_mirror_result(result):
+    metrics.count("images", stage="mirror", ok=result.ok)
+    if not result.ok:
+        metrics.event("mirror_failed", source=result.source, error=result.error)
 
 
 def upload_images_from_monuments(
-    monuments: MutableSequence[WikiMonument], bar=True
+    monuments: MutableSequence[WikiMonument],
+    bar=True,
+    max_downloads: int = 8,
+    max_uploads: int = 8,
+    cache: Optional[ImageCache] = None,
 ) -> MutableSequence[WikiMonument]:
-    """Takes Monuments and their URLs, uploads them to Google Cloud, and replaces those URLs with the new URIs."""
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(config["IMAGE_BUCKET"])
+    """Takes Monuments and their URLs, uploads them to Google Cloud, and replaces those URLs with the new URIs.
+    With a cache, identical images are shared between monuments and across runs."""
+    bucket = storage_client().bucket(config["IMAGE_BUCKET"])
+
+    total = sum(not url.startswith("gs") for mon in monuments for url in mon.image_urls)
+    with tqdm(total=total, disable=not bar) as pbar, metrics.timer(
+        "stage_seconds", stage="mirror"
+    ):
+        results = mirror_images(
+            monuments,
+            bucket,
+            max_downloads=max_downloads,
+            max_uploads=max_uploads,
+            progress=lambda _: pbar.update(),
+            cache=cache,
+        )
 
-    for mon in tqdm(monuments) if bar else monuments:
-        for i, url in enumerate(mon.image_urls):
-            if not url.startswith("gs"):
-                ext = url.split(".")[-1]
+    for result in results:
+        _report_mirror_result(result)
+
+    return apply_results(monuments, results)
+
+
+def iter_upload_images_from_monuments(
+    monuments: Iterable[WikiMonument],
+    max_downloads: int = 8,
+    max_uploads: int = 8,
+    cache: Optional[ImageCache] = None,
+) -> Iterator[WikiMonument]:
+    """Streaming version of `upload_images_from_monuments`: generates each monument
+    with its URLs replaced as soon as its images are uploaded."""
+    bucket = storage_client().bucket(config["IMAGE_BUCKET"])
+
+    for mon, results in iter_mirrored(
+        monuments, bucket, max_downloads, max_uploads, cache=cache
+    ):
+        for result in results:
+            _report_mirror_result(result)
+        yield mon
+
+
+def upload_base64_image(b64: str, preprocess: bool = True) -> str:
+    """Uploads an image in base64 to the GC bucket and returns a URI pointing to the image.
+    Unless told otherwise, the image is shrunk first (see `preprocess.prepare_image`)."""
+    bin_data = decode_base64_image(b64)
+    if preprocess:
+        from .preprocess import prepare_image
+
+        bin_data = prepare_image(bin_data).data
+    fn = hashlib.md5(bin_data).hexdigest()[:15]
+    uri = f"{fn}.jpeg"
+    bucket = storage_client().bucket(config["IMAGE_BUCKET"])
+    blob = bucket.blob(uri)
+    blob.upload_from_string(bin_data, content_type="image/jpeg")
+    return f"gs://{config['IMAGE_BUCKET']}/{uri}"
 
-                uri = f"{slugify(mon.name)}/{i}.{ext}"
-                blob = bucket.blob(uri)
 
-                try:
-                    r = requests.get(url, headers=headers, timeout=3)
-                    blob.upload_from_string(r.content)
-                    mon.image_urls[i] = f'gs://{config["IMAGE_BUCKET"]}/{uri}'
-                except ConnectionError as e:
-                    print("Could not read image", url, ", skipping")
+# the region the product set lives in; every resource path is built from this and
+# `config["PROJECT_ID"]`
+LOCATION = "us-east1"
 
-    return
 
+def location_path() -> str:
+    """A resource that represents Google Cloud Platform location."""
+    return f"projects/{config['PROJECT_ID']}/locations/{LOCATION}"
 
-def upload_base64_image(b64: str) -> str:
-    """Uploads an image in base64 to the GC bucket and returns a URI pointing to the image."""
-    fn = hashlib.md5(b64).hexdigest()[:15]
-    uri = f"{fn}.jpeg"
-    data = b64.split('base64,')[1]
-    bin_data = base64.b64encode(data)
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(config["IMAGE_BUCKET"])
-    blob = bucket.blob(uri)
-    blob.upload_from_string(bin_data)
-    return f"gs://{config['IMAGE_BUCKET']}/{uri}"
 
+def product_path(product_id: str) -> str:
+    return f"{location_path()}/products/{product_id}"
 
-def create_product(product_id, product_display_name):
-    client = vision.ProductSearchClient()
 
-    # A resource that represents Google Cloud Platform location.
-    location_path = f"projects/{config['PROJECT_ID']}/locations/us-east1"
+def product_set_path() -> str:
+    return f"{location_path()}/productSets/{config['PRODUCT_SET_ID']}"
+
+
+def reference_image_path(product_id: str, reference_image_id: str) -> str:
+    return f"{product_path(product_id)}/referenceImages/{reference_image_id}"
+
+
+def label_key_values(labels: str) -> list:
+    """The `key=value,...` labels of the import CSV as `Product.KeyValue`s."""
+    from google.cloud import vision
+
+    return [
+        vision.Product.KeyValue(key=key, value=value)
+        for key, value in (label.split("=", 1) for label in labels.split(",") if label)
+    ]
+
+
+def create_product(product_id, product_display_name, labels="", add_to_set=True):
+    """Create a product, and unless told otherwise add it to the product set.
+    Args:
+        product_id: Id of the product.
+        product_display_name: Display name of the product.
+        labels: Labels in the import CSV format, `key=value,...`.
+        add_to_set: Whether to add the product to the product set.
+    """
+    from google.cloud import vision
+
+    client = product_search_client()
 
     # Create a product with the product specification in the region.
     # Set product display name and product category.
     product = vision.Product(
         display_name=product_display_name,
-        product_category='general-v1')
+        product_category='general-v1',
+        product_labels=label_key_values(labels))
 
     # The response is the product with the `name` field populated.
     response = client.create_product(
-        parent=location_path,
+        parent=location_path(),
         product=product,
         product_id=product_id)
 
-    add_product_to_product_set(product_id)
+    if add_to_set:
+        add_product_to_product_set(product_id)
 
-    # Display the product information.
-    print('Product name: {}'.format(response.name))
+    return response
 
 def create_reference_image(product_id, reference_image_id, gcs_uri):
     """Create a reference image.
     Args:
-        project_id: Id of the project.
-        location: A compute region name.
         product_id: Id of the product.
         reference_image_id: Id of the reference image.
         gcs_uri: Google Cloud Storage path of the input image.
     """
-    client = vision.ProductSearchClient()
+    from google.cloud import vision
 
-    # Get the full path of the product.
-    product_path = client.product_path(
-        project=config['PROJECT_ID'], location='us-east1', product=product_id)
+    client = product_search_client()
 
     # Create a reference image.
     reference_image = vision.ReferenceImage(uri=gcs_uri)
 
     # The response is the reference image with `name` populated.
-    image = client.create_reference_image(
-        parent=product_path,
+    return client.create_reference_image(
+        parent=product_path(product_id),
         reference_image=reference_image,
         reference_image_id=reference_image_id)
 
 def add_product_to_product_set(product_id):
-    """Add a product to a product set.
+    """Add a product to the product set.
     Args:
-        project_id: Id of the project.
-        location: A compute region name.
         product_id: Id of the product.
-        product_set_id: Id of the product set.
     """
-    client = vision.ProductSearchClient()
-
-    # Get the full path of the product set.
-    product_set_path = client.product_set_path(
-        project=config['PROJECT_ID'], location='us_east1',
-        product_set=config['PRODUCT_SET_ID'])
-
-    # Get the full path of the product.
-    product_path = client.product_path(
-        project=config['PROJECT_SET'], location='us_east1', product=product_id)
+    client = product_search_client()
 
     # Add the product to the product set.
     client.add_product_to_product_set(
-        name=product_set_path, product=product_path)
-
-def monuments_to_csv(monuments: Sequence[WikiMonument]) -> str:
-    """Reads the monuments into a CSV suitable for input and return it."""
-    data = []
+        name=product_set_path(), product=product_path(product_id))
+
+# Product Search rejects import files with more lines than this
+CSV_MAX_ROWS = 20000
+
+CONTENT_URI = re.compile(r"/sha256/([0-9a-f]{64})\.")
+
+
+def reference_image_id(uri: str, content_hash: Optional[str] = None) -> str:
+    """The ID a reference image gets in the product set: the content hash for
+    content-addressed blobs (see `mirror.content_blob_name`), so the same image
+    gets the same ID wherever it's used, and otherwise a hash of the URI and of
+    the blob's `content_hash` if known (see `blob_content_hashes`), so an image
+    replaced at the same URI gets a new ID."""
+    match = CONTENT_URI.search(uri)
+    if match:
+        return match.group(1)
+    return hashlib.sha256((uri + (content_hash or "")).encode()).hexdigest()
+
+
+def blob_content_hashes(uris: Iterable[str]) -> Dict[str, str]:
+    """The hashes Cloud Storage keeps of the contents of the blobs at the
+    `gs://` URIs (MD5, or CRC32C for composite blobs), in hex by URI. Each
+    bucket is listed once rather than every blob looked up; blobs that don't
+    exist are left out."""
+    wanted: Dict[str, Set[str]] = {}
+    for uri in uris:
+        bucket, _, name = uri[len("gs://") :].partition("/")
+        wanted.setdefault(bucket, set()).add(name)
+
+    hashes = {}
+    for bucket, names in wanted.items():
+        for blob in storage_client().list_blobs(bucket):
+            digest = blob.md5_hash or blob.crc32c
+            if blob.name in names and digest:
+                hashes[f"gs://{bucket}/{blob.name}"] = base64.b64decode(digest).hex()
+        metrics.count("requests", stage="list_blobs")
+    return hashes
+
+
+def product_labels(mon: WikiMonument) -> str:
+    """The labels column for the monument: its geohash cells, see `geocell.geo_filter`."""
+    return ",".join(f"{k}={v}" for k, v in cell_labels(mon.coord).items())
+
+
+def csv_row(
+    uri: str,
+    product_id: str,
+    display_name: str,
+    labels: str,
+    image_id: Optional[str] = None,
+) -> List[str]:
+    """One line of a Product Search import CSV."""
+    if not uri.startswith("gs"):
+        raise ValueError("Cannot import non-GC URL: ", uri)
+
+    return [
+        uri,  # image-uri
+        image_id or reference_image_id(uri),  # image-id
+        config["PRODUCT_SET_ID"],  # product-set-id,
+        product_id,  # product-id: slugified name
+        "general-v1",  # product-category
+        display_name,  # product-display-name
+        labels,  # labels
+        "",  # bounding poly: skip for now
+    ]
+
+
+def iter_csv_rows(monuments: Iterable[WikiMonument]) -> Iterator[List[str]]:
+    """The Product Search import CSV rows for the monuments, one per image."""
     for mon in monuments:
+        labels = product_labels(mon)
         for url in mon.image_urls:
-            if not url.startswith("gs"):
-                raise ValueError("Cannot import non-GC URL: ", url)
-
-            product_id = re.match(
-                f'gs://{config["IMAGE_BUCKET"]}' + r"/([^/ .]+)/\d+\.\w+", url
-            ).group(1)
-            data.append(
-                [
-                    url,  # image-uri
-                    "",  # image-id: skip
-                    config["PRODUCT_SET_ID"],  # product-set-id,
-                    product_id,  # product-id: slugified name
-                    "general-v1",  # product-category
-                    mon.name,  # product-display-name
-                    "",  # labels: skip for now
-                    "",  # bounding poly: skip for now
-                ]
-            )
+            yield csv_row(url, mon.slug, mon.name, labels)
 
-    # escape using quotes
-    return "\n".join([",".join(['"' + c + '"' for c in l]) for l in data])
 
+def _csv_writer(f):
+    # quote everything, as the import examples do; quotes inside names are doubled
+    return csv.writer(f, quoting=csv.QUOTE_ALL, lineterminator="\n")
 
-def import_product_sets(gcs_uri):
-    """Import images of different products in the product set.
-    Args:
-        gcs_uri: Google Cloud Storage URI.
-            Target files must be in Product Search CSV format.
-    """
-    client = vision.ProductSearchClient()
 
-    # A resource that represents Google Cloud Platform location.
-    location_path = f"projects/{config['PROJECT_ID']}/locations/us-east1"
+def monuments_to_csv(monuments: Iterable[WikiMonument]) -> str:
+    """Reads the monuments into a CSV suitable for input and return it."""
+    out = io.StringIO()
+    _csv_writer(out).writerows(iter_csv_rows(monuments))
+    return out.getvalue()
+
+
+def write_csv_rows(
+    rows: Iterable[List[str]],
+    max_rows: int = CSV_MAX_ROWS,
+    prefix: Optional[str] = None,
+) -> List[str]:
+    """Streams the CSV rows straight into the CSV bucket, in files of at most
+    `max_rows` rows, and returns their URIs. Rows are never all held in memory,
+    so this works for regions of any size.
+
+    Files are only cut between products, so that the imports of two files,
+    which may run at the same time, never write the same product: a product's
+    rows should come one after another, and one with more than `max_rows` of
+    them gets a file of its own."""
+    bucket = storage_client().bucket(config["CSV_BUCKET"])
+    prefix = prefix or uuid.uuid4().hex
+
+    uris = []
+    products = (list(group) for _, group in itertools.groupby(rows, lambda r: r[3]))
+    product = next(products, None)
+    while product is not None:
+        name = f"{prefix}/{len(uris):05d}.csv"
+        with metrics.timer("request_seconds", stage="csv"):
+            with bucket.blob(name).open("w", content_type="text/csv") as f:
+                writer = _csv_writer(f)
+                count = 0
+                while product is not None and (
+                    count == 0 or count + len(product) <= max_rows
+                ):
+                    writer.writerows(product)
+                    count += len(product)
+                    product = next(products, None)
+        metrics.count("requests", stage="csv")
+        uris.append(f'gs://{config["CSV_BUCKET"]}/{name}')
+
+    return uris
+
+
+def write_csv_shards(
+    monuments: Iterable[WikiMonument],
+    max_rows: int = CSV_MAX_ROWS,
+    prefix: Optional[str] = None,
+) -> List[str]:
+    """Streams the import CSV for the monuments into the CSV bucket, see
+    `write_csv_rows`."""
+    return write_csv_rows(iter_csv_rows(monuments), max_rows, prefix)
+
+
+def start_import(gcs_uri: str):
+    """Starts importing the Product Search CSV at the URI, returning the
+    long-running operation without waiting on it."""
+    from google.cloud import vision
+
+    client = product_search_client()
 
     # Set the input configuration along with Google Cloud Storage URI
     gcs_source = vision.ImportProductSetsGcsSource(csv_file_uri=gcs_uri)
     input_config = vision.ImportProductSetsInputConfig(gcs_source=gcs_source)
 
     # Import the product sets from the input URI.
-    response = client.import_product_sets(
-        parent=location_path, input_config=input_config
-    )
+    return client.import_product_sets(parent=location_path(), input_config=input_config)
 
-    print("Processing operation name: {}".format(response.operation.name))
-    # synchronous check of operation status
-    result = response.result()
-    print("Processing done.")
 
+def report_import_result(result, uri=None):
+    """Counts and logs the outcome of each line of a finished import of the CSV
+    at `uri`."""
     for i, status in enumerate(result.statuses):
-        print("Status of processing line {} of the csv: {}".format(i, status))
         # Check the status of reference image
         # `0` is the code for OK in google.rpc.Code.
-        if status.code == 0:
-            reference_image = result.reference_images[i]
-            print(reference_image)
+        ok = status.code == 0
+        metrics.count("rows", stage="import", ok=ok)
+        if ok:
+            metrics.event(
+                "import_line", uri=uri, line=i, reference_image=result.reference_images[i]
+            )
         else:
-            print("Status code not OK: {}".format(status.message))
+            metrics.event(
+                "import_line_failed",
+                uri=uri,
+                line=i,
+                code=status.code,
+                message=status.message,
+            )
+
 
+def import_product_sets(gcs_uri):
+    """Import images of different products in the product set.
+    Args:
+        gcs_uri: Google Cloud Storage URI.
+            Target files must be in Product Search CSV format.
+    """
+    with metrics.timer("stage_seconds", stage="import"):
+        response = start_import(gcs_uri)
+        metrics.event("import_started", uri=gcs_uri, operation=response.operation.name)
+        # synchronous check of operation status
+        result = response.result()
+    metrics.event("import_done", uri=gcs_uri, operation=response.operation.name)
 
-def upload_product_set(monuments: Sequence[WikiMonument]):
-    """Uploads the Monuments as a product set."""
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(config["CSV_BUCKET"])
-    csv = monuments_to_csv(monuments)
+    report_import_result(result, gcs_uri)
 
-    csv_id = hashlib.sha256(csv.encode()).hexdigest()
-    blob = bucket.blob(csv_id + ".csv")
 
-    blob.upload_from_string(csv)
+def wait_for_imports(operations: Sequence[Any], poll: float = 5.0) -> List[Any]:
+    """Polls the import operations together until all are done, returning their
+    results in order. Raises the first operation's error once all have ended."""
+    pending = set(range(len(operations)))
+    while pending:
+        pending = {i for i in pending if not operations[i].done()}
+        if pending:
+            time.sleep(poll)
 
-    uri = f'gs://{config["CSV_BUCKET"]}/{csv_id}.csv'
-    import_product_sets(uri)
+    return [op.result() for op in operations]
+
+
+def upload_product_set(
+    monuments: Iterable[WikiMonument], max_rows: int = CSV_MAX_ROWS, poll: float = 5.0
+):
+    """Uploads the Monuments as a product set: the CSV is written in shards of
+    `max_rows` rows, and the shards are imported concurrently."""
+    with metrics.timer("stage_seconds", stage="csv"):
+        uris = write_csv_shards(monuments, max_rows)
+
+    with metrics.timer("stage_seconds", stage="import"):
+        operations = [start_import(uri) for uri in uris]
+        for uri, op in zip(uris, operations):
+            metrics.event("import_started", uri=uri, operation=op.operation.name)
+
+        results = wait_for_imports(operations, poll)
+    metrics.event("import_done", uris=uris)
+
+    for uri, result in zip(uris, results):
+        report_import_result(result, uri)
+
+
+def decode_base64_image(b64: str) -> bytes:
+    """The image bytes of a base64 string, with or without a `data:` URL prefix."""
+    return base64.b64decode(b64.split("base64,")[-1])
+
+
+def _image_context(filter):
+    """The image context that points product search at our product set."""
+    from google.cloud import vision
+
+    # product search specific parameters
+    product_search_params = vision.ProductSearchParams(
+        product_set=product_set_path(),
+        product_categories=['general-v1'],
+        filter=filter,
+    )
+    return vision.ImageContext(product_search_params=product_search_params)
+
+
+def _product_search(content: bytes, filter, max_results):
+    """Runs product search on the image and returns the `product_search_results`."""
+    from google.cloud import vision
+
+    # Create annotate image request along with product search feature.
+    image = vision.Image(content=content)
+
+    # Search products similar to the image.
+    with metrics.timer("request_seconds", service="product_search"):
+        response = image_annotator_client().product_search(
+            image, image_context=_image_context(filter), max_results=max_results
+        )
+    metrics.count("requests", service="product_search")
+    metrics.count("bytes", len(content), service="product_search")
+    return response.product_search_results
 
 
 def get_similar_products_file(
     b64,
     filter,
     max_results,
+    cache: Optional[SearchCache] = None,
+    preprocess: bool = True,
+    gps_radius: Optional[float] = None,
 ):
     """Search similar products to image.
     Args:
-        project_id: Id of the project.
-        location: A compute region name.
-        product_set_id: Id of the product set.
-        product_category: Category of the product.
-        file_path: Local file path of the image to be searched.
+        b64: The image to be searched, in base64 (optionally as a data URL).
         filter: Condition to be applied on the labels.
                 Example for filter: (color = red OR color = blue) AND style = kids
                 It will search on all products with the following labels:
                 color:red AND style:kids
                 color:blue AND style:kids
+                Use geocell.geo_filter(coord, radius) to only search near a point.
         max_results: The maximum number of results (matches) to return. If omitted, all results are returned.
+        cache: If given, a near-identical image searched with the same filter and
+               max_results returns the cached results without calling the API.
+        preprocess: Whether to shrink the image before sending it (see
+                    `preprocess.prepare_image`). Images that can't be decoded
+                    are sent as they are.
+        gps_radius: If given and the image has a GPS position in its EXIF data,
+                    only products within this many meters of it are searched.
     """
-    # product_search_client is needed only for its helper methods.
-    product_search_client = vision.ProductSearchClient()
-    image_annotator_client = vision.ImageAnnotatorClient()
-
     # Read the image as a stream of bytes.
-    content = base64.b64encode(b64.split['base64,'][1])
+    content = decode_base64_image(b64)
+
+    if preprocess:
+        from .preprocess import DECODE_ERRORS, prepare_image
+
+        try:
+            prepared = prepare_image(content)
+        except DECODE_ERRORS:
+            # not an image we can decode; let the API have a go at it as it is
+            prepared = None
+        if prepared is not None:
+            content = prepared.data
+            if gps_radius is not None and prepared.gps is not None:
+                near = geo_filter(prepared.gps, gps_radius)
+                filter = f"({near}) AND ({filter})" if filter else near
+
+    h = None
+    if cache is not None:
+        from .imagehash import phash
+        from .preprocess import DECODE_ERRORS
+
+        try:
+            h = phash(content)
+        except DECODE_ERRORS:
+            # not an image we can decode; let the API have a go at it
+            pass
+        else:
+            results = cache.get(h, filter, max_results)
+            if results is not None:
+                metrics.count("cache_hits", service="product_search")
+                return results
+
+    search_results = _product_search(content, filter, max_results)
+
+    index_time = search_results.index_time
+    results = search_results.results
+
+    if metrics.enabled():
+        metrics.event(
+            "search_results",
+            index_time=index_time,
+            results=[
+                {
+                    "score": result.score,
+                    "image": result.image,
+                    "product": result.product.name,
+                    "display_name": result.product.display_name,
+                    "labels": {kv.key: kv.value for kv in result.product.product_labels},
+                }
+                for result in results
+            ],
+        )
+
+    if h is not None:
+        cache.put(h, filter, max_results, results, index_time)
+    return results
 
-    # Create annotate image request along with product search feature.
-    image = vision.Image(content=content)
 
-    # product search specific parameters
-    product_set_path = product_search_client.product_set_path(
-        project='loca-346705', location='us-east-1', product_set=config['PRODUCT_SET_ID']
-    )
-    product_search_params = vision.ProductSearchParams(
-        product_set=product_set_path,
-        product_categories=['general-v1'],
-        filter=filter,
-    )
-    image_context = vision.ImageContext(product_search_params=product_search_params)
+# the most images batch_annotate_images takes in one request
+BATCH_SIZE = 16
 
-    # Search products similar to the image.
-    response = image_annotator_client.product_search(
-        image, image_context=image_context, max_results=max_results
-    )
 
-    index_time = response.product_search_results.index_time
-    print("Product set index time: ", end="")
-    print(index_time)
+class SearchOutcome(NamedTuple):
+    """The product search results for one image of a batch, or why there are none."""
 
-    results = response.product_search_results.results
+    index: int
+    results: Optional[Sequence]
+    index_time: Any
+    error: Optional[str]
 
-    print("Search results:")
-    for result in results:
-        product = result.product
+    @property
+    def ok(self) -> bool:
+        return self.error is None
 
-        print("Score(Confidence): {}".format(result.score))
-        print("Image name: {}".format(result.image))
 
-        print("Product name: {}".format(product.name))
-        print("Product display name: {}".format(product.display_name))
-        print("Product description: {}\n".format(product.description))
-        print("Product labels: {}\n".format(product.product_labels))
+def batch_search_products(
+    images: Sequence[bytes],
+    filter=None,
+    max_results: int = 10,
+    batch_size: int = BATCH_SIZE,
+    max_in_flight: int = 4,
+    preprocess: bool = True,
+) -> List[SearchOutcome]:
+    """Searches for products similar to each image, returning one outcome per image
+    in input order.
 
-    return results
+    Images are sent `batch_size` at a time with `batch_annotate_images`, with up to
+    `max_in_flight` batches running at once. A failure only affects its own image:
+    an image that can't be decoded is never sent, and if a whole batch is rejected
+    its images are retried one by one."""
+    from google.cloud import vision
+
+    feature = vision.Feature(
+        type_=vision.Feature.Type.PRODUCT_SEARCH, max_results=max_results
+    )
+    image_context = _image_context(filter)
+
+    def prepare(batch) -> Tuple[list, List[SearchOutcome]]:
+        """Builds the requests for a batch, and outcomes for images that can't be sent."""
+        requests, failed = [], []
+        for i, content in batch:
+            if preprocess:
+                from .preprocess import DECODE_ERRORS, prepare_image
+
+                try:
+                    content = prepare_image(content).data
+                except DECODE_ERRORS as e:
+                    error = f"unreadable image: {e}"
+                    failed.append(SearchOutcome(i, None, None, error))
+                    continue
+
+            request = vision.AnnotateImageRequest(
+                image=vision.Image(content=content),
+                features=[feature],
+                image_context=image_context,
+            )
+            requests.append((i, request))
+        return requests, failed
+
+    def annotate(requests) -> List[SearchOutcome]:
+        try:
+            with metrics.timer("request_seconds", service="batch_annotate"):
+                response = image_annotator_client().batch_annotate_images(
+                    requests=[request for _, request in requests]
+                )
+            metrics.count("requests", service="batch_annotate")
+        except Exception as e:
+            if len(requests) == 1:
+                return [SearchOutcome(requests[0][0], None, None, str(e))]
+            return [outcome for one in requests for outcome in annotate([one])]
+
+        outcomes = []
+        for (i, _), res in zip(requests, response.responses):
+            if res.error.code != 0:
+                outcomes.append(SearchOutcome(i, None, None, res.error.message))
+            else:
+                search_results = res.product_search_results
+                outcomes.append(
+                    SearchOutcome(
+                        i, search_results.results, search_results.index_time, None
+                    )
+                )
+        return outcomes
+
+    def search(batch) -> List[SearchOutcome]:
+        # preprocessing happens here too, since PIL releases the GIL while it works
+        requests, failed = prepare(batch)
+        return failed + (annotate(requests) if requests else [])
+
+    indexed = list(enumerate(images))
+    batches = [indexed[i : i + batch_size] for i in range(0, len(indexed), batch_size)]
+
+    outcomes: List[Optional[SearchOutcome]] = [None] * len(images)
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+        for batch_outcomes in pool.map(search, batches):
+            for outcome in batch_outcomes:
+                outcomes[outcome.index] = outcome
+
+    return outcomes
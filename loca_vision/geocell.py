@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""Geohash cells as product labels, so searches can be restricted by location.
+
+Every product is labeled with the geohash of its monument at a few precisions
+(`geo3=dr7`, `geo4=dr7k`, ...). A query near a point then filters on the handful
+of cells around it at the finest precision that keeps the filter short, and
+Product Search only considers the products in those cells."""
+
+from __future__ import annotations
+
+import math
+from typing import Dict, List, Sequence, Tuple
+
+from .coord import EARTH_RADIUS, Coord
+
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+# precisions written as labels: cells of roughly 156, 39 and 4.9 km
+PRECISIONS = (3, 4, 5)
+
+
+def encode(coord: Coord, precision: int) -> str:
+    """The geohash of the point, `precision` characters long."""
+    lat, lon = (-90.0, 90.0), (-180.0, 180.0)
+    chars = []
+    bits = 0
+    n = 0
+    even = True
+    while len(chars) < precision:
+        if even:
+            mid = (lon[0] + lon[1]) / 2
+            bit = coord.lon >= mid
+            lon = (mid, lon[1]) if bit else (lon[0], mid)
+        else:
+            mid = (lat[0] + lat[1]) / 2
+            bit = coord.lat >= mid
+            lat = (mid, lat[1]) if bit else (lat[0], mid)
+        bits = (bits << 1) | bit
+        n += 1
+        even = not even
+        if n == 5:
+            chars.append(BASE32[bits])
+            bits = n = 0
+
+    return "".join(chars)
+
+
+def bounds(cell: str) -> Tuple[Coord, Coord]:
+    """The south-west and north-east corners of the cell."""
+    lat, lon = [-90.0, 90.0], [-180.0, 180.0]
+    even = True
+    for char in cell:
+        value = BASE32.index(char)
+        for shift in range(4, -1, -1):
+            interval = lon if even else lat
+            mid = (interval[0] + interval[1]) / 2
+            interval[(value >> shift) & 1 == 0] = mid
+            even = not even
+
+    return Coord(lat[0], lon[0]), Coord(lat[1], lon[1])
+
+
+def cell_size(precision: int) -> Tuple[float, float]:
+    """Height and width of cells at the precision, in degrees."""
+    bits = 5 * precision
+    return 180 / 2 ** (bits // 2), 360 / 2 ** ((bits + 1) // 2)
+
+
+def cell_labels(coord: Coord, precisions: Sequence[int] = PRECISIONS) -> Dict[str, str]:
+    """The labels for a product at the point, e.g. `{"geo3": "dr7", ...}`."""
+    return {f"geo{p}": encode(coord, p) for p in precisions}
+
+
+def _distance(a: Coord, b: Coord) -> float:
+    p1, p2 = math.radians(a.lat), math.radians(b.lat)
+    dlat, dlon = p2 - p1, math.radians(b.lon - a.lon)
+    h = math.sin(dlat / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(h)))
+
+
+def covering_cells(coord: Coord, radius: float, precision: int) -> List[str]:
+    """The cells at the precision that overlap the circle of `radius` meters."""
+    height, width = cell_size(precision)
+    dlat = math.degrees(radius / EARTH_RADIUS)
+    cos = math.cos(math.radians(min(89.9, abs(coord.lat) + dlat)))
+    dlon = min(180.0, dlat / cos)
+
+    # sample the circle's bounding box more finely than the cells, so every cell
+    # it touches gets hit at least once
+    steps_lat = max(2, math.ceil(2 * dlat / height) + 1)
+    steps_lon = max(2, math.ceil(2 * dlon / width) + 1)
+    lats = [
+        max(-90.0, min(90.0, coord.lat - dlat + 2 * dlat * i / (steps_lat - 1)))
+        for i in range(steps_lat)
+    ]
+    lons = [
+        (coord.lon - dlon + 2 * dlon * j / (steps_lon - 1) + 180) % 360 - 180
+        for j in range(steps_lon)
+    ]
+    cells = {encode(Coord(lat, lon), precision) for lat in lats for lon in lons}
+
+    def overlaps(cell: str) -> bool:
+        sw, ne = bounds(cell)
+        nearest = Coord(
+            min(max(coord.lat, sw.lat), ne.lat), min(max(coord.lon, sw.lon), ne.lon)
+        )
+        return _distance(coord, nearest) <= radius
+
+    return sorted(cell for cell in cells if overlaps(cell))
+
+
+def geo_filter(
+    coord: Coord,
+    radius: float,
+    precisions: Sequence[int] = PRECISIONS,
+    max_cells: int = 9,
+) -> str:
+    """A Product Search `filter` matching the products labeled with cells within
+    `radius` meters of the point, like `geo5 = dr7kz OR geo5 = dr7ky`.
+
+    Uses the finest labeled precision that needs at most `max_cells` cells, so the
+    filter stays short while excluding as much as possible."""
+    for p in sorted(precisions, reverse=True):
+        cells = covering_cells(coord, radius, p)
+        if len(cells) <= max_cells or p == min(precisions):
+            return " OR ".join(f"geo{p} = {cell}" for cell in cells)
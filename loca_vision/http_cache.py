@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""A persistent cache of MediaWiki API responses.
+
+Responses are keyed on the full, normalized query parameters and stored in
+SQLite, expire after a TTL, and are evicted least recently used first once the
+cache grows past `max_bytes`. In offline mode a miss is an error instead of a
+request, which makes recorded crawls usable as fixtures."""
+
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    body TEXT NOT NULL,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used);
+"""
+
+
+class OfflineCacheMiss(LookupError):
+    """Raised in offline mode when a request isn't in the cache."""
+
+
+def cache_key(params: dict) -> str:
+    """A canonical form of the request parameters: sorted, with every value as the
+    string that would be sent."""
+    return json.dumps(
+        {str(k): str(v) for k, v in params.items()},
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+
+
+class ResponseCache:
+    """SQLite-backed store of decoded JSON responses. Safe to share between threads.
+
+    `ttl` is in seconds, and `None` keeps responses forever."""
+
+    def __init__(
+        self,
+        path: str,
+        ttl: Optional[float] = 7 * 24 * 3600,
+        max_bytes: int = 256 << 20,
+        offline: bool = False,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        (self._size,) = self._db.execute(
+            "SELECT COALESCE(SUM(LENGTH(body)), 0) FROM responses"
+        ).fetchone()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get(self, params: dict) -> Optional[dict]:
+        """The cached response to the request, if there is a fresh one."""
+        key = cache_key(params)
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT body, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and (self.ttl is None or now - row[1] <= self.ttl):
+                with self._db:
+                    self._db.execute(
+                        "UPDATE responses SET last_used = ? WHERE key = ?", (now, key)
+                    )
+                self.hits += 1
+                return json.loads(row[0])
+
+            self.misses += 1
+
+        if self.offline:
+            raise OfflineCacheMiss(key)
+        return None
+
+    def put(self, params: dict, response: dict):
+        key = cache_key(params)
+        body = json.dumps(response, separators=(",", ":"))
+        now = time.time()
+        with self._lock, self._db:
+            old = self._db.execute(
+                "SELECT LENGTH(body) FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, body, now, now),
+            )
+            self._size += len(body) - (old[0] if old else 0)
+            self._evict()
+
+    def _evict(self):
+        """Drops least recently used responses until the cache fits. Needs the lock."""
+        while self._size > self.max_bytes:
+            rows = self._db.execute(
+                "SELECT key, LENGTH(body) FROM responses ORDER BY last_used LIMIT 64"
+            ).fetchall()
+            if not rows:
+                self._size = 0
+                return
+
+            evicted = []
+            for key, size in rows:
+                if self._size <= self.max_bytes:
+                    break
+                self._size -= size
+                evicted.append((key,))
+            self._db.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def clear(self):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM responses")
+            self._size = 0
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self) -> ResponseCache:
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""Rate limits and retries shared by all outbound HTTP requests.
+
+Every request goes through a `Scheduler`, which keeps a token bucket per host,
+so concurrent crawls and image fetches together stay within what each host
+allows. A request that fails in a way worth retrying (a connection error or
+timeout, a 429 or 5xx, or a MediaWiki `maxlag` error) is retried with
+exponential backoff and full jitter. When the server says how long to wait,
+with `Retry-After` (which MediaWiki also sends with `maxlag` errors), the whole
+host is paused for that long, not just the one request, since every other
+request to it would be turned away too.
+
+The scheduler's state is guarded by locks, and `reserve` never blocks, so it
+can be shared by threads and asyncio tasks alike (see `Scheduler.wait`)."""
+
+from __future__ import annotations
+
+import asyncio
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import requests
+
+from . import metrics
+from .ratelimit import RateLimiter
+
+# requests per second and burst, by host; hosts not listed aren't limited
+HOST_RATES: Dict[str, Tuple[float, int]] = {
+    "en.wikipedia.org": (10, 4),
+    "upload.wikimedia.org": (20, 8),
+}
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+# how long to pause a host on a maxlag error that doesn't say
+MAXLAG_PAUSE = 5.0
+
+
+class RetriesExhausted(requests.RequestException):
+    """The request still failed after every retry; `response` is the last one."""
+
+
+def retry_after(response: requests.Response) -> Optional[float]:
+    """The seconds to wait that the response's `Retry-After` header asks for."""
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_maxlag(response: requests.Response) -> bool:
+    """Whether MediaWiki refused the request because its replicas are lagging.
+    That comes as a normal 200 response, but flagged in a header."""
+    return response.headers.get("MediaWiki-API-Error") == "maxlag"
+
+
+class Scheduler:
+    """Per-host token buckets plus retries with backoff.
+
+    `rates` maps hosts to `(rate, burst)` and defaults to `HOST_RATES`. Failed
+    requests are retried up to `retries` times, the `n`th retry after a random
+    delay of up to `backoff * 2**n` seconds (capped at `max_backoff`)."""
+
+    def __init__(
+        self,
+        rates: Optional[Dict[str, Tuple[float, int]]] = None,
+        retries: int = 5,
+        backoff: float = 0.5,
+        max_backoff: float = 60.0,
+    ):
+        self.rates = dict(HOST_RATES if rates is None else rates)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._limiters: Dict[str, Optional[RateLimiter]] = {}
+        self._paused_until: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def _limiter(self, host: str) -> Optional[RateLimiter]:
+        with self._lock:
+            if host not in self._limiters:
+                rate = self.rates.get(host)
+                self._limiters[host] = RateLimiter(*rate) if rate else None
+            return self._limiters[host]
+
+    def reserve(self, url: str) -> float:
+        """Takes a slot for a request to the URL's host, and returns how many
+        seconds the caller must wait before sending it. Never blocks."""
+        host = urlsplit(url).hostname or ""
+        limiter = self._limiter(host)
+        wait = limiter.reserve() if limiter is not None else 0.0
+        with self._lock:
+            paused = self._paused_until.get(host, 0.0) - time.monotonic()
+        return max(wait, paused)
+
+    def acquire(self, url: str):
+        """Blocks until a request to the URL's host may be sent."""
+        wait = self.reserve(url)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def wait(self, url: str):
+        """Like `acquire`, for asyncio code."""
+        wait = self.reserve(url)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def pause(self, url: str, seconds: float):
+        """Holds back every request to the URL's host for `seconds`."""
+        host = urlsplit(url).hostname or ""
+        with self._lock:
+            until = time.monotonic() + seconds
+            self._paused_until[host] = max(self._paused_until.get(host, 0.0), until)
+
+    def delay(self, attempt: int) -> float:
+        """The backoff before retry number `attempt` (from 0), with full jitter."""
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        session: Optional[requests.Session] = None,
+        limiter: Optional[RateLimiter] = None,
+        **kwargs,
+    ) -> requests.Response:
+        """Sends the request when the host's rate allows (and `limiter` too, if
+        given), retrying as described above. Returns the response, which may
+        still be an error the caller should check; raises `RetriesExhausted` if
+        the last attempt was still one worth retrying."""
+        send = (session or requests).request
+        host = urlsplit(url).hostname or ""
+        for attempt in range(self.retries + 1):
+            if limiter is not None:
+                limiter.acquire()
+            self.acquire(url)
+
+            try:
+                response = send(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.retries:
+                    raise
+                metrics.count("retries", host=host, reason=type(e).__name__)
+                time.sleep(self.delay(attempt))
+                continue
+
+            maxlag = is_maxlag(response)
+            if not maxlag and response.status_code not in RETRY_STATUSES:
+                return response
+
+            reason = "maxlag" if maxlag else str(response.status_code)
+            if attempt == self.retries:
+                raise RetriesExhausted(
+                    f"{reason} after {attempt + 1} attempts: {url}", response=response
+                )
+            metrics.count("retries", host=host, reason=reason)
+            # hands the connection back, in case the body was being streamed
+            response.close()
+
+            wait = retry_after(response)
+            if wait is None and maxlag:
+                wait = MAXLAG_PAUSE
+            if wait is not None:
+                # the server knows best; everyone waits, with a little jitter so
+                # they don't all come back at once
+                self.pause(url, wait)
+                time.sleep(wait + random.uniform(0, self.backoff))
+            else:
+                time.sleep(self.delay(attempt))
+
+        raise AssertionError("unreachable")
+
+
+_scheduler = Scheduler()
+
+
+def get_scheduler() -> Scheduler:
+    """The scheduler that `wiki_parser` and `mirror` send their requests through."""
+    return _scheduler
+
+
+def set_scheduler(scheduler: Scheduler):
+    """Replaces the shared scheduler, e.g. to change the host rates."""
+    global _scheduler
+    _scheduler = scheduler
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""A persistent, content-addressed cache of mirrored images.
+
+The index maps each source URL to the SHA-256 of its bytes, and each hash to the
+Cloud Storage URI it was uploaded to, so an image that has been mirrored before
+never touches the network again, and identical images from different URLs
+share one blob. The bytes themselves are kept in a local object store bounded
+by `max_bytes`, evicting the least recently used objects first."""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import BinaryIO, Iterable, Optional
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (url TEXT PRIMARY KEY, sha256 TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS blobs (
+    sha256 TEXT NOT NULL, bucket TEXT NOT NULL, uri TEXT NOT NULL,
+    PRIMARY KEY (sha256, bucket)
+);
+CREATE TABLE IF NOT EXISTS objects (
+    sha256 TEXT PRIMARY KEY, size INTEGER NOT NULL, last_used REAL NOT NULL
+);
+"""
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class ImageCache:
+    """On-disk index and object store for mirrored images. Safe to share between
+    threads."""
+
+    def __init__(self, path: str, max_bytes: int = 1 << 30):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(path, "objects"), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            os.path.join(path, "index.sqlite3"), check_same_thread=False
+        )
+        self._db.executescript(SCHEMA)
+        (self._size,) = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM objects"
+        ).fetchone()
+
+    def _object_path(self, sha: str) -> str:
+        return os.path.join(self.path, "objects", sha[:2], sha)
+
+    def digest_for(self, url: str) -> Optional[str]:
+        """The content hash of the image at `url`, if it has been downloaded before."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT sha256 FROM sources WHERE url = ?", (url,)
+            ).fetchone()
+        return row and row[0]
+
+    def uri_for(self, sha: str, bucket: str) -> Optional[str]:
+        """The URI of the blob in `bucket` holding the content, if it was uploaded."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT uri FROM blobs WHERE sha256 = ? AND bucket = ?", (sha, bucket)
+            ).fetchone()
+        return row and row[0]
+
+    def lookup(self, url: str, bucket: str) -> Optional[str]:
+        """The URI in `bucket` the image at `url` was mirrored to, if any."""
+        sha = self.digest_for(url)
+        return sha and self.uri_for(sha, bucket)
+
+    def record_source(self, url: str, sha: str):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO sources VALUES (?, ?)", (url, sha)
+            )
+
+    def record_blob(self, sha: str, bucket: str, uri: str):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO blobs VALUES (?, ?, ?)", (sha, bucket, uri)
+            )
+
+    def open(self, sha: str) -> Optional[BinaryIO]:
+        """The stored object for the content hash, opened for reading, if it
+        hasn't been evicted."""
+        try:
+            f = open(self._object_path(sha), "rb")
+        except FileNotFoundError:
+            return None
+
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE objects SET last_used = ? WHERE sha256 = ?", (time.time(), sha)
+            )
+        return f
+
+    def get_bytes(self, sha: str) -> Optional[bytes]:
+        """The stored bytes for the content hash, if they haven't been evicted."""
+        f = self.open(sha)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def put_bytes(self, data: bytes) -> str:
+        """Stores the bytes, evicting old objects if needed, and returns their hash."""
+        return self.put_chunks([data])
+
+    def put_chunks(self, chunks: Iterable[bytes]) -> str:
+        """Stores the bytes that the chunks add up to, hashing them on the way to
+        disk, so no more than a chunk is ever held in memory. Returns their hash.
+        Objects larger than the whole store aren't kept."""
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp = tempfile.mkstemp(
+            suffix=".tmp", dir=os.path.join(self.path, "objects")
+        )
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            sha = digest.hexdigest()
+            if size <= self.max_bytes:
+                self._add(sha, tmp, size)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return sha
+
+    def _add(self, sha: str, tmp: str, size: int):
+        """Moves the temporary file into the store as the object for `sha`."""
+        path = self._object_path(sha)
+        with self._lock:
+            if os.path.exists(path):
+                return
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp, path)
+
+            with self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO objects VALUES (?, ?, ?)",
+                    (sha, size, time.time()),
+                )
+            self._size += size
+            self._evict()
+
+    def _evict(self):
+        """Drops least recently used objects until the store fits. Needs the lock."""
+        if self._size <= self.max_bytes:
+            return
+
+        rows = self._db.execute(
+            "SELECT sha256, size FROM objects ORDER BY last_used"
+        ).fetchall()
+        evicted = []
+        for sha, size in rows:
+            if self._size <= self.max_bytes:
+                break
+            try:
+                os.remove(self._object_path(sha))
+            except FileNotFoundError:
+                pass
+            self._size -= size
+            evicted.append((sha,))
+
+        with self._db:
+            self._db.executemany("DELETE FROM objects WHERE sha256 = ?", evicted)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self) -> ImageCache:
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""Perceptual hashes of images, for spotting near-duplicates.
+
+Two photos of the same thing that differ only by scale, compression or small
+edits get hashes a few bits apart, so the Hamming distance between hashes is a
+cheap similarity measure. All hashes here are 64-bit ints."""
+
+from __future__ import annotations
+
+import io
+import math
+from functools import lru_cache
+from typing import Union
+
+import numpy as np
+from PIL import Image
+
+HASH_BITS = 64
+
+
+def open_image(data: Union[bytes, Image.Image], size: int = 64) -> Image.Image:
+    """Decodes the image, letting JPEGs decode straight to roughly `size` pixels
+    (which is many times faster than decoding at full resolution)."""
+    if isinstance(data, Image.Image):
+        return data
+
+    image = Image.open(io.BytesIO(data))
+    image.draft("L", (size, size))
+    return image
+
+
+def _gray(image: Image.Image, width: int, height: int) -> np.ndarray:
+    image = image.convert("L").resize((width, height), Image.Resampling.LANCZOS)
+    return np.asarray(image, dtype=np.float64)
+
+
+def _bits_to_int(bits: np.ndarray) -> int:
+    return int("".join("1" if b else "0" for b in bits.ravel()), 2)
+
+
+@lru_cache(maxsize=None)
+def _dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n)
+    m = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n))
+    m[0] /= math.sqrt(2)
+    return m * math.sqrt(2 / n)
+
+
+def phash(data: Union[bytes, Image.Image]) -> int:
+    """The DCT hash: which of the 8x8 lowest frequencies of the 32x32 grayscale
+    image are above their median."""
+    pixels = _gray(open_image(data, 32), 32, 32)
+    m = _dct_matrix(32)
+    low = (m @ pixels @ m.T)[:8, :8].ravel()
+    return _bits_to_int(low > np.median(low[1:]))
+
+
+def dhash(data: Union[bytes, Image.Image]) -> int:
+    """The difference hash: whether each pixel of the 9x8 grayscale image is
+    brighter than its right neighbor."""
+    pixels = _gray(open_image(data, 9), 9, 8)
+    return _bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+def hamming(a: int, b: int) -> int:
+    """The number of bits that differ between two hashes."""
+    return bin(a ^ b).count("1")
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""Counters, latency histograms and events, for seeing where a run spends its
+time.
+
+The library reports what it does through the functions here: `count` for
+things like requests and bytes, `observe` (or the `timer` context manager) for
+latencies, and `event` for what used to be printed, such as failed images or
+import statuses. Labels say which stage or service a measurement belongs to,
+e.g. `count("bytes", n, stage="download")`.
+
+Nothing is recorded until a sink is added with `add_sink`; until then every call
+returns straight away. The sinks are:
+
+- `MemorySink`, which keeps everything for inspection (tests, benchmarks),
+- `JsonLinesSink`, which writes one JSON object per measurement or event,
+- `PrometheusSink`, which aggregates into the Prometheus text format,
+- `LoggingSink`, which logs events, e.g. to get the old console output back."""
+
+from __future__ import annotations
+
+import bisect
+import json
+import logging
+import threading
+import time
+from typing import IO, Any, Dict, List, Optional, Sequence, Tuple, Union
+
+Labels = Tuple[Tuple[str, str], ...]
+
+# the active sinks; replaced rather than mutated, so it can be read without a lock
+_sinks: Tuple[Sink, ...] = ()
+_lock = threading.Lock()
+
+
+def _labels(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Sink:
+    """Receives every measurement and event. The methods do nothing by default,
+    so a sink only overrides what it cares about."""
+
+    def counter(self, name: str, value: float, labels: Labels):
+        pass
+
+    def histogram(self, name: str, value: float, labels: Labels):
+        pass
+
+    def event(self, name: str, fields: Dict[str, Any]):
+        pass
+
+
+def add_sink(sink: Sink) -> Sink:
+    global _sinks
+    with _lock:
+        _sinks = _sinks + (sink,)
+    return sink
+
+
+def remove_sink(sink: Sink):
+    global _sinks
+    with _lock:
+        _sinks = tuple(s for s in _sinks if s is not sink)
+
+
+def clear_sinks():
+    global _sinks
+    with _lock:
+        _sinks = ()
+
+
+def enabled() -> bool:
+    """Whether anything is listening, for skipping work that only feeds metrics."""
+    return bool(_sinks)
+
+
+def count(name: str, value: float = 1, **labels):
+    """Adds `value` to the counter."""
+    sinks = _sinks
+    if not sinks:
+        return
+    key = _labels(labels)
+    for sink in sinks:
+        sink.counter(name, value, key)
+
+
+def observe(name: str, value: float, **labels):
+    """Records a sample (usually seconds) in the histogram."""
+    sinks = _sinks
+    if not sinks:
+        return
+    key = _labels(labels)
+    for sink in sinks:
+        sink.histogram(name, value, key)
+
+
+def event(name: str, **fields):
+    """Reports something that happened, with whatever details go with it."""
+    sinks = _sinks
+    if not sinks:
+        return
+    for sink in sinks:
+        sink.event(name, fields)
+
+
+class _Timer:
+    __slots__ = ("name", "labels", "start", "elapsed")
+
+    def __init__(self, name: str, labels: Dict[str, Any]):
+        self.name = name
+        self.labels = labels
+        self.elapsed = 0.0
+
+    def __enter__(self) -> _Timer:
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+        observe(self.name, self.elapsed, **self.labels)
+
+
+class _NullTimer:
+    __slots__ = ()
+    elapsed = 0.0
+
+    def __enter__(self) -> _NullTimer:
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timer(name: str = "seconds", **labels) -> Union[_Timer, _NullTimer]:
+    """A context manager that observes how long its body took, in seconds."""
+    if not _sinks:
+        return _NULL_TIMER
+    return _Timer(name, labels)
+
+
+class MemorySink(Sink):
+    """Keeps counter totals, every histogram sample and every event."""
+
+    def __init__(self):
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.histograms: Dict[Tuple[str, Labels], List[float]] = {}
+        self.events: List[Tuple[float, str, Dict[str, Any]]] = []
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, value: float, labels: Labels):
+        with self._lock:
+            key = (name, labels)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def histogram(self, name: str, value: float, labels: Labels):
+        with self._lock:
+            self.histograms.setdefault((name, labels), []).append(value)
+
+    def event(self, name: str, fields: Dict[str, Any]):
+        with self._lock:
+            self.events.append((time.time(), name, fields))
+
+    def total(self, name: str, **labels) -> float:
+        """The sum of the counter over every label set that includes `labels`."""
+        want = set(_labels(labels))
+        return sum(
+            v for (n, l), v in self.counters.items() if n == name and want <= set(l)
+        )
+
+    def samples(self, name: str, **labels) -> List[float]:
+        """The histogram's samples over every label set that includes `labels`."""
+        want = set(_labels(labels))
+        return [
+            x
+            for (n, l), xs in self.histograms.items()
+            if n == name and want <= set(l)
+            for x in xs
+        ]
+
+    def named(self, name: str) -> List[Dict[str, Any]]:
+        """The fields of every event with the name."""
+        return [fields for _, n, fields in self.events if n == name]
+
+
+class JsonLinesSink(Sink):
+    """Writes every measurement and event as a line of JSON to `out`, a path or
+    an open text file. Values that aren't JSON are written as strings."""
+
+    def __init__(self, out: Union[str, IO[str]]):
+        self._own = isinstance(out, str)
+        self._file = open(out, "a", encoding="utf-8") if self._own else out
+        self._lock = threading.Lock()
+
+    def _write(self, record: dict):
+        line = json.dumps(record, default=str, ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def _measurement(self, kind: str, name: str, value: float, labels: Labels):
+        self._write(
+            {
+                "ts": time.time(),
+                "type": kind,
+                "name": name,
+                "value": value,
+                "labels": dict(labels),
+            }
+        )
+
+    def counter(self, name: str, value: float, labels: Labels):
+        self._measurement("counter", name, value, labels)
+
+    def histogram(self, name: str, value: float, labels: Labels):
+        self._measurement("histogram", name, value, labels)
+
+    def event(self, name: str, fields: Dict[str, Any]):
+        self._write({"ts": time.time(), "type": "event", "name": name, **fields})
+
+    def close(self):
+        if self._own:
+            self._file.close()
+
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class PrometheusSink(Sink):
+    """Aggregates counters and histograms for the Prometheus text exposition
+    format, with every metric name prefixed by `prefix`. Events are counted by
+    name as `<prefix>events_total`."""
+
+    def __init__(self, prefix: str = "loca_", buckets: Sequence[float] = BUCKETS):
+        self.prefix = prefix
+        self.buckets = tuple(sorted(buckets))
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        # per label set: count per bucket (plus +Inf), sum
+        self._histograms: Dict[str, Dict[Labels, Tuple[List[int], List[float]]]] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, value: float, labels: Labels):
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[labels] = series.get(labels, 0) + value
+
+    def histogram(self, name: str, value: float, labels: Labels):
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            if labels not in series:
+                series[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+            counts, total = series[labels]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    def event(self, name: str, fields: Dict[str, Any]):
+        self.counter("events", 1, (("event", name),))
+
+    @staticmethod
+    def _format(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+        pairs = list(labels) + ([extra] if extra else [])
+        if not pairs:
+            return ""
+        escaped = (
+            (k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for k, v in pairs
+        )
+        return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+    def exposition(self) -> str:
+        """The current values, in the text format Prometheus scrapes."""
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                metric = f"{self.prefix}{name}_total"
+                lines.append(f"# TYPE {metric} counter")
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{metric}{self._format(labels)} {value}")
+
+            for name, series in sorted(self._histograms.items()):
+                metric = f"{self.prefix}{name}"
+                lines.append(f"# TYPE {metric} histogram")
+                for labels, (counts, total) in sorted(series.items()):
+                    cumulative = 0
+                    for bound, n in zip(self.buckets + (float("inf"),), counts):
+                        cumulative += n
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append(
+                            f"{metric}_bucket{self._format(labels, ('le', le))} {cumulative}"
+                        )
+                    lines.append(f"{metric}_sum{self._format(labels)} {total[0]}")
+                    lines.append(f"{metric}_count{self._format(labels)} {cumulative}")
+
+        return "\n".join(lines) + "\n"
+
+
+class LoggingSink(Sink):
+    """Logs every event to `logger` at `level`, as the name and its fields."""
+
+    def __init__(
+        self, logger: Union[str, logging.Logger] = "loca_vision", level=logging.INFO
+    ):
+        self.logger = logging.getLogger(logger) if isinstance(logger, str) else logger
+        self.level = level
+
+    def event(self, name: str, fields: Dict[str, Any]):
+        if self.logger.isEnabledFor(self.level):
+            details = " ".join(f"{k}={v}" for k, v in fields.items())
+            self.logger.log(self.level, "%s %s", name, details)
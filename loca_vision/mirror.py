@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+"""Concurrent mirroring of monument images into a Cloud Storage bucket.
+
+Downloads and uploads run on a shared thread pool, each under its own cap.
+Nothing here touches the monuments: every image gets a `MirrorResult`, and the
+caller decides what to do with them (usually `apply_results`).
+
+Images are never held in memory whole: without a cache, each one is streamed
+from the download straight into the upload. That ties the two together: an
+image holds its download slot until its upload is done, so a slow bucket slows
+the downloads down with it, and no more than `max_downloads` images are ever
+being uploaded. Images of up to `UPLOAD_CHUNK_SIZE` go up in a single request;
+larger ones go into a resumable upload, which sends them `UPLOAD_CHUNK_SIZE` at
+a time.
+
+Given an `ImageCache`, images are stored by content hash instead of under the
+monument's name, each distinct source URL is fetched at most once per run, and
+anything the cache has already seen skips the network entirely. New images are
+written to the cache as they download, hashed on the way, and uploaded from
+there, so the download slot is free again before the upload starts and the two
+caps are independent."""
+
+from __future__ import annotations
+
+import mimetypes
+import threading
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import (
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import metrics
+from .http_scheduler import get_scheduler
+from .image_cache import ImageCache
+from .wiki_monument import WikiMonument
+from .wiki_parser import MAX_IMAGE_BYTES, headers
+
+# images are streamed from the download to the upload in chunks this large, so
+# no worker ever holds a whole image in memory
+CHUNK_SIZE = 256 * 1024
+
+# resumable uploads send this much per request (it must be a multiple of 256 KiB);
+# left to itself, the client would buffer up to 40 MiB, more than any image
+UPLOAD_CHUNK_SIZE = 4 * CHUNK_SIZE
+
+
+class TooLarge(requests.RequestException):
+    """The image is larger than Product Search takes."""
+
+
+class MirrorResult(NamedTuple):
+    """The outcome of mirroring a single image of a single monument."""
+
+    monument: int
+    index: int
+    source: str
+    uri: Optional[str]
+    error: Optional[str]
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def make_session(pool_size: int = 16) -> requests.Session:
+    """Creates an HTTP session whose connection pool can serve `pool_size` threads."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update(headers)
+    return session
+
+
+def blob_name(mon: WikiMonument, i: int, url: str) -> str:
+    """The name under which the `i`th image of the monument is stored."""
+    ext = url.split(".")[-1]
+    return f"{mon.slug}/{i}.{ext}"
+
+
+def content_blob_name(sha: str, url: str) -> str:
+    """The name under which content-addressed images are stored."""
+    ext = url.split(".")[-1]
+    return f"sha256/{sha}.{ext}"
+
+
+class _Mirror:
+    """Copies single images into the bucket, under the shared concurrency caps."""
+
+    def __init__(
+        self,
+        bucket,
+        max_downloads: int,
+        max_uploads: int,
+        timeout: float,
+        session: Optional[requests.Session],
+        cache: Optional[ImageCache],
+    ):
+        self.bucket = bucket
+        self.timeout = timeout
+        self.session = session or make_session(max_downloads)
+        self.cache = cache
+        self.download_slots = threading.BoundedSemaphore(max_downloads)
+        self.upload_slots = threading.BoundedSemaphore(max_uploads)
+        self.workers = max_downloads + max_uploads
+
+    @contextmanager
+    def download(self, url: str) -> Iterator[Iterator[bytes]]:
+        """Opens the image at `url` and gives its bytes as `CHUNK_SIZE` chunks,
+        holding a download slot until done with them. Raises `TooLarge` partway
+        through if there turn out to be more than `MAX_IMAGE_BYTES`."""
+        with self.download_slots:
+            with metrics.timer("request_seconds", stage="download"):
+                r = get_scheduler().request(
+                    "GET", url, session=self.session, timeout=self.timeout, stream=True
+                )
+            with r:
+                metrics.count("requests", stage="download", status=r.status_code)
+                r.raise_for_status()
+                if int(r.headers.get("Content-Length") or 0) > MAX_IMAGE_BYTES:
+                    raise TooLarge(f"{url} is {r.headers['Content-Length']} bytes")
+
+                def chunks() -> Iterator[bytes]:
+                    size = 0
+                    try:
+                        for chunk in r.iter_content(CHUNK_SIZE):
+                            size += len(chunk)
+                            if size > MAX_IMAGE_BYTES:
+                                raise TooLarge(f"{url} is over {MAX_IMAGE_BYTES} bytes")
+                            yield chunk
+                    finally:
+                        metrics.count("bytes", size, stage="download")
+
+                yield chunks()
+
+    def upload(self, name: str, chunks: Iterable[bytes]) -> str:
+        """Streams the chunks into the named blob. Up to `UPLOAD_CHUNK_SIZE`
+        bytes are uploaded in one request; past that, the rest goes into a
+        resumable upload, which is abandoned if the chunks run into an error."""
+        chunks = iter(chunks)
+        head: List[bytes] = []
+        size = 0
+        with self.upload_slots:
+            with metrics.timer("request_seconds", stage="upload"):
+                content_type = mimetypes.guess_type(name)[0]
+                blob = self.bucket.blob(name)
+                for chunk in chunks:
+                    head.append(chunk)
+                    size += len(chunk)
+                    if size > UPLOAD_CHUNK_SIZE:
+                        break
+                else:
+                    blob.upload_from_string(b"".join(head), content_type=content_type)
+                    head = []
+
+                if head:
+                    with blob.open(
+                        "wb", chunk_size=UPLOAD_CHUNK_SIZE, content_type=content_type
+                    ) as f:
+                        f.write(b"".join(head))
+                        for chunk in chunks:
+                            f.write(chunk)
+                            size += len(chunk)
+        metrics.count("requests", stage="upload")
+        metrics.count("bytes", size, stage="upload")
+        return f"gs://{self.bucket.name}/{name}"
+
+    def copy(self, url: str, name: str) -> Tuple[Optional[str], Optional[str]]:
+        """Mirrors the image to the named blob, returning its URI or an error. The
+        bytes go straight from the download into the upload, a chunk at a time,
+        so the download slot is held until the upload is done."""
+        try:
+            with self.download(url) as chunks:
+                # errors reading the download surface from inside the upload
+                failed: List[Exception] = []
+
+                def read() -> Iterator[bytes]:
+                    try:
+                        yield from chunks
+                    except Exception as e:
+                        failed.append(e)
+                        raise
+
+                try:
+                    return self.upload(name, read()), None
+                except Exception as e:
+                    if failed:
+                        return None, f"download failed: {failed[0]}"
+                    return None, f"upload failed: {e}"
+        except Exception as e:
+            return None, f"download failed: {e}"
+
+    def copy_cached(self, url: str) -> Tuple[Optional[str], Optional[str]]:
+        """Mirrors the image to a content-addressed blob, consulting the cache first.
+        The name depends on the content, so a new image is downloaded into the
+        cache and then uploaded from there."""
+        cache, bucket = self.cache, self.bucket
+        uri = cache.lookup(url, bucket.name)
+        if uri is not None:
+            metrics.count("cache_hits", stage="mirror")
+            return uri, None
+
+        sha = cache.digest_for(url)
+        f = sha and cache.open(sha)
+        if not f:
+            try:
+                with self.download(url) as chunks:
+                    sha = cache.put_chunks(chunks)
+            except requests.RequestException as e:
+                return None, f"download failed: {e}"
+            cache.record_source(url, sha)
+            f = cache.open(sha)
+
+        uri = cache.uri_for(sha, bucket.name)
+        if uri is not None:
+            if f:
+                f.close()
+            return uri, None
+        name = content_blob_name(sha, url)
+        if not f:
+            # too large to keep in the cache, so stream it once more
+            uri, error = self.copy(url, name)
+        else:
+            with f:
+                chunks = iter(lambda: f.read(CHUNK_SIZE), b"")
+                try:
+                    uri, error = self.upload(name, chunks), None
+                except Exception as e:
+                    uri, error = None, f"upload failed: {e}"
+        if uri is not None:
+            cache.record_blob(sha, bucket.name, uri)
+        return uri, error
+
+    def submit(
+        self,
+        pool: ThreadPoolExecutor,
+        mon: WikiMonument,
+        i: int,
+        url: str,
+        in_flight: Dict[str, Future],
+    ) -> Future:
+        """Schedules the `i`th image of the monument. With a cache, images whose URL
+        is already in `in_flight` share that copy."""
+        if self.cache is None:
+            return pool.submit(self.copy, url, blob_name(mon, i, url))
+        if url not in in_flight:
+            in_flight[url] = pool.submit(self.copy_cached, url)
+        return in_flight[url]
+
+
+def _jobs(mon: WikiMonument) -> List[Tuple[int, str]]:
+    return [
+        (i, url) for i, url in enumerate(mon.image_urls) if not url.startswith("gs")
+    ]
+
+
+def mirror_images(
+    monuments: Sequence[WikiMonument],
+    bucket,
+    max_downloads: int = 8,
+    max_uploads: int = 8,
+    timeout: float = 3,
+    session: Optional[requests.Session] = None,
+    progress: Optional[Callable[[MirrorResult], None]] = None,
+    cache: Optional[ImageCache] = None,
+) -> List[MirrorResult]:
+    """Copies every image of the monuments that isn't already in Cloud Storage into
+    the bucket, and returns one result per image in input order.
+
+    `bucket` only needs to provide `name`, `blob(name).upload_from_string(data)`
+    and `blob(name).open("wb")`, so anything shaped like a
+    `google.cloud.storage.Bucket` works. `progress` is
+    called with each result, in input order, as it is collected."""
+    mirror = _Mirror(bucket, max_downloads, max_uploads, timeout, session, cache)
+
+    with ThreadPoolExecutor(max_workers=mirror.workers) as pool:
+        in_flight: Dict[str, Future] = {}
+        jobs = [
+            (m, i, url, mirror.submit(pool, mon, i, url, in_flight))
+            for m, mon in enumerate(monuments)
+            for i, url in _jobs(mon)
+        ]
+
+        results = []
+        for m, i, url, future in jobs:
+            result = MirrorResult(m, i, url, *future.result())
+            if progress is not None:
+                progress(result)
+            results.append(result)
+
+        return results
+
+
+def iter_mirrored(
+    monuments: Iterable[WikiMonument],
+    bucket,
+    max_downloads: int = 8,
+    max_uploads: int = 8,
+    timeout: float = 3,
+    session: Optional[requests.Session] = None,
+    cache: Optional[ImageCache] = None,
+    window: int = 64,
+) -> Iterator[Tuple[WikiMonument, List[MirrorResult]]]:
+    """Mirrors the images of a stream of monuments, generating each monument (with
+    its mirrored URLs replaced) along with its results, in input order.
+
+    At most `window` monuments are in flight at once, so memory stays flat no
+    matter how long the stream is, and the first monuments come out while later
+    ones are still being read. Takes the same options as `mirror_images`."""
+    mirror = _Mirror(bucket, max_downloads, max_uploads, timeout, session, cache)
+
+    with ThreadPoolExecutor(max_workers=mirror.workers) as pool:
+        in_flight: Dict[str, Future] = {}
+        pending: Deque[Tuple[int, WikiMonument, list]] = deque()
+
+        def finish():
+            m, mon, jobs = pending.popleft()
+            results = [
+                MirrorResult(m, i, url, *future.result()) for i, url, future in jobs
+            ]
+            for i, url, future in jobs:
+                if in_flight.get(url) is future:
+                    del in_flight[url]
+            for result in results:
+                if result.ok:
+                    mon.image_urls[result.index] = result.uri
+            return mon, results
+
+        for m, mon in enumerate(monuments):
+            jobs = [
+                (i, url, mirror.submit(pool, mon, i, url, in_flight))
+                for i, url in _jobs(mon)
+            ]
+            pending.append((m, mon, jobs))
+            if len(pending) >= window:
+                yield finish()
+
+        while pending:
+            yield finish()
+
+
+def apply_results(
+    monuments: Sequence[WikiMonument], results: Sequence[MirrorResult]
+) -> Sequence[WikiMonument]:
+    """Replaces the source URLs of successfully mirrored images with their new URIs."""
+    for result in results:
+        if result.ok:
+            monuments[result.monument].image_urls[result.index] = result.uri
+
+    return monuments
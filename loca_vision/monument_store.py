@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""An append-only store of monuments as newline-delimited JSON.
+
+Each line is one `WikiMonument.to_json()`, so monuments can be written as soon as
+they're crawled and read back one at a time, without ever holding the whole
+list in memory. A crash mid-write leaves at most one truncated last line, which
+the reader skips."""
+
+from __future__ import annotations
+
+import json
+import os
+from typing import Iterable, Iterator
+
+from .wiki_monument import WikiMonument
+
+
+def drop_partial_line(path: str):
+    """Cuts off a truncated last line, so appending doesn't glue onto it."""
+    try:
+        f = open(path, "rb+")
+    except FileNotFoundError:
+        return
+
+    with f:
+        end = f.seek(0, os.SEEK_END)
+        pos = end
+        while pos > 0:
+            step = min(4096, pos)
+            f.seek(pos - step)
+            chunk = f.read(step)
+            newline = chunk.rfind(b"\n")
+            if newline >= 0:
+                if pos - step + newline + 1 != end:
+                    f.truncate(pos - step + newline + 1)
+                return
+            pos -= step
+        f.truncate(0)
+
+
+class MonumentWriter:
+    """Appends monuments to an NDJSON file, flushing after every line."""
+
+    def __init__(self, path: str, append: bool = True):
+        self.path = path
+        self.count = 0
+        if append:
+            drop_partial_line(path)
+        self._file = open(path, "a" if append else "w", encoding="utf-8")
+
+    def write(self, mon: WikiMonument):
+        self._file.write(json.dumps(mon.to_json(), ensure_ascii=False) + "\n")
+        self._file.flush()
+        self.count += 1
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self) -> MonumentWriter:
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_monuments(
+    path: str, monuments: Iterable[WikiMonument], append: bool = True
+) -> int:
+    """Writes the monuments as they are generated and returns how many there were."""
+    with MonumentWriter(path, append) as writer:
+        for mon in monuments:
+            writer.write(mon)
+        return writer.count
+
+
+def read_monuments(path: str) -> Iterator[WikiMonument]:
+    """Generates the monuments in an NDJSON file, one line at a time."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                obj = json.loads(line)
+            except json.JSONDecodeError:
+                if not line.endswith("\n"):
+                    # truncated by an interrupted write
+                    return
+                raise
+            yield WikiMonument.from_json(obj)
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""Applying batches of product set changes through the online API.
+
+A batch is a list of `CreateProduct`, `CreateReferenceImage` and
+`AddToProductSet` operations. They're run in dependency order, in three waves:
+products are created first, then their reference images, and finally products
+are added to the product set, so they only become searchable once their images
+are in. Within a wave the operations are independent and run in a thread pool,
+all under one rate limiter sized to the mutation quota. Transient errors are
+retried with backoff; an operation whose product couldn't be created is skipped.
+
+Every operation is one request, so for large batches a CSV import (one request
+and a few minutes of waiting, see `gcloud.upload_product_set`) is cheaper, and
+`execute` switches to it by itself."""
+
+from __future__ import annotations
+
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Set, Union
+
+from .clients import config
+from .gcloud import (
+    CSV_MAX_ROWS,
+    add_product_to_product_set,
+    create_product,
+    create_reference_image,
+    csv_row,
+    reference_image_id,
+    start_import,
+    wait_for_imports,
+    write_csv_rows,
+)
+from .ratelimit import RateLimiter
+
+# the default Product Search quota for mutating requests, per minute; set
+# `MUTATIONS_PER_MINUTE` in the config if the project's quota differs
+MUTATIONS_PER_MINUTE = 600
+
+# batches with at least this many images are imported from a CSV instead
+IMPORT_THRESHOLD = 1000
+
+
+class CreateProduct(NamedTuple):
+    product_id: str
+    display_name: str
+    # as in the import CSV, `key=value,...`
+    labels: str = ""
+
+
+class CreateReferenceImage(NamedTuple):
+    product_id: str
+    uri: str
+    # defaults to `gcloud.reference_image_id(uri)`
+    image_id: Optional[str] = None
+    # the product's, for the import CSV, which restates them on every row; only
+    # needed for an image of a product the batch doesn't create
+    display_name: Optional[str] = None
+    labels: Optional[str] = None
+
+
+class AddToProductSet(NamedTuple):
+    product_id: str
+
+
+Mutation = Union[CreateProduct, CreateReferenceImage, AddToProductSet]
+
+
+class MutationResult(NamedTuple):
+    """What became of one operation. `status` is one of "done", "exists" (it had
+    been done before), "imported" (through the CSV import), "failed" or
+    "skipped" (because the product it needs failed)."""
+
+    mutation: Mutation
+    status: str
+    error: Optional[str] = None
+    attempts: int = 0
+
+    @property
+    def ok(self) -> bool:
+        return self.status in ("done", "exists", "imported")
+
+
+def _transient_errors() -> tuple:
+    from google.api_core import exceptions
+
+    return (
+        exceptions.TooManyRequests,
+        exceptions.ResourceExhausted,
+        exceptions.ServiceUnavailable,
+        exceptions.InternalServerError,
+        exceptions.DeadlineExceeded,
+        exceptions.Aborted,
+    )
+
+
+class _Executor:
+    def __init__(self, limiter: RateLimiter, retries: int, backoff: float):
+        from google.api_core.exceptions import AlreadyExists, GoogleAPICallError
+
+        self.limiter = limiter
+        self.retries = retries
+        self.backoff = backoff
+        self.already_exists = AlreadyExists
+        self.api_error = GoogleAPICallError
+        self.transient = _transient_errors()
+
+    def call(self, mutation: Mutation, fn: Callable[[], object]) -> MutationResult:
+        """Runs the request, retrying transient errors with exponential backoff
+        and full jitter. Any other error fails just this operation."""
+        for attempt in range(1, self.retries + 2):
+            self.limiter.acquire()
+            try:
+                fn()
+                return MutationResult(mutation, "done", None, attempt)
+            except self.already_exists:
+                return MutationResult(mutation, "exists", None, attempt)
+            except self.transient as e:
+                if attempt > self.retries:
+                    return MutationResult(mutation, "failed", str(e), attempt)
+                time.sleep(random.uniform(0, self.backoff * 2 ** (attempt - 1)))
+            except self.api_error as e:
+                return MutationResult(mutation, "failed", str(e), attempt)
+            except Exception as e:
+                # e.g. a bad argument or a connection error outside the API's
+                # own exceptions; the rest of the batch still gets its results
+                return MutationResult(mutation, "failed", repr(e), attempt)
+
+    def run(self, mutation: Mutation) -> MutationResult:
+        if isinstance(mutation, CreateProduct):
+            return self.call(
+                mutation,
+                lambda: create_product(
+                    mutation.product_id,
+                    mutation.display_name,
+                    mutation.labels,
+                    add_to_set=False,
+                ),
+            )
+        if isinstance(mutation, CreateReferenceImage):
+            image_id = mutation.image_id or reference_image_id(mutation.uri)
+            return self.call(
+                mutation,
+                lambda: create_reference_image(
+                    mutation.product_id, image_id, mutation.uri
+                ),
+            )
+        return self.call(
+            mutation, lambda: add_product_to_product_set(mutation.product_id)
+        )
+
+
+def _run_online(
+    mutations: Sequence[Mutation],
+    executor: _Executor,
+    workers: int,
+    failed: Set[str],
+) -> Dict[int, MutationResult]:
+    """Runs the operations wave by wave, returning their results by index.
+    `failed` gathers the products that couldn't be created."""
+    results: Dict[int, MutationResult] = {}
+    waves = [
+        [i for i, m in enumerate(mutations) if isinstance(m, kind)]
+        for kind in (CreateProduct, CreateReferenceImage, AddToProductSet)
+    ]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for wave in waves:
+            runnable = []
+            for i in wave:
+                if mutations[i].product_id in failed:
+                    results[i] = MutationResult(
+                        mutations[i], "skipped", "product was not created"
+                    )
+                else:
+                    runnable.append(i)
+
+            for i, result in zip(
+                runnable, pool.map(executor.run, (mutations[i] for i in runnable))
+            ):
+                results[i] = result
+                if isinstance(result.mutation, CreateProduct) and not result.ok:
+                    failed.add(result.mutation.product_id)
+
+    return results
+
+
+def _run_import(
+    mutations: Sequence[Mutation], max_rows: int, poll: float
+) -> Dict[int, MutationResult]:
+    """Imports the reference images, and with them the products they belong to,
+    from a CSV. Returns the results of the operations it covered by index.
+
+    Every row of the CSV restates its product's display name and labels, so an
+    image whose product isn't created in the batch and doesn't carry them is
+    left to the online path, rather than importing made-up ones over the
+    product's."""
+    products = {m.product_id: m for m in mutations if isinstance(m, CreateProduct)}
+    images = [i for i, m in enumerate(mutations) if isinstance(m, CreateReferenceImage)]
+
+    results: Dict[int, MutationResult] = {}
+    rows, rowed = [], []
+    for i in images:
+        m = mutations[i]
+        product = products.get(m.product_id)
+        if product is not None:
+            display_name, labels = product.display_name, product.labels
+        elif m.display_name is not None and m.labels is not None:
+            display_name, labels = m.display_name, m.labels
+        else:
+            continue
+        try:
+            row = csv_row(m.uri, m.product_id, display_name, labels, m.image_id)
+        except ValueError as e:
+            # the import can't take it, and neither can the online API
+            results[i] = MutationResult(m, "failed", str(e), 0)
+            continue
+        rows.append(row)
+        rowed.append(i)
+
+    # a product's rows together, since the CSV is only split between products
+    order = sorted(range(len(rows)), key=lambda k: rows[k][3])
+    rows, rowed = [rows[k] for k in order], [rowed[k] for k in order]
+    uris = write_csv_rows(rows, max_rows)
+    outcomes = wait_for_imports([start_import(uri) for uri in uris], poll)
+    statuses = [status for outcome in outcomes for status in outcome.statuses]
+
+    imported: Set[str] = set()
+    for i, status in zip(rowed, statuses):
+        # `0` is the code for OK in google.rpc.Code, and 6 for ALREADY_EXISTS,
+        # which (as online) means an earlier attempt got it in
+        if status.code in (0, 6):
+            state = "imported" if status.code == 0 else "exists"
+            results[i] = MutationResult(mutations[i], state, None, 1)
+            imported.add(mutations[i].product_id)
+        else:
+            results[i] = MutationResult(mutations[i], "failed", status.message, 1)
+
+    # the import creates the products of the images it takes, and puts them in
+    # the set; products none of whose images got in are left to the online path
+    for i, m in enumerate(mutations):
+        if not isinstance(m, CreateReferenceImage) and m.product_id in imported:
+            results[i] = MutationResult(m, "imported", None, 1)
+
+    return results
+
+
+def execute(
+    mutations: Sequence[Mutation],
+    workers: int = 8,
+    rate: Optional[float] = None,
+    retries: int = 5,
+    backoff: float = 1.0,
+    import_threshold: int = IMPORT_THRESHOLD,
+    max_rows: int = CSV_MAX_ROWS,
+    poll: float = 5.0,
+) -> List[MutationResult]:
+    """Applies the operations and reports on each, in input order. Every new
+    product is added to the product set once its images are in, whether or not
+    the batch asks for it; the implied `AddToProductSet`s are reported at the end.
+
+    Requests are limited to `rate` per second, by default the project's
+    `MUTATIONS_PER_MINUTE` quota. With at least `import_threshold` reference
+    images, those go through a CSV import instead."""
+    mutations = list(mutations)
+    explicit = {m.product_id for m in mutations if isinstance(m, AddToProductSet)}
+    mutations.extend(
+        AddToProductSet(m.product_id)
+        for m in mutations
+        if isinstance(m, CreateProduct) and m.product_id not in explicit
+    )
+
+    results: Dict[int, MutationResult] = {}
+    n_images = sum(isinstance(m, CreateReferenceImage) for m in mutations)
+    if n_images >= import_threshold:
+        results = _run_import(mutations, max_rows, poll)
+
+    if rate is None:
+        rate = float(config.get("MUTATIONS_PER_MINUTE", MUTATIONS_PER_MINUTE)) / 60
+    executor = _Executor(RateLimiter(rate, burst=workers), retries, backoff)
+
+    remaining = [i for i in range(len(mutations)) if i not in results]
+    online = _run_online([mutations[i] for i in remaining], executor, workers, set())
+    for j, result in online.items():
+        results[remaining[j]] = result
+
+    return [results[i] for i in range(len(mutations))]
@@ -0,0 +1,577 @@
+#!/usr/bin/env python3
+"""The whole crawl → curate → mirror → import flow as one resumable run. Run with
+`python -m loca_vision.pipeline --bbox SW_LAT SW_LON NE_LAT NE_LON`.
+
+Everything a run does is checkpointed in its working directory, per stage and
+per item:
+
+- crawl: the monuments go to `crawl.ndjson`, and the page IDs of every batch
+  hydrated go to `crawl.pages`, so a restarted crawl only hydrates new pages;
+- curate: the monuments, with only the images worth keeping (see `curation`),
+  go to `curate.ndjson`, and what was pruned and why to `curate.pruned.ndjson`;
+- mirror: the monuments, with their images mirrored, go to `mirror.ndjson`;
+  like curation, a restarted mirror skips the monuments already done;
+- import: the monuments of every import that finished go to `import.keys`.
+
+A stage that ran to the end leaves a `<stage>.done` file. With `--resume`, done
+stages are skipped and the others pick up where they stopped; without it, the
+stages being run start over.
+
+The stages run at the same time, each in its own thread. Each one follows the
+file the one before it writes, the way `tail -f` does, so monuments are
+curated and mirrored while the crawl is still going and imported, a CSV shard
+at a time, while the mirror is still going. Curation keeps the images it
+downloads in an image cache, `images/` in the working directory unless
+`--image-cache` names another, and the mirror takes them from there rather than
+downloading them again."""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+from typing import (
+    Any,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+from . import metrics
+from .coord import Coord
+from .curation import KEEP, iter_curated
+from .gcloud import (
+    CSV_MAX_ROWS,
+    iter_csv_rows,
+    iter_upload_images_from_monuments,
+    report_import_result,
+    start_import,
+    wait_for_imports,
+    write_csv_rows,
+)
+from .image_cache import ImageCache
+from .monument_store import MonumentWriter, drop_partial_line, read_monuments
+from .tiling import bbox_polygon
+from .wiki_monument import WikiMonument
+from .wiki_parser import iter_crawl_batches
+
+STAGES = ("crawl", "curate", "mirror", "import")
+
+# the monuments each stage writes, which the next stage reads
+OUTPUTS = {
+    "crawl": "crawl.ndjson",
+    "curate": "curate.ndjson",
+    "mirror": "mirror.ndjson",
+}
+
+# every file a stage keeps, removed when it starts over
+FILES = {
+    "crawl": ("crawl.json", "crawl.ndjson", "crawl.pages", "crawl.done"),
+    "curate": ("curate.ndjson", "curate.pruned.ndjson", "curate.done"),
+    "mirror": ("mirror.ndjson", "mirror.done"),
+    "import": ("import.keys", "import.done"),
+}
+
+# how often a stage checks for more input while the one before it is running
+FOLLOW_POLL = 0.5
+
+
+class Checkpoint:
+    """The keys of the items a stage has finished, appended to a file one per
+    line as they finish, so a restarted stage can skip them."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.keys: Set[str] = set()
+        drop_partial_line(path)
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.keys.update(line.rstrip("\n") for line in f if line.strip())
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def __contains__(self, key: Any) -> bool:
+        return str(key) in self.keys
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def add(self, keys: Iterable[Any]):
+        """Records the items as done, flushing straight away."""
+        keys = [str(key) for key in keys]
+        with self._lock:
+            self._file.write("".join(key + "\n" for key in keys))
+            self._file.flush()
+            self.keys.update(keys)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self) -> Checkpoint:
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def follow(
+    path: str,
+    finished: threading.Event,
+    stop: Optional[threading.Event] = None,
+    poll: float = FOLLOW_POLL,
+) -> Iterator[WikiMonument]:
+    """Generates the monuments in the NDJSON file, including the ones appended
+    while reading it, until `finished` is set and the end has been reached (or
+    `stop` is set). Half-written lines are waited on, not read."""
+    while not os.path.exists(path):
+        if finished.is_set() or (stop is not None and stop.is_set()):
+            return
+        time.sleep(poll)
+
+    with open(path, "r", encoding="utf-8") as f:
+        while stop is None or not stop.is_set():
+            # checked before reading, so nothing written in between is missed
+            ended = finished.is_set()
+            pos = f.tell()
+            line = f.readline()
+            if line.endswith("\n"):
+                if line.strip():
+                    yield WikiMonument.from_json(json.loads(line))
+                continue
+            if ended:
+                # a partial last line of a finished file was cut off by a crash
+                return
+            f.seek(pos)
+            time.sleep(poll)
+
+
+def _monument_key(mon: WikiMonument) -> str:
+    """What a stage's checkpoint knows the monument by. Not the slug: pages with
+    the same name are different monuments, and the import gives them the same
+    product."""
+    return json.dumps([mon.name, mon.coord.lat, mon.coord.lon], ensure_ascii=False)
+
+
+def _mirrored_only(mon: WikiMonument) -> WikiMonument:
+    """The monument with just the images that made it into Cloud Storage, since
+    the import can't take any others."""
+    urls = [url for url in mon.image_urls if url.startswith("gs")]
+    return WikiMonument(mon.name, mon.desc, mon.coord, urls)
+
+
+class Pipeline:
+    """The stages of a run in the working directory `workdir`.
+
+    `bbox` is the `(sw, ne)` corners of the area to crawl, and is only needed
+    by the crawl stage (a resumed crawl reuses the one it started with).
+    Curation keeps up to `keep` images per monument, and is skipped altogether
+    without `curate`. The other options set each stage's parallelism:
+    `crawl_workers` requests in flight under `crawl_rate` per second;
+    `curate_workers` decoding processes (by default one per CPU);
+    `max_downloads` and `max_uploads` images at once, shared through the image
+    cache directory `image_cache` (with curation, `images/` in `workdir` by
+    default, so curated images aren't downloaded twice); and up to
+    `max_imports` CSV imports of `max_rows` rows running at once, polled every
+    `poll` seconds."""
+
+    def __init__(
+        self,
+        workdir: str,
+        bbox: Optional[Tuple[Coord, Coord]] = None,
+        crawl_workers: int = 4,
+        crawl_rate: float = 10,
+        curate: bool = True,
+        keep: int = KEEP,
+        curate_workers: Optional[int] = None,
+        max_downloads: int = 8,
+        max_uploads: int = 8,
+        image_cache: Optional[str] = None,
+        max_rows: int = CSV_MAX_ROWS,
+        max_imports: int = 4,
+        poll: float = 5.0,
+    ):
+        self.workdir = workdir
+        self.bbox = bbox
+        self.crawl_workers = crawl_workers
+        self.crawl_rate = crawl_rate
+        self.stages = STAGES if curate else tuple(s for s in STAGES if s != "curate")
+        self.keep = keep
+        self.curate_workers = curate_workers
+        self.max_downloads = max_downloads
+        self.max_uploads = max_uploads
+        if image_cache is None and curate:
+            image_cache = os.path.join(workdir, "images")
+        self.image_cache = image_cache
+        self.max_rows = max_rows
+        self.max_imports = max_imports
+        self.poll = poll
+
+        self.errors: Dict[str, BaseException] = {}
+        self._finished = {stage: threading.Event() for stage in STAGES}
+        self._stop = threading.Event()
+        self._run_id = uuid.uuid4().hex[:12]
+        self._cache: Optional[ImageCache] = None
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.workdir, name)
+
+    def is_done(self, stage: str) -> bool:
+        return os.path.exists(self.path(f"{stage}.done"))
+
+    def reset(self, stage: str):
+        """Throws away everything the stage has done."""
+        for name in FILES[stage]:
+            try:
+                os.remove(self.path(name))
+            except FileNotFoundError:
+                pass
+
+    def run(self, stages: Optional[Sequence[str]] = None, resume: bool = False) -> bool:
+        """Runs the stages (by default all of them) together, skipping the ones
+        already done if resuming, and returns whether all of them are now done.
+        Stages left out read what earlier runs of them wrote. Ctrl-C stops every
+        stage at the next item, with its checkpoints intact."""
+        stages = self.stages if stages is None else stages
+        os.makedirs(self.workdir, exist_ok=True)
+        if not resume:
+            for stage in stages:
+                self.reset(stage)
+        if self.image_cache and self._cache is None:
+            self._cache = ImageCache(self.image_cache)
+
+        threads = []
+        for stage in self.stages:
+            if stage not in stages or self.is_done(stage):
+                self._finished[stage].set()
+                continue
+            threads.append(
+                threading.Thread(
+                    target=self._run_stage, args=(stage,), name=f"pipeline-{stage}"
+                )
+            )
+
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.5)
+        except KeyboardInterrupt:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+            raise
+        finally:
+            if self._cache is not None:
+                self._cache.close()
+                self._cache = None
+
+        return all(self.is_done(stage) for stage in stages)
+
+    def _run_stage(self, stage: str):
+        metrics.event("stage_started", stage=stage)
+        try:
+            with metrics.timer("stage_seconds", stage=stage):
+                complete = getattr(self, f"_{stage}")()
+            if complete:
+                open(self.path(f"{stage}.done"), "w").close()
+                metrics.event("stage_done", stage=stage)
+            else:
+                metrics.event("stage_incomplete", stage=stage)
+        except Exception as e:
+            self.errors[stage] = e
+            metrics.event("stage_failed", stage=stage, error=repr(e))
+        finally:
+            self._finished[stage].set()
+
+    def _upstream(self, stage: str) -> Iterator[WikiMonument]:
+        """The monuments the stage before this one has written, and is writing."""
+        before = self.stages[self.stages.index(stage) - 1]
+        return follow(self.path(OUTPUTS[before]), self._finished[before], self._stop)
+
+    def _upstream_done(self, stage: str) -> bool:
+        before = self.stages[self.stages.index(stage) - 1]
+        return not self._stop.is_set() and self.is_done(before)
+
+    def _crawl_bbox(self) -> Tuple[Coord, Coord]:
+        """The area being crawled, saved with the crawl so resuming keeps it."""
+        saved = self.path("crawl.json")
+        if os.path.exists(saved):
+            with open(saved, "r", encoding="utf-8") as f:
+                sw, ne = (Coord.from_json(c) for c in json.load(f)["bbox"])
+            if self.bbox is not None and [c.to_json() for c in self.bbox] != [
+                sw.to_json(),
+                ne.to_json(),
+            ]:
+                raise ValueError(
+                    f"the crawl in {self.workdir} is of {sw} to {ne}; "
+                    "start it over to crawl another area"
+                )
+            return sw, ne
+
+        if self.bbox is None:
+            raise ValueError("the crawl stage needs the area to crawl (--bbox)")
+        with open(saved, "w", encoding="utf-8") as f:
+            json.dump({"bbox": [c.to_json() for c in self.bbox]}, f)
+        return self.bbox
+
+    def _crawl(self) -> bool:
+        sw, ne = self._crawl_bbox()
+        out = self.path(OUTPUTS["crawl"])
+        seen = (
+            {_monument_key(mon) for mon in read_monuments(out)}
+            if os.path.exists(out)
+            else set()
+        )
+
+        with Checkpoint(self.path("crawl.pages")) as pages, MonumentWriter(
+            out
+        ) as writer:
+            skipped = len(pages)
+            if skipped:
+                metrics.event("stage_resumed", stage="crawl", pages=skipped)
+
+            for batch, monuments in iter_crawl_batches(
+                bbox_polygon(sw, ne),
+                workers=self.crawl_workers,
+                rate=self.crawl_rate,
+                skip=pages,
+            ):
+                for mon in monuments:
+                    # a batch hydrated before a crash, but not yet recorded
+                    if _monument_key(mon) not in seen:
+                        seen.add(_monument_key(mon))
+                        writer.write(mon)
+                        metrics.count("monuments", stage="crawl")
+                pages.add(batch)
+                if self._stop.is_set():
+                    return False
+
+        return not self._stop.is_set()
+
+    def _done_monuments(self, stage: str) -> Set[str]:
+        """The monuments the stage has already written, to be skipped."""
+        out = self.path(OUTPUTS[stage])
+        done = (
+            {_monument_key(mon) for mon in read_monuments(out)}
+            if os.path.exists(out)
+            else set()
+        )
+        if done:
+            metrics.event("stage_resumed", stage=stage, monuments=len(done))
+        return done
+
+    def _curate(self) -> bool:
+        done = self._done_monuments("curate")
+        todo = (
+            mon for mon in self._upstream("curate") if _monument_key(mon) not in done
+        )
+        pruned: Dict[str, int] = {}
+
+        with MonumentWriter(self.path(OUTPUTS["curate"])) as writer, open(
+            self.path("curate.pruned.ndjson"), "a", encoding="utf-8"
+        ) as report:
+            for mon, dropped in iter_curated(
+                todo,
+                self.keep,
+                self.curate_workers,
+                self.max_downloads,
+                cache=self._cache,
+            ):
+                # the report first: a monument in the output has its report
+                for p in dropped:
+                    report.write(json.dumps(p._asdict(), ensure_ascii=False) + "\n")
+                    pruned[p.reason] = pruned.get(p.reason, 0) + 1
+                report.flush()
+                writer.write(mon)
+                metrics.count("monuments", stage="curate")
+
+        metrics.event("curation_pruned", **pruned)
+        return self._upstream_done("curate")
+
+    def _mirror(self) -> bool:
+        out = self.path(OUTPUTS["mirror"])
+        done = self._done_monuments("mirror")
+        todo = (
+            mon for mon in self._upstream("mirror") if _monument_key(mon) not in done
+        )
+        with MonumentWriter(out) as writer:
+            for mon in iter_upload_images_from_monuments(
+                todo, self.max_downloads, self.max_uploads, self._cache
+            ):
+                writer.write(mon)
+                metrics.count("monuments", stage="mirror")
+
+        return self._upstream_done("mirror")
+
+    def _import(self) -> bool:
+        # the CSV shards of an import, their operations, the monuments in them
+        # and the products they touch
+        pending: Deque[Tuple[List[str], List[Any], List[str], Set[str]]] = deque()
+        rows: List[List[str]] = []
+        monuments: List[str] = []
+        products: Set[str] = set()
+        shards = 0
+
+        with Checkpoint(self.path("import.keys")) as keys:
+            if len(keys):
+                metrics.event("stage_resumed", stage="import", monuments=len(keys))
+
+            def finish():
+                uris, operations, done, _ = pending.popleft()
+                for uri, result in zip(uris, wait_for_imports(operations, self.poll)):
+                    report_import_result(result, uri)
+                keys.add(done)
+                metrics.count("monuments", len(done), stage="import")
+
+            def flush():
+                nonlocal rows, monuments, products, shards
+                if rows:
+                    # a product's rows together, since shards are only cut
+                    # between products
+                    rows.sort(key=lambda row: row[3])
+                    uris = write_csv_rows(
+                        rows, self.max_rows, f"{self._run_id}/{shards:05d}"
+                    )
+                    operations = [start_import(uri) for uri in uris]
+                    for uri, op in zip(uris, operations):
+                        metrics.event(
+                            "import_started", uri=uri, operation=op.operation.name
+                        )
+                    pending.append((uris, operations, monuments, products))
+                    shards += 1
+                else:
+                    # nothing to import for these
+                    keys.add(monuments)
+                    metrics.count("monuments", len(monuments), stage="import")
+                rows, monuments, products = [], [], set()
+
+            for mon in self._upstream("import"):
+                key = _monument_key(mon)
+                if key in keys or key in monuments:
+                    continue
+                # monuments with the same name are the same product: one that's
+                # still being imported is waited on, so two imports running at
+                # once never write the same product
+                while any(mon.slug in group[3] for group in pending):
+                    finish()
+                rows.extend(iter_csv_rows([_mirrored_only(mon)]))
+                monuments.append(key)
+                products.add(mon.slug)
+                if len(rows) >= self.max_rows:
+                    flush()
+                    while len(pending) >= self.max_imports:
+                        finish()
+                # record imports that are done without waiting on them
+                while pending and all(op.done() for op in pending[0][1]):
+                    finish()
+
+            if self._stop.is_set():
+                return False
+            flush()
+            while pending:
+                finish()
+
+        return self._upstream_done("import")
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m loca_vision.pipeline",
+        description="Crawls monuments in an area, picks and mirrors their images "
+        "and imports them into the product set, with checkpoints to resume from.",
+    )
+    parser.add_argument("--workdir", default="pipeline", help="where checkpoints go")
+    parser.add_argument(
+        "--bbox",
+        type=float,
+        nargs=4,
+        metavar=("SW_LAT", "SW_LON", "NE_LAT", "NE_LON"),
+        help="the area to crawl",
+    )
+    parser.add_argument(
+        "--stage",
+        choices=STAGES,
+        action="append",
+        help="run only this stage (can be repeated); by default all of them",
+    )
+    parser.add_argument(
+        "--resume", action="store_true", help="skip work done by earlier runs"
+    )
+    parser.add_argument("--crawl-workers", type=int, default=4)
+    parser.add_argument(
+        "--crawl-rate", type=float, default=10, help="Wikipedia requests per second"
+    )
+    parser.add_argument(
+        "--no-curate", action="store_true", help="mirror every image crawled"
+    )
+    parser.add_argument(
+        "--keep", type=int, default=KEEP, help="images kept per monument"
+    )
+    parser.add_argument(
+        "--curate-workers", type=int, help="decoding processes (one per CPU)"
+    )
+    parser.add_argument("--downloads", type=int, default=8, help="images at once")
+    parser.add_argument("--uploads", type=int, default=8, help="uploads at once")
+    parser.add_argument(
+        "--image-cache",
+        help="directory of the shared image cache (default: images/ in the "
+        "working directory, with curation)",
+    )
+    parser.add_argument(
+        "--max-rows", type=int, default=CSV_MAX_ROWS, help="rows per import CSV"
+    )
+    parser.add_argument("--imports", type=int, default=4, help="imports at once")
+    parser.add_argument(
+        "--poll", type=float, default=5.0, help="seconds between import checks"
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    sink = metrics.add_sink(metrics.LoggingSink())
+
+    bbox = None
+    if args.bbox:
+        bbox = (Coord(*args.bbox[:2]), Coord(*args.bbox[2:]))
+    pipeline = Pipeline(
+        args.workdir,
+        bbox,
+        crawl_workers=args.crawl_workers,
+        crawl_rate=args.crawl_rate,
+        curate=not args.no_curate,
+        keep=args.keep,
+        curate_workers=args.curate_workers,
+        max_downloads=args.downloads,
+        max_uploads=args.uploads,
+        image_cache=args.image_cache,
+        max_rows=args.max_rows,
+        max_imports=args.imports,
+        poll=args.poll,
+    )
+    try:
+        done = pipeline.run(args.stage, args.resume)
+    except KeyboardInterrupt:
+        print("stopped; run again with --resume to continue", file=sys.stderr)
+        return 130
+    finally:
+        metrics.remove_sink(sink)
+
+    for stage, error in pipeline.errors.items():
+        print(f"{stage} failed: {error!r}", file=sys.stderr)
+    return 0 if done else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
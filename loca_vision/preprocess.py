@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""Shrinking query images before they're sent to Product Search.
+
+Phone photos are several megabytes of pixels and metadata, while Product Search
+works on far smaller images, so uploading them as-is mostly costs latency. Here
+each image is decoded (JPEGs directly at reduced scale), rotated upright per its
+EXIF orientation, downscaled so its longest side is at most `MAX_SIDE`, and
+re-encoded as a metadata-free JPEG. The GPS position from the EXIF data is kept
+alongside, since it's stripped from the image itself."""
+
+from __future__ import annotations
+
+import io
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+from .coord import Coord
+
+# comfortably more detail than Product Search needs to match a landmark; see
+# benchmarks/bench_preprocess.py for the size and time tradeoff
+MAX_SIDE = 1024
+QUALITY = 85
+
+GPS_IFD = 0x8825
+
+# what PIL raises for data it can't decode (or won't, for decompression bombs)
+DECODE_ERRORS = (OSError, ValueError, Image.DecompressionBombError)
+
+
+class PreparedImage(NamedTuple):
+    """A query image ready to be sent."""
+
+    data: bytes
+    gps: Optional[Coord]
+    original_bytes: int
+    size: Tuple[int, int]
+
+
+def _degrees(dms, ref) -> float:
+    d, m, s = (float(x) for x in dms)
+    value = d + m / 60 + s / 3600
+    return -value if ref in ("S", "W") else value
+
+
+def exif_gps(image: Image.Image) -> Optional[Coord]:
+    """Where the photo was taken, if its EXIF data says."""
+    gps = image.getexif().get_ifd(GPS_IFD)
+    try:
+        lat = _degrees(gps[2], gps.get(1, "N"))
+        lon = _degrees(gps[4], gps.get(3, "E"))
+    except (KeyError, TypeError, ValueError, ZeroDivisionError):
+        return None
+
+    if lat == 0 and lon == 0:
+        # cameras without a fix write zeros
+        return None
+    return Coord(lat, lon)
+
+
+def prepare_image(
+    data: bytes, max_side: int = MAX_SIDE, quality: int = QUALITY
+) -> PreparedImage:
+    """Decodes, orients, downscales and re-encodes the image. Images that are
+    already small enough and upright are passed through untouched. Raises one
+    of `DECODE_ERRORS` for an image that can't be decoded."""
+    image = Image.open(io.BytesIO(data))
+    gps = exif_gps(image)
+    orientation = image.getexif().get(0x0112, 1)
+
+    if max(image.size) <= max_side and orientation == 1:
+        return PreparedImage(data, gps, len(data), image.size)
+
+    # let the JPEG decoder skip straight to the smallest scale that's still at
+    # least the target size
+    scale = max_side / max(image.size)
+    image.draft("RGB", (round(image.width * scale), round(image.height * scale)))
+    image = ImageOps.exif_transpose(image).convert("RGB")
+    image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=quality, optimize=True)
+    return PreparedImage(out.getvalue(), gps, len(data), image.size)
+
+
+def _prepare(args) -> PreparedImage:
+    return prepare_image(*args)
+
+
+def prepare_images(
+    images: Iterable[bytes],
+    max_side: int = MAX_SIDE,
+    quality: int = QUALITY,
+    workers: Optional[int] = None,
+) -> List[PreparedImage]:
+    """Prepares many images in a process pool of `workers` processes (by default
+    one per CPU), returning them in input order."""
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_prepare, ((data, max_side, quality) for data in images)))
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""A thread-safe token bucket for keeping outbound requests under a rate."""
+
+from __future__ import annotations
+
+import threading
+import time
+
+
+class RateLimiter:
+    """Allows `rate` acquisitions per second on average, and bursts of up to
+    `burst` at once."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Takes a token, and returns how many seconds the caller must wait before
+        using it. Never blocks, so it can be used from asyncio code as well."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._last) * self.rate
+            )
+            self._last = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        """Blocks until a token is available."""
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""Recognizing products locally from reference images on disk, before asking
+Product Search.
+
+The reference images are laid out one directory per product, like
+`test_reference/<product-id>/*.jpg`. Indexing each one keeps two things:
+
+- its perceptual hash, which catches near-identical photos outright, and
+- a few hundred local descriptors: gradient orientation histograms (in the style
+  of SIFT, but upright) around the strongest corners, at a few scales.
+
+A query's descriptors are each compared with every product's, all at once as a
+matrix product. A descriptor votes for the product it matches best, if that
+match is close in absolute terms (`MIN_SIMILARITY`) and clearly better than the
+best match in any other product (Lowe's ratio test). A product's score is its
+share of the votes, and its coverage is the share of the query's descriptors
+that voted for it. That is robust to the viewpoint, lighting and framing
+changes between a user's photo and the reference photos, which whole-image
+descriptors aren't.
+
+The score alone only says which product the query is most like, not whether it
+is any of them: a photo of something else still splits its few chance matches
+between the products. `recognize` therefore answers from the index only when
+the top product also has enough votes and coverage, and otherwise falls back to
+`gcloud.get_similar_products_file`. See benchmarks/bench_recognition.py for
+accuracy, false accepts and latency."""
+
+from __future__ import annotations
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from PIL import Image
+
+from . import metrics
+from .imagehash import hamming, open_image, phash
+
+# images are described at this size (longest side), and then at smaller scales
+SIDE = 320
+SCALES = (1.0, 0.7, 0.5)
+KEYPOINTS = 250
+PATCH = 24
+
+# a descriptor's best match must be this much closer than the best match in any
+# other product to count as a vote
+RATIO = 0.8
+
+# and at least this similar (the cosine of the descriptors); chance matches
+# between unrelated images mostly fall below it
+MIN_SIMILARITY = 0.8
+
+# hashes this close are the same photo
+NEAR_DUPLICATE = 6
+
+# chunk of indexed descriptors compared at once, to bound memory
+CHUNK = 16384
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+
+class LocalMatch(NamedTuple):
+    """A product the query looks like. `score` is its share of the votes and
+    `coverage` the share of the query's descriptors that voted for it; both are
+    1.0 for a near-duplicate of one of its reference images."""
+
+    product: str
+    score: float
+    votes: int
+    coverage: float
+
+
+class Recognition(NamedTuple):
+    """Where the answer came from ("local" or "cloud") and the matches: a list of
+    `LocalMatch`es, or Product Search's results."""
+
+    source: str
+    matches: List[Any]
+
+
+def _box_sum(a: np.ndarray, r: int) -> np.ndarray:
+    """The sum over the (2r+1)-square window around each pixel."""
+    k = 2 * r + 1
+    c = np.pad(a, r + 1, mode="edge").cumsum(0).cumsum(1)
+    return c[k:, k:] - c[:-k, k:] - c[k:, :-k] + c[:-k, :-k]
+
+
+def _describe_scale(
+    gray: np.ndarray, n: int = KEYPOINTS, patch: int = PATCH
+) -> np.ndarray:
+    gy, gx = np.gradient(gray)
+
+    # Harris corner response, and its local maxima away from the border
+    sxx, syy, sxy = _box_sum(gx * gx, 2), _box_sum(gy * gy, 2), _box_sum(gx * gy, 2)
+    response = sxx * syy - sxy * sxy - 0.05 * (sxx + syy) ** 2
+    margin = patch // 2 + 1
+    response[:margin] = response[-margin:] = 0
+    response[:, :margin] = response[:, -margin:] = 0
+    peaks = sliding_window_view(np.pad(response, 3), (7, 7)).max(axis=(2, 3))
+    ys, xs = np.nonzero((response == peaks) & (response > 0))
+    strongest = np.argsort(response[ys, xs])[::-1][:n]
+    ys, xs = ys[strongest], xs[strongest]
+
+    # 4x4 cells of 8 orientation bins over the patch around each corner
+    magnitude = np.hypot(gx, gy)
+    orientation = (np.arctan2(gy, gx) % (2 * np.pi) / (2 * np.pi) * 8).astype(int) % 8
+    offsets = np.arange(patch) - patch // 2
+    rows = ys[:, None, None] + offsets[None, :, None]
+    cols = xs[:, None, None] + offsets[None, None, :]
+    cell = (offsets + patch // 2) // (patch // 4)
+    bins = (cell[:, None] * 4 + cell[None, :]) * 8 + orientation[rows, cols]
+    flat = (np.arange(len(ys))[:, None, None] * 128 + bins).ravel()
+    d = np.bincount(flat, magnitude[rows, cols].ravel(), len(ys) * 128)
+    # (bincount of nothing is an integer array)
+    d = d.reshape(len(ys), 128).astype(np.float64)
+
+    # normalized, clipped and normalized again, as SIFT does against lighting
+    d /= np.linalg.norm(d, axis=1, keepdims=True) + 1e-9
+    np.minimum(d, 0.2, out=d)
+    d /= np.linalg.norm(d, axis=1, keepdims=True) + 1e-9
+    return d.astype(np.float32)
+
+
+def describe(data: Union[bytes, Image.Image]) -> Tuple[int, np.ndarray]:
+    """The perceptual hash and local descriptors (one per row) of the image."""
+    image = open_image(data, SIDE)
+    h = phash(image)
+    gray = image.convert("L")
+    gray.thumbnail((SIDE, SIDE), Image.Resampling.LANCZOS)
+
+    descriptors = []
+    for scale in SCALES:
+        size = (max(48, round(gray.width * scale)), max(48, round(gray.height * scale)))
+        pixels = np.asarray(gray.resize(size, Image.Resampling.BILINEAR), np.float32)
+        descriptors.append(_describe_scale(pixels))
+    return h, np.concatenate(descriptors)
+
+
+def _describe_file(path: str) -> Tuple[int, np.ndarray]:
+    with open(path, "rb") as f:
+        return describe(f.read())
+
+
+class LocalIndex:
+    """Descriptors of the reference images of every product, grouped by product:
+    those of product `i` are `descriptors[starts[i]:starts[i + 1]]`."""
+
+    def __init__(
+        self,
+        products: Sequence[str],
+        starts: np.ndarray,
+        descriptors: np.ndarray,
+        hashes: np.ndarray,
+        hash_products: np.ndarray,
+    ):
+        self.products = list(products)
+        self.starts = np.asarray(starts, np.int64)
+        self.descriptors = np.asarray(descriptors, np.float32)
+        self.hashes = np.asarray(hashes, np.uint64)
+        self.hash_products = np.asarray(hash_products, np.int64)
+
+    def __len__(self) -> int:
+        return len(self.products)
+
+    @property
+    def nbytes(self) -> int:
+        return self.descriptors.nbytes + self.hashes.nbytes + self.starts.nbytes
+
+    @classmethod
+    def build(cls, root: str, workers: Optional[int] = None) -> LocalIndex:
+        """Indexes every image under `root/<product>/`, describing them in a
+        process pool of `workers` processes (by default one per CPU)."""
+        products, paths, owners = [], [], []
+        for product in sorted(os.listdir(root)):
+            directory = os.path.join(root, product)
+            if not os.path.isdir(directory):
+                continue
+            files = sorted(
+                name
+                for name in os.listdir(directory)
+                if name.lower().endswith(IMAGE_EXTENSIONS)
+            )
+            if files:
+                owners.extend([len(products)] * len(files))
+                paths.extend(os.path.join(directory, name) for name in files)
+                products.append(product)
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            described = list(pool.map(_describe_file, paths))
+
+        # the paths are grouped by product, so the descriptors are too; products
+        # without a single corner in any image are left out
+        sizes = np.bincount(
+            owners, [len(d) for _, d in described], minlength=len(products)
+        ).astype(np.int64)
+        keep = np.flatnonzero(sizes)
+        renumber = np.cumsum(sizes > 0) - 1
+        kept = [i for i, owner in enumerate(owners) if sizes[owner]]
+        return cls(
+            [products[i] for i in keep],
+            np.concatenate([[0], np.cumsum(sizes[keep])[:-1]]).astype(np.int64),
+            np.concatenate([described[i][1] for i in kept] or [np.zeros((0, 128))]),
+            np.array([described[i][0] for i in kept], np.uint64),
+            np.array([renumber[owners[i]] for i in kept], np.int64),
+        )
+
+    def save(self, path: str):
+        """Writes the index as a compressed `.npz`, with descriptors as float16."""
+        np.savez_compressed(
+            path,
+            products=np.array(self.products),
+            starts=self.starts,
+            descriptors=self.descriptors.astype(np.float16),
+            hashes=self.hashes,
+            hash_products=self.hash_products,
+        )
+
+    @classmethod
+    def load(cls, path: str) -> LocalIndex:
+        with np.load(path) as f:
+            return cls(
+                [str(p) for p in f["products"]],
+                f["starts"],
+                f["descriptors"],
+                f["hashes"],
+                f["hash_products"],
+            )
+
+    def _best_per_product(self, query: np.ndarray) -> np.ndarray:
+        """The similarity of each query descriptor to its best match in each
+        product, as a (descriptors, products) array."""
+        best = np.empty((len(query), len(self.products)), np.float32)
+        bounds = list(self.starts) + [len(self.descriptors)]
+        first = 0
+        while first < len(self.products):
+            # whole products at a time, about `CHUNK` descriptors
+            last = first + 1
+            while (
+                last < len(self.products) and bounds[last + 1] - bounds[first] <= CHUNK
+            ):
+                last += 1
+            chunk = self.descriptors[bounds[first] : bounds[last]]
+            similarity = query @ chunk.T
+            best[:, first:last] = np.maximum.reduceat(
+                similarity, np.array(bounds[first:last]) - bounds[first], axis=1
+            )
+            first = last
+        return best
+
+    def match(self, data: Union[bytes, Image.Image], k: int = 3) -> List[LocalMatch]:
+        """The `k` products the image looks most like, best first."""
+        if not self.products:
+            return []
+        h, query = describe(data)
+        if not len(query):
+            return []
+
+        distances = np.array([hamming(h, int(x)) for x in self.hashes])
+        if len(distances) and distances.min() <= NEAR_DUPLICATE:
+            product = self.products[self.hash_products[distances.argmin()]]
+            return [LocalMatch(product, 1.0, len(query), 1.0)]
+
+        if len(self.products) == 1:
+            # nothing to compare against but the next best descriptor
+            top = -np.partition(-(query @ self.descriptors.T), 1, axis=1)[:, :2]
+            winner = np.zeros(len(query), np.int64)
+        else:
+            best = self._best_per_product(query)
+            order = np.argsort(-best, axis=1)[:, :2]
+            top = np.take_along_axis(best, order, axis=1)
+            winner = order[:, 0]
+
+        # unit vectors, so distance follows from similarity
+        d1, d2 = np.sqrt(np.maximum(0, 2 - 2 * top)).T
+        voted = (d1 < RATIO * d2) & (top[:, 0] >= MIN_SIMILARITY)
+        votes = np.bincount(winner[voted], minlength=len(self.products))
+
+        total = max(1, int(votes.sum()))
+        ranked = np.argsort(-votes, kind="stable")[:k]
+        return [
+            LocalMatch(
+                self.products[i],
+                float(votes[i] / total),
+                int(votes[i]),
+                float(votes[i] / len(query)),
+            )
+            for i in ranked
+            if votes[i] > 0
+        ]
+
+
+def recognize(
+    b64: str,
+    index: LocalIndex,
+    k: int = 3,
+    min_votes: int = 15,
+    min_score: float = 0.6,
+    min_coverage: float = 0.025,
+    filter: Optional[str] = None,
+    max_results: int = 10,
+    **kwargs,
+) -> Recognition:
+    """Recognizes the base64 image locally if the index is confident (the top
+    product has at least `min_votes` votes, `min_score` of them, and the votes
+    of `min_coverage` of the query's descriptors), and with
+    `gcloud.get_similar_products_file` otherwise, passing on `filter`,
+    `max_results` and any other keyword arguments."""
+    from .gcloud import decode_base64_image, get_similar_products_file
+
+    with metrics.timer("request_seconds", service="local_recognition"):
+        try:
+            matches = index.match(decode_base64_image(b64), k)
+        except OSError:
+            # not an image PIL can decode; let the API have a go at it
+            matches = []
+
+    top = matches[0] if matches else None
+    if (
+        top
+        and top.votes >= min_votes
+        and top.score >= min_score
+        and top.coverage >= min_coverage
+    ):
+        metrics.count("recognitions", tier="local")
+        return Recognition("local", matches)
+
+    metrics.count("recognitions", tier="cloud")
+    return Recognition(
+        "cloud", get_similar_products_file(b64, filter, max_results, **kwargs)
+    )
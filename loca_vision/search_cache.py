@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""A cache of product search results keyed on what the query image looks like.
+
+Users often send the same landmark several times in a row (burst shots,
+retries), and those photos have nearly identical perceptual hashes. Results are
+stored under the hash together with the search's `filter` and `max_results`,
+and a lookup matches any entry whose hash is at most `tolerance` bits away.
+
+To find those without comparing against every entry, each hash is split into
+`tolerance + 1` bands: two hashes within `tolerance` bits must agree exactly on
+at least one band, so only entries sharing a band need checking.
+
+Results are only valid for one version of the product set index, so the whole
+cache is dropped whenever a search reports a different `index_time`."""
+
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, NamedTuple, Optional, Set, Tuple
+
+from .imagehash import HASH_BITS, hamming
+
+Key = Tuple[int, Optional[str], Optional[int]]
+
+
+class _Entry(NamedTuple):
+    results: Any
+    index_time: Any
+    created: float
+
+
+class SearchCache:
+    """An LRU cache of search results with a TTL (in seconds) and a Hamming
+    distance tolerance. Safe to share between threads."""
+
+    def __init__(self, tolerance: int = 4, ttl: float = 3600, max_entries: int = 4096):
+        self.tolerance = tolerance
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.index_time = None
+
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[Key, _Entry] = OrderedDict()
+        self._bands: Dict[Tuple[Hashable, ...], Set[Key]] = {}
+
+        n = tolerance + 1
+        widths = [HASH_BITS // n + (i < HASH_BITS % n) for i in range(n)]
+        self._shifts = [sum(widths[i + 1 :]) for i in range(n)]
+        self._masks = [(1 << w) - 1 for w in widths]
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "invalidations": self.invalidations,
+        }
+
+    def _band_keys(self, key: Key) -> List[Tuple[Hashable, ...]]:
+        h, filter, max_results = key
+        return [
+            (i, (h >> shift) & mask, filter, max_results)
+            for i, (shift, mask) in enumerate(zip(self._shifts, self._masks))
+        ]
+
+    def _remove(self, key: Key):
+        del self._entries[key]
+        for band in self._band_keys(key):
+            keys = self._bands[band]
+            keys.discard(key)
+            if not keys:
+                del self._bands[band]
+
+    def get(self, h: int, filter: Optional[str], max_results: Optional[int]) -> Any:
+        """The cached results for an image with perceptual hash `h`, or `None`."""
+        now = time.monotonic()
+        key = (h, filter, max_results)
+        with self._lock:
+            if key in self._entries:
+                candidates = [key]
+            else:
+                candidates = {
+                    k
+                    for band in self._band_keys(key)
+                    for k in self._bands.get(band, ())
+                    if hamming(k[0], h) <= self.tolerance
+                }
+                candidates = sorted(candidates, key=lambda k: hamming(k[0], h))
+
+            for k in candidates:
+                entry = self._entries[k]
+                if now - entry.created > self.ttl:
+                    self._remove(k)
+                    continue
+                self._entries.move_to_end(k)
+                self.hits += 1
+                return entry.results
+
+            self.misses += 1
+            return None
+
+    def put(
+        self,
+        h: int,
+        filter: Optional[str],
+        max_results: Optional[int],
+        results: Any,
+        index_time: Any = None,
+    ):
+        """Stores the results of a live search, first dropping everything if the
+        search saw a different index than the cached results did."""
+        self.check_index_time(index_time)
+        key = (h, filter, max_results)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = _Entry(results, index_time, time.monotonic())
+            for band in self._band_keys(key):
+                self._bands.setdefault(band, set()).add(key)
+
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def check_index_time(self, index_time: Any):
+        """Drops every entry if the product set was reindexed since they were stored."""
+        if index_time is None:
+            return
+        with self._lock:
+            if self.index_time is not None and index_time != self.index_time:
+                self._entries.clear()
+                self._bands.clear()
+                self.invalidations += 1
+            self.index_time = index_time
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bands.clear()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""An in-process spatial index for answering "what's near here?" locally.
+
+Points are bucketed into a grid of `cell_deg` by `cell_deg` degree cells. A
+radius query only looks at the cells the circle's bounding box touches and then
+computes exact distances for those candidates with NumPy; a nearest-neighbor
+query grows a radius query until it has enough hits. Anything can be indexed,
+but `from_monuments` and `from_json_file` cover the usual case."""
+
+from __future__ import annotations
+
+import json
+import math
+from typing import Dict, Generic, Iterable, List, Sequence, Tuple, TypeVar
+
+import numpy as np
+
+from .coord import EARTH_RADIUS, Coord
+from .coord_array import CoordArray, haversine
+from .wiki_monument import WikiMonument
+
+T = TypeVar("T")
+
+HALF_CIRCUMFERENCE = math.pi * EARTH_RADIUS
+
+
+class SpatialIndex(Generic[T]):
+    """A grid index of items by location, supporting incremental inserts."""
+
+    def __init__(self, cell_deg: float = 0.05):
+        self.cell_deg = cell_deg
+        self._cols = math.ceil(360 / cell_deg)
+        self._rows = math.ceil(180 / cell_deg)
+        self._lat = np.empty(1024)
+        self._lon = np.empty(1024)
+        self._items: List[T] = []
+        self._cells: Dict[int, List[int]] = {}
+        self._frozen: Dict[int, np.ndarray] = {}
+
+    @classmethod
+    def from_monuments(
+        cls, monuments: Iterable[WikiMonument], **kwargs
+    ) -> SpatialIndex[WikiMonument]:
+        monuments = list(monuments)
+        index = cls(**kwargs)
+        index.extend(CoordArray.from_monuments(monuments), monuments)
+        return index
+
+    @classmethod
+    def from_json_file(cls, path: str, **kwargs) -> SpatialIndex[WikiMonument]:
+        """Indexes a monuments JSON file, as written by `test.py`."""
+        with open(path, "r") as f:
+            return cls.from_monuments(
+                map(WikiMonument.from_json, json.load(f)), **kwargs
+            )
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def _cell_rows(self, lat):
+        return np.clip(
+            ((lat + 90) // self.cell_deg).astype(np.int64), 0, self._rows - 1
+        )
+
+    def _cell_cols(self, lon):
+        return ((lon + 180) // self.cell_deg).astype(np.int64) % self._cols
+
+    def _reserve(self, n: int):
+        if n > len(self._lat):
+            size = max(n, 2 * len(self._lat))
+            self._lat = np.resize(self._lat, size)
+            self._lon = np.resize(self._lon, size)
+
+    def insert(self, coord: Coord, item: T):
+        self.extend(CoordArray([coord.lat], [coord.lon]), [item])
+
+    def extend(self, coords: CoordArray, items: Sequence[T]):
+        """Adds many items at once, which is much faster than inserting them one by
+        one."""
+        if len(coords) != len(items):
+            raise ValueError("need exactly one coordinate per item")
+
+        start = len(self._items)
+        self._reserve(start + len(items))
+        self._lat[start : start + len(items)] = coords.lat
+        self._lon[start : start + len(items)] = coords.lon
+        self._items.extend(items)
+
+        keys = self._cell_rows(coords.lat) * self._cols + self._cell_cols(coords.lon)
+        order = np.argsort(keys, kind="stable")
+        unique, first = np.unique(keys[order], return_index=True)
+        for key, group in zip(unique.tolist(), np.split(order + start, first[1:])):
+            self._cells.setdefault(key, []).extend(group.tolist())
+            self._frozen.pop(key, None)
+
+    def _cell(self, key: int) -> np.ndarray:
+        ids = self._frozen.get(key)
+        if ids is None:
+            ids = self._frozen[key] = np.array(self._cells[key], dtype=np.int64)
+        return ids
+
+    def _candidates(self, coord: Coord, radius: float) -> np.ndarray:
+        """IDs of every item in a cell touched by the circle's bounding box."""
+        n = len(self._items)
+        dlat = math.degrees(radius / EARTH_RADIUS)
+        south, north = coord.lat - dlat, coord.lat + dlat
+        if south <= -90 or north >= 90:
+            dlon = 180.0
+        else:
+            dlon = dlat / math.cos(math.radians(max(abs(south), abs(north))))
+
+        rows = range(
+            int(self._cell_rows(np.array([south]))[0]),
+            int(self._cell_rows(np.array([north]))[0]) + 1,
+        )
+        if dlon >= 180:
+            cols = range(self._cols)
+        else:
+            first = math.floor((coord.lon - dlon + 180) / self.cell_deg)
+            last = math.floor((coord.lon + dlon + 180) / self.cell_deg)
+            cols = [
+                c % self._cols
+                for c in range(first, min(last, first + self._cols - 1) + 1)
+            ]
+
+        if len(rows) * len(cols) > len(self._cells):
+            # cheaper to go through the non-empty cells than the ones in the box
+            cols = set(cols)
+            keys = [
+                key
+                for key in self._cells
+                if rows.start <= key // self._cols < rows.stop
+                and key % self._cols in cols
+            ]
+        else:
+            keys = [
+                key
+                for key in (row * self._cols + col for row in rows for col in cols)
+                if key in self._cells
+            ]
+
+        if len(keys) == len(self._cells):
+            return np.arange(n)
+        if not keys:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([self._cell(key) for key in keys])
+
+    def _query(self, coord: Coord, radius: float) -> Tuple[np.ndarray, np.ndarray]:
+        """IDs and distances of the items within the radius, nearest first."""
+        ids = self._candidates(coord, radius)
+        d = haversine(
+            math.radians(coord.lat),
+            math.radians(coord.lon),
+            np.radians(self._lat[ids]),
+            np.radians(self._lon[ids]),
+        )
+        hits = d <= radius
+        ids, d = ids[hits], d[hits]
+        order = np.argsort(d, kind="stable")
+        return ids[order], d[order]
+
+    def within(self, coord: Coord, radius: float) -> List[Tuple[T, float]]:
+        """Every item no more than `radius` meters from the point, with its distance,
+        nearest first."""
+        ids, d = self._query(coord, radius)
+        return [(self._items[i], dist) for i, dist in zip(ids.tolist(), d.tolist())]
+
+    def nearest(self, coord: Coord, k: int = 1) -> List[Tuple[T, float]]:
+        """The `k` items nearest the point, with their distances, nearest first."""
+        radius = self.cell_deg * math.pi / 180 * EARTH_RADIUS
+        while True:
+            ids, d = self._query(coord, radius)
+            if len(ids) >= k or radius >= HALF_CIRCUMFERENCE:
+                break
+            radius *= 2
+
+        return [
+            (self._items[i], dist) for i, dist in zip(ids[:k].tolist(), d[:k].tolist())
+        ]
@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+"""Incremental updates of the product set from the monument list.
+
+A manifest file records what's already in the product set: each product's
+display name and labels, and its reference images by ID and URI (the IDs come
+from the images' contents, see `gcloud.reference_image_id`, so an image
+replaced at the same URI is replaced in the product set too).
+Syncing diffs the manifest against the monuments and applies only the
+difference, so a refresh costs as much as what changed rather than as much as
+the whole catalog:
+
+- new products and images are created with `mutations.execute`, which imports
+  them from a CSV when there are many (images the mirror couldn't copy into
+  Cloud Storage are skipped, since Product Search only takes those);
+- products whose name or labels changed are patched;
+- images and products that are no longer there are deleted.
+
+The manifest is only updated with what actually succeeded, so a failed sync is
+simply retried by the next one."""
+
+from __future__ import annotations
+
+import json
+import os
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+from . import metrics
+from .clients import product_search_client
+from .gcloud import (
+    CONTENT_URI,
+    CSV_MAX_ROWS,
+    blob_content_hashes,
+    label_key_values,
+    product_labels,
+    product_path,
+    product_set_path,
+    reference_image_id,
+    reference_image_path,
+)
+from .mutations import (
+    AddToProductSet,
+    CreateProduct,
+    CreateReferenceImage,
+    Mutation,
+    execute,
+)
+from .wiki_monument import WikiMonument
+
+MANIFEST_VERSION = 1
+
+
+class ProductState(NamedTuple):
+    """A product as the product set has it."""
+
+    display_name: str
+    labels: str
+    # reference image ID -> image URI
+    images: Dict[str, str]
+
+    @classmethod
+    def from_json(cls, json: dict) -> ProductState:
+        return cls(json["display_name"], json["labels"], dict(json["images"]))
+
+    def to_json(self) -> dict:
+        return {
+            "display_name": self.display_name,
+            "labels": self.labels,
+            "images": self.images,
+        }
+
+
+class Diff(NamedTuple):
+    """What needs to change to bring the product set in line with the monuments."""
+
+    # (product ID, reference image ID, URI) of images to import, creating their
+    # products as needed
+    add_images: List[Tuple[str, str, str]]
+    # product IDs whose display name or labels changed
+    update_products: List[str]
+    # (product ID, reference image ID) of images no longer used
+    delete_images: List[Tuple[str, str]]
+    # products with no monument left
+    delete_products: List[str]
+
+    def __len__(self) -> int:
+        return sum(len(field) for field in self)
+
+    def summary(self) -> str:
+        return (
+            f"{len(self.add_images)} images to add, "
+            f"{len(self.update_products)} products to update, "
+            f"{len(self.delete_images)} images to delete, "
+            f"{len(self.delete_products)} products to delete"
+        )
+
+
+class SyncReport(NamedTuple):
+    """What a sync did, with the operations that failed and why, and the
+    `(product ID, URL)` of images skipped because they aren't in Cloud
+    Storage."""
+
+    diff: Diff
+    applied: int
+    errors: List[Tuple[str, str]]
+    skipped: Sequence[Tuple[str, str]] = ()
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+
+def desired_state(
+    monuments: Iterable[WikiMonument],
+    skipped: Optional[List[Tuple[str, str]]] = None,
+    hashes: Optional[Dict[str, str]] = None,
+) -> Dict[str, ProductState]:
+    """The products the monuments should become. Monuments with the same slug
+    share a product, as they do in the import CSV. `hashes` are the content
+    hashes of images not stored under them, by URI (see
+    `gcloud.blob_content_hashes`).
+
+    Only images in Cloud Storage can be reference images, so any others (left
+    as source URLs when the mirror failed to copy them) are left out, and added
+    to `skipped` as `(product ID, URL)` if given."""
+    hashes = hashes or {}
+    products: Dict[str, ProductState] = {}
+    for mon in monuments:
+        product = products.setdefault(
+            mon.slug, ProductState(mon.name, product_labels(mon), {})
+        )
+        for uri in mon.image_urls:
+            if uri.startswith("gs://"):
+                product.images[reference_image_id(uri, hashes.get(uri))] = uri
+            elif skipped is not None:
+                skipped.append((mon.slug, uri))
+    return products
+
+
+def diff(
+    current: Dict[str, ProductState], desired: Dict[str, ProductState]
+) -> Diff:
+    """The changes from the `current` products to the `desired` ones."""
+    result = Diff([], [], [], [])
+    for pid, want in desired.items():
+        have = current.get(pid)
+        if have is None:
+            result.add_images.extend(
+                (pid, image_id, uri) for image_id, uri in want.images.items()
+            )
+            continue
+
+        if (have.display_name, have.labels) != (want.display_name, want.labels):
+            result.update_products.append(pid)
+        result.add_images.extend(
+            (pid, image_id, uri)
+            for image_id, uri in want.images.items()
+            if image_id not in have.images
+        )
+        result.delete_images.extend(
+            (pid, image_id) for image_id in have.images if image_id not in want.images
+        )
+
+    result.delete_products.extend(pid for pid in current if pid not in desired)
+    return result
+
+
+class Manifest:
+    """The products known to be in the product set, saved as JSON at `path`."""
+
+    def __init__(self, path: str):
+        self.path = path
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            data = {"version": MANIFEST_VERSION, "products": {}}
+
+        if data.get("version") != MANIFEST_VERSION:
+            raise ValueError(f"Unsupported manifest version in {path}")
+        self.products = {
+            pid: ProductState.from_json(product)
+            for pid, product in data["products"].items()
+        }
+
+    def save(self):
+        """Writes the manifest, atomically so a crash leaves the old one intact."""
+        data = {
+            "version": MANIFEST_VERSION,
+            "products": {pid: p.to_json() for pid, p in sorted(self.products.items())},
+        }
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=1)
+        os.replace(self.path + ".tmp", self.path)
+
+
+def pull_manifest(path: str) -> Manifest:
+    """Builds the manifest from what's actually in the product set, for a first
+    sync of a set that was imported before, or after the manifest was lost."""
+    client = product_search_client()
+
+    manifest = Manifest(path)
+    manifest.products = {}
+    for product in client.list_products_in_product_set(name=product_set_path()):
+        pid = product.name.split("/")[-1]
+        labels = ",".join(f"{kv.key}={kv.value}" for kv in product.product_labels)
+        images = {
+            image.name.split("/")[-1]: image.uri
+            for image in client.list_reference_images(parent=product.name)
+        }
+        manifest.products[pid] = ProductState(product.display_name, labels, images)
+
+    manifest.save()
+    return manifest
+
+
+def _add(
+    manifest: Manifest,
+    desired: Dict[str, ProductState],
+    adds: List[Tuple[str, str, str]],
+    max_rows: int,
+    poll: float,
+    errors: List[Tuple[str, str]],
+) -> int:
+    batch: List[Mutation] = []
+    for pid in dict.fromkeys(pid for pid, _, _ in adds):
+        if pid not in manifest.products:
+            want = desired[pid]
+            batch.append(CreateProduct(pid, want.display_name, want.labels))
+    batch.extend(
+        CreateReferenceImage(
+            pid, uri, image_id, desired[pid].display_name, desired[pid].labels
+        )
+        for pid, image_id, uri in adds
+    )
+
+    results = execute(batch, max_rows=max_rows, poll=poll)
+
+    # a new product is only searchable once it's in the set, so one that didn't
+    # get in is left out of the manifest altogether: the next sync creates it
+    # again (which finds it and its images already there) and retries that
+    unlisted = {
+        r.mutation.product_id
+        for r in results
+        if isinstance(r.mutation, AddToProductSet) and not r.ok
+    }
+
+    applied = 0
+    for result in results:
+        m = result.mutation
+        if not result.ok:
+            errors.append((f"add {type(m).__name__} {m.product_id}", result.error))
+            continue
+        if m.product_id in unlisted:
+            continue
+        if isinstance(m, CreateProduct):
+            manifest.products.setdefault(
+                m.product_id, ProductState(m.display_name, m.labels, {})
+            )
+        elif isinstance(m, CreateReferenceImage):
+            want = desired[m.product_id]
+            have = manifest.products.setdefault(
+                m.product_id, ProductState(want.display_name, want.labels, {})
+            )
+            have.images[m.image_id] = m.uri
+            applied += 1
+    return applied
+
+
+def _update_product(client, pid: str, want: ProductState):
+    from google.cloud import vision
+
+    product = vision.Product(
+        name=product_path(pid),
+        display_name=want.display_name,
+        product_labels=label_key_values(want.labels),
+    )
+    client.update_product(
+        product=product, update_mask={"paths": ["display_name", "product_labels"]}
+    )
+
+
+def apply_diff(
+    manifest: Manifest,
+    desired: Dict[str, ProductState],
+    changes: Diff,
+    max_rows: int = CSV_MAX_ROWS,
+    poll: float = 5.0,
+) -> SyncReport:
+    """Applies the changes to the product set, recording in the manifest each one
+    that succeeds. The manifest is saved even if some fail."""
+    from google.api_core.exceptions import GoogleAPICallError, NotFound
+
+    client = product_search_client()
+    errors: List[Tuple[str, str]] = []
+    applied = 0
+
+    try:
+        if changes.add_images:
+            applied += _add(
+                manifest, desired, changes.add_images, max_rows, poll, errors
+            )
+
+        for pid in changes.update_products:
+            try:
+                _update_product(client, pid, desired[pid])
+            except GoogleAPICallError as e:
+                errors.append((f"update {pid}", str(e)))
+                continue
+            have = manifest.products[pid]
+            manifest.products[pid] = have._replace(
+                display_name=desired[pid].display_name, labels=desired[pid].labels
+            )
+            applied += 1
+
+        for pid, image_id in changes.delete_images:
+            try:
+                client.delete_reference_image(name=reference_image_path(pid, image_id))
+            except NotFound:
+                pass
+            except GoogleAPICallError as e:
+                errors.append((f"delete {pid}/{image_id}", str(e)))
+                continue
+            del manifest.products[pid].images[image_id]
+            applied += 1
+
+        for pid in changes.delete_products:
+            try:
+                client.delete_product(name=product_path(pid))
+            except NotFound:
+                pass
+            except GoogleAPICallError as e:
+                errors.append((f"delete {pid}", str(e)))
+                continue
+            del manifest.products[pid]
+            applied += 1
+    finally:
+        manifest.save()
+
+    return SyncReport(changes, applied, errors)
+
+
+def sync_product_set(
+    monuments: Iterable[WikiMonument],
+    manifest_path: str = "product-set.json",
+    max_rows: int = CSV_MAX_ROWS,
+    poll: float = 5.0,
+    dry_run: bool = False,
+) -> SyncReport:
+    """Brings the product set in line with the monuments, changing only what
+    differs from the manifest. With `dry_run`, only works out the changes."""
+    manifest = Manifest(manifest_path)
+    monuments = list(monuments)
+    hashes = blob_content_hashes(
+        uri
+        for mon in monuments
+        for uri in mon.image_urls
+        if uri.startswith("gs://") and not CONTENT_URI.search(uri)
+    )
+    skipped: List[Tuple[str, str]] = []
+    desired = desired_state(monuments, skipped, hashes)
+    changes = diff(manifest.products, desired)
+    metrics.event(
+        "sync_diff",
+        add_images=len(changes.add_images),
+        update_products=len(changes.update_products),
+        delete_images=len(changes.delete_images),
+        delete_products=len(changes.delete_products),
+        skipped_images=len(skipped),
+    )
+    for pid, url in skipped:
+        metrics.event("sync_skipped", product=pid, source=url)
+
+    if dry_run or not len(changes):
+        return SyncReport(changes, 0, [], skipped)
+
+    report = apply_diff(manifest, desired, changes, max_rows, poll)
+    for op, error in report.errors:
+        metrics.event("sync_failed", operation=op, error=error)
+    return report._replace(skipped=skipped)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""Covering regions of the map with circular search tiles.
+
+Circles of radius r centered on a hexagonal lattice with spacing r√3 cover the
+plane with the least overlap of any circle packing, so that's what we lay over
+the region. Distances use a local equirectangular projection, which is plenty
+accurate at the scale of a single search radius."""
+
+from __future__ import annotations
+
+import math
+from typing import List, Sequence, Tuple
+
+from .coord import EARTH_RADIUS, Coord
+
+# shrink the lattice a little so the projection error can't open gaps
+SAFETY = 0.95
+
+
+def _project(origin: Coord, coord: Coord) -> Tuple[float, float]:
+    """Meters east and north of the origin."""
+    x = math.radians(coord.lon - origin.lon) * math.cos(math.radians(origin.lat))
+    y = math.radians(coord.lat - origin.lat)
+    return x * EARTH_RADIUS, y * EARTH_RADIUS
+
+
+def _segment_distance(p, a, b) -> float:
+    """Distance from the point `p` to the segment `ab`, in the plane."""
+    (px, py), (ax, ay), (bx, by) = p, a, b
+    dx, dy = bx - ax, by - ay
+    length = dx * dx + dy * dy
+    t = (
+        0.0
+        if length == 0
+        else max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / length))
+    )
+    return math.hypot(px - ax - t * dx, py - ay - t * dy)
+
+
+def contains(polygon: Sequence[Coord], coord: Coord) -> bool:
+    """Whether the point is inside the polygon, by ray casting."""
+    inside = False
+    for a, b in zip(polygon, [*polygon[1:], polygon[0]]):
+        if (a.lat > coord.lat) != (b.lat > coord.lat):
+            lon = a.lon + (coord.lat - a.lat) / (b.lat - a.lat) * (b.lon - a.lon)
+            if coord.lon < lon:
+                inside = not inside
+    return inside
+
+
+def intersects(polygon: Sequence[Coord], center: Coord, radius: float) -> bool:
+    """Whether the circle overlaps the polygon at all."""
+    if contains(polygon, center):
+        return True
+
+    points = [_project(center, v) for v in polygon]
+    return any(
+        _segment_distance((0.0, 0.0), a, b) <= radius
+        for a, b in zip(points, [*points[1:], points[0]])
+    )
+
+
+def bbox_polygon(sw: Coord, ne: Coord) -> List[Coord]:
+    """The corners of the box with the given south-west and north-east corners."""
+    return [sw, Coord(sw.lat, ne.lon), ne, Coord(ne.lat, sw.lon)]
+
+
+def hex_cover(polygon: Sequence[Coord], radius: float) -> List[Coord]:
+    """Centers of circles of the given radius (in meters) that together cover the
+    polygon."""
+    r = radius * SAFETY
+    south = min(v.lat for v in polygon)
+    north = max(v.lat for v in polygon)
+    west = min(v.lon for v in polygon)
+    east = max(v.lon for v in polygon)
+
+    dlat = math.degrees(1.5 * r / EARTH_RADIUS)
+    margin = math.degrees(r / EARTH_RADIUS)
+
+    centers = []
+    row = 0
+    lat = south
+    while lat <= north + dlat:
+        # the equatorward edge of the row has the most meters per degree
+        edge = min(abs(lat - dlat / 2), abs(lat + dlat / 2))
+        if (lat - dlat / 2) * (lat + dlat / 2) < 0:
+            edge = 0.0
+        cos = max(math.cos(math.radians(edge)), 1e-6)
+        dlon = math.degrees(math.sqrt(3) * r / EARTH_RADIUS) / cos
+
+        lon = west - (dlon / 2 if row % 2 else 0) - margin / cos
+        while lon <= east + margin / cos:
+            center = Coord(lat, lon)
+            if intersects(polygon, center, radius):
+                centers.append(center)
+            lon += dlon
+
+        lat += dlat
+        row += 1
+
+    return centers
+
+
+def split_tile(center: Coord, radius: float) -> List[Coord]:
+    """Centers of circles of half the radius that together cover the circle."""
+    half = radius / 2
+    d = math.degrees(radius / EARTH_RADIUS)
+    cos = max(math.cos(math.radians(center.lat)), 1e-6)
+    square = bbox_polygon(
+        Coord(center.lat - d, center.lon - d / cos),
+        Coord(center.lat + d, center.lon + d / cos),
+    )
+    return [
+        c
+        for c in hex_cover(square, half)
+        if math.hypot(*_project(center, c)) <= radius + half
+    ]
@@ -2,12 +2,15 @@
 
 from __future__ import annotations
 from typing import MutableSequence
+from slugify import slugify
 from .coord import Coord
 
 
 class WikiMonument:
     """A monument populated from a Wikipedia entry."""
 
+    __slots__ = ("name", "desc", "coord", "image_urls")
+
     def __init__(
         self, name: str, desc: str, coord: Coord, image_urls: MutableSequence[str]
     ):
@@ -17,6 +20,11 @@ class WikiMonument:
         self.coord = coord
         self.image_urls = image_urls
 
+    @property
+    def slug(self) -> str:
+        """The slugified name, used as the product ID and as the blob prefix."""
+        return slugify(self.name)
+
     def __repr__(self):
         return f"""WikiMonument(
             {self.name},
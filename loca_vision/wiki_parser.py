@@ -2,21 +2,125 @@
 
 """Takes data from Wikipedia and uses it to pre-populate monument data."""
 
-from typing import Sequence
-import requests
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import (
+    Container,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
 
+from . import metrics
 from .wiki_monument import WikiMonument
 from .coord import Coord
+from .http_cache import ResponseCache
+from .http_scheduler import get_scheduler
+from .ratelimit import RateLimiter
+from .tiling import bbox_polygon, contains, hex_cover, split_tile
 
 BASE_URL = "https://en.wikipedia.org/w/api.php"
 
 base_params = {"action": "query", "utf8": 1, "maxlag": 1, "format": "json"}
 headers = {"User-Agent": "Loca v0.1 (https://github.com/loca-ai/loca-vision)"}
 
+# limits of the MediaWiki API for normal (non-bot) clients
+GSRADIUS_MIN = 10
+GSRADIUS_MAX = 10000
+GSLIMIT_MAX = 500
+PAGEIDS_MAX = 50
 
-def geosearch_pages(coord: Coord, radius: float, limit=200) -> Sequence[int]:
-    """Generates all pages with location no more than the given radius (in meters)
-    away from the given coordinates. """
+# images are fetched as thumbnails this wide, which is plenty for Product Search
+# and a fraction of the size of the many-megabyte originals on Commons
+THUMB_WIDTH = 1280
+
+# the image types Product Search accepts, and the largest file it takes
+SUPPORTED_MIMES = frozenset(
+    {"image/jpeg", "image/png", "image/webp", "image/gif", "image/bmp"}
+)
+MAX_IMAGE_BYTES = 20 * 1024 * 1024
+
+# opt-in response cache, see `enable_response_cache`
+response_cache: Optional[ResponseCache] = None
+
+
+def enable_response_cache(path: str, **kwargs) -> ResponseCache:
+    """Caches every API response in the SQLite database at `path`. Takes the same
+    options as `ResponseCache`, and returns the cache so its stats can be read."""
+    global response_cache
+    response_cache = ResponseCache(path, **kwargs)
+    return response_cache
+
+
+def disable_response_cache():
+    global response_cache
+    if response_cache is not None:
+        response_cache.close()
+    response_cache = None
+
+
+def _query(params: dict, limiter: Optional[RateLimiter] = None) -> dict:
+    """Makes a single API request and returns the decoded response."""
+    params = {**base_params, **params}
+    cache = response_cache
+    if cache is not None:
+        cached = cache.get(params)
+        if cached is not None:
+            metrics.count("cache_hits", service="wikipedia")
+            return cached
+
+    # rate limits, retries and maxlag are handled by the shared scheduler
+    with metrics.timer("request_seconds", service="wikipedia"):
+        r = get_scheduler().request(
+            "GET", BASE_URL, limiter=limiter, params=params, headers=headers
+        )
+    metrics.count("requests", service="wikipedia", status=r.status_code)
+    metrics.count("bytes", len(r.content), service="wikipedia")
+    r.raise_for_status()
+    json = r.json()
+
+    if cache is not None and "error" not in json:
+        cache.put(params, json)
+    return json
+
+
+def _query_all(params: dict, limiter: Optional[RateLimiter] = None) -> Iterator[dict]:
+    """Makes an API request and follows its continuations, generating the `query`
+    part of every response."""
+    cont = {}
+    while True:
+        json = _query({**params, **cont}, limiter)
+        if "query" in json:
+            yield json["query"]
+        if "continue" not in json:
+            return
+        cont = json["continue"]
+
+
+def _chunks(items: Sequence, size: int) -> List[Sequence]:
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+def _batched(items: Iterable, size: int) -> Iterator[List]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def geosearch(coord: Coord, radius: int, limit=200) -> Sequence[dict]:
+    """Returns the geosearch results (with `pageid`, `title`, `lat` and `lon`) for all
+    pages no more than the given radius (in meters) away from the given coordinates."""
     params = {
         "list": "geosearch",
         "gscoord": f"{coord.lat}|{coord.lon}",
@@ -24,70 +128,452 @@ def geosearch_pages(coord: Coord, radius: float, limit=200) -> Sequence[int]:
         "gslimit": limit,
     }
 
-    r = requests.get(BASE_URL, params={**base_params, **params}, headers=headers)
-    r.raise_for_status()
-    json = r.json()
+    json = _query(params)
     if "query" not in json:
         return []
 
-    return [page["pageid"] for page in json["query"]["geosearch"]]
+    return json["query"]["geosearch"]
 
 
-def get_monuments(pageids: Sequence[int]) -> Sequence[WikiMonument]:
-    """Given a set of page IDs, returns a list of WikiMonuments objects with images, description, name, and coordinates."""
+def geosearch_pages(coord: Coord, radius: float, limit=200) -> Sequence[int]:
+    """Generates all pages with location no more than the given radius (in meters)
+    away from the given coordinates. """
+    return [page["pageid"] for page in geosearch(coord, radius, limit)]
+
+
+# everything a monument is made of: its images, intro, page image and coordinates
+PAGE_PROPS = {
+    "prop": "images|extracts|pageimages|coordinates",
+    "formatversion": 2,
+    "explaintext": 1,
+    "exintro": 1,
+    "exlimit": "max",
+    "imlimit": "max",
+    "pilimit": "max",
+    "colimit": "max",
+}
+
+# the most pages MediaWiki gives intros for per request
+EXLIMIT_MAX = 20
+
+
+def _get_pages(
+    pageids: Sequence[int], limiter: Optional[RateLimiter] = None
+) -> Sequence[dict]:
+    """Fetches the images, intro, page image and coordinates of up to `PAGEIDS_MAX`
+    pages, merging the partial pages that continuations return."""
     params = {
-        "prop": "images|extracts|pageimages|coordinates",
-        "formatversion": 2,
+        **PAGE_PROPS,
         "pageids": "|".join(map(str, pageids)),
         "redirects": 1,
-        "explaintext": 1,
-        "exintro": 1,
     }
-    r = requests.get(BASE_URL, params={**base_params, **params}, headers=headers)
-    r.raise_for_status()
-    monuments = []
-    if "query" not in r.json():
-        return []
+    pages: Dict[int, dict] = {}
+    for query in _query_all(params, limiter):
+        for page in query.get("pages", []):
+            merged = pages.setdefault(page["pageid"], {"images": []})
+            merged["images"].extend(page.pop("images", []))
+            merged.update(page)
+
+    return list(pages.values())
+
+
+def _image_titles(page: dict) -> List[str]:
+    image_titles = []
+    if "pageimage" in page.keys():
+        image_titles.append("File:" + page["pageimage"].replace("_", " "))
+
+    for im in page.get("images", []):
+        title = im["title"]
+        if not title.endswith("svg") and title not in image_titles:
+            # skip SVGs, usually icons
+            image_titles.append(title)
+
+    return image_titles
 
-    for page in r.json()["query"]["pages"]:
-        image_titles = []
-        if "pageimage" in page.keys():
-            image_titles.append("File:" + page["pageimage"])
 
-        for im in page.get("images", []):
-            title = im["title"]
-            if not title.endswith("svg") and title not in image_titles:
-                # skip SVGs, usually icons
-                image_titles.append(title)
+def get_monuments(
+    pageids: Sequence[int], workers: int = 4, limiter: Optional[RateLimiter] = None
+) -> Sequence[WikiMonument]:
+    """Given a set of page IDs, returns a list of WikiMonuments objects with images, description, name, and coordinates.
+
+    Pages are fetched `PAGEIDS_MAX` at a time, and the images of all of them are
+    resolved together, so this takes about 2N/50 requests for N pages, `workers` of
+    them in flight at once."""
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        chunks = pool.map(
+            lambda chunk: _get_pages(chunk, limiter), _chunks(pageids, PAGEIDS_MAX)
+        )
+        pages = [page for chunk in chunks for page in chunk]
+
+    return _hydrate(pages, workers, limiter)
+
+
+def _hydrate(
+    pages: Sequence[dict], workers: int = 4, limiter: Optional[RateLimiter] = None
+) -> List[WikiMonument]:
+    """Turns fetched pages into monuments, resolving all of their images together."""
+    titles = {page["pageid"]: _image_titles(page) for page in pages}
+    all_titles = list(dict.fromkeys(t for ts in titles.values() for t in ts))
+    urls = resolve_image_urls(all_titles, workers, limiter)
+    return _monuments(pages, titles, urls)
+
 
-        image_urls = get_image_urls(image_titles)
+def _monuments(
+    pages: Sequence[dict], titles: Dict[int, List[str]], urls: Dict[str, str]
+) -> List[WikiMonument]:
+    """The monuments of the pages that have coordinates, given the image titles of
+    every page and the URLs they resolved to."""
+    monuments = []
+    for page in pages:
+        if "coordinates" not in page:
+            continue
+
+        image_urls = [urls[t] for t in titles[page["pageid"]] if t in urls]
         coord = Coord(page["coordinates"][0]["lat"], page["coordinates"][0]["lon"])
 
         monuments.append(
-            WikiMonument(page["title"], page["extract"], coord, image_urls)
+            WikiMonument(page["title"], page.get("extract", ""), coord, image_urls)
         )
 
     return monuments
 
 
+def image_url(info: dict) -> Tuple[Optional[str], Optional[str]]:
+    """Picks the URL to fetch an image from given its `imageinfo`: the thumbnail
+    if there is one, or else the original. Returns the URL, or why the image
+    should be skipped instead: it isn't a picture, it's of a type Product Search
+    doesn't take, or it's too large."""
+    if not info.get("mime", "image/").startswith("image/"):
+        # videos, PDFs and sounds have thumbnails too, but of the wrong thing
+        return None, f"not an image ({info['mime']})"
+
+    thumb = "thumburl" in info
+    mime = info.get("thumbmime" if thumb else "mime")
+    if mime is not None and mime not in SUPPORTED_MIMES:
+        return None, f"unsupported type {mime}"
+    if not thumb and info.get("size", 0) > MAX_IMAGE_BYTES:
+        return None, f"too large ({info['size']} bytes)"
+    return info["thumburl" if thumb else "url"], None
+
+
+def _imageinfo_params() -> dict:
+    return {
+        "prop": "imageinfo",
+        "formatversion": 2,
+        "iiprop": "url|size|mime|thumbmime",
+        "iiurlwidth": THUMB_WIDTH,
+    }
+
+
+def _add_image_urls(query: dict, urls: Dict[str, str]) -> Set[str]:
+    """Adds the URLs of the images in an imageinfo response to `urls`, and
+    returns the titles of all the images it had, used or skipped."""
+    seen = set()
+    for page in query.get("pages", []):
+        if not page.get("imageinfo"):
+            continue
+        seen.add(page["title"])
+        url, reason = image_url(page["imageinfo"][0])
+        if url is None:
+            metrics.count("images", stage="resolve", ok=False)
+            metrics.event("image_skipped", title=page["title"], reason=reason)
+            continue
+        metrics.count("images", stage="resolve", ok=True)
+        urls[page["title"]] = url
+    return seen
+
+
+def _resolve_chunk(
+    titles: Sequence[str], limiter: Optional[RateLimiter] = None
+) -> Dict[str, str]:
+    params = {**_imageinfo_params(), "titles": "|".join(titles)}
+    urls = {}
+    aliases = {}
+    for query in _query_all(params, limiter):
+        for norm in query.get("normalized", []):
+            aliases[norm["to"]] = norm["from"]
+        _add_image_urls(query, urls)
+
+    for to, frm in aliases.items():
+        if to in urls:
+            urls[frm] = urls[to]
+
+    return urls
+
+
+def resolve_image_urls(
+    titles: Sequence[str], workers: int = 4, limiter: Optional[RateLimiter] = None
+) -> Dict[str, str]:
+    """Maps the given image names from Wikipedia to their URLs, resolving them
+    `PAGEIDS_MAX` at a time with up to `workers` requests in flight. The URLs are
+    of `THUMB_WIDTH` thumbnails where there are any (see `image_url`), and
+    images that don't exist or can't be used are left out."""
+    urls = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for chunk in pool.map(
+            lambda chunk: _resolve_chunk(chunk, limiter), _chunks(titles, PAGEIDS_MAX)
+        ):
+            urls.update(chunk)
+
+    return urls
+
+
 def get_image_urls(titles: Sequence[str]) -> Sequence[str]:
     """Given a list of image names from Wikipedia, gets the URLs corresponding to those images."""
+    urls = resolve_image_urls(titles)
+    return [urls[t] for t in titles if t in urls]
+
+
+def iter_monument_batches(
+    pageids: Iterable[int], workers: int = 4, limiter: Optional[RateLimiter] = None
+) -> Iterator[Tuple[List[int], List[WikiMonument]]]:
+    """Hydrates the pages `PAGEIDS_MAX` at a time as the page IDs come in, with up
+    to `workers` batches in flight, generating each batch of page IDs along with
+    its monuments (pages without coordinates have none), in order."""
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending: Deque[Tuple[List[int], Future]] = deque()
+        for chunk in _batched(pageids, PAGEIDS_MAX):
+            future = pool.submit(
+                lambda c: _hydrate(_get_pages(c, limiter), 1, limiter), chunk
+            )
+            pending.append((chunk, future))
+            if len(pending) >= workers:
+                chunk, future = pending.popleft()
+                yield chunk, future.result()
+
+        while pending:
+            chunk, future = pending.popleft()
+            yield chunk, future.result()
+
+
+def iter_monuments(
+    pageids: Iterable[int], workers: int = 4, limiter: Optional[RateLimiter] = None
+) -> Iterator[WikiMonument]:
+    """Like `get_monuments`, but generates the monuments `PAGEIDS_MAX` pages at a
+    time as the page IDs come in, with up to `workers` batches in flight."""
+    for _, monuments in iter_monument_batches(pageids, workers, limiter):
+        yield from monuments
+
+
+def _page_image_urls(
+    pageids: Sequence[int], limiter: Optional[RateLimiter] = None
+) -> Tuple[Dict[str, str], Set[str]]:
+    """The URLs of the images on up to `PAGEIDS_MAX` pages, straight from the page
+    IDs with `generator=images`, along with the titles of every image seen."""
     params = {
-        "prop": "imageinfo",
-        "titles": "|".join(titles),
-        "iiprop": "url",
+        **_imageinfo_params(),
+        "generator": "images",
+        "gimlimit": "max",
+        "pageids": "|".join(map(str, pageids)),
     }
-    r = requests.get(BASE_URL, params={**base_params, **params}, headers=headers)
-    r.raise_for_status()
-    json = r.json()
-    if "query" not in json:
+    urls: Dict[str, str] = {}
+    seen: Set[str] = set()
+    for query in _query_all(params, limiter):
+        seen |= _add_image_urls(query, urls)
+    return urls, seen
+
+
+# for continuations that go page by page ("<pageid>|..."), the pages from the one
+# named on are unfinished; for the others, the pages without this key are
+CONTINUED_BY_PAGE = {"imcontinue", "cocontinue"}
+CONTINUED_KEYS = {"excontinue": "extract", "picontinue": "pageimage"}
+
+
+def _unfinished(pages: Sequence[dict], cont: Dict[str, str]) -> Set[int]:
+    """The IDs of the pages whose props the continuation `cont` has yet to fill
+    in, or of all of them for a continuation we can't tell that for."""
+    unfinished: Set[int] = set()
+    for key, value in cont.items():
+        if key == "continue":
+            continue
+        if key in CONTINUED_BY_PAGE:
+            first = int(str(value).split("|")[0])
+            unfinished |= {page["pageid"] for page in pages if page["pageid"] >= first}
+        elif key in CONTINUED_KEYS:
+            unfinished |= {
+                page["pageid"] for page in pages if CONTINUED_KEYS[key] not in page
+            }
+        else:
+            return {page["pageid"] for page in pages}
+    return unfinished
+
+
+def geosearch_monuments(
+    coord: Coord,
+    radius: float,
+    limit: int = 200,
+    workers: int = 4,
+    limiter: Optional[RateLimiter] = None,
+) -> List[WikiMonument]:
+    """Finds the monuments no more than `radius` meters from the coordinates, in
+    two round trips instead of the three of `geosearch_pages` then
+    `get_monuments`:
+
+    1. a single `generator=geosearch` request finds the pages and gets their
+       props, as far as MediaWiki's per-request limits allow (intros only come
+       `EXLIMIT_MAX` pages at a time, for instance), then
+    2. the images of all the pages are resolved with `generator=images` from
+       the page IDs, while any pages the first request didn't finish are fetched
+       again, `EXLIMIT_MAX` at a time so each takes a single request.
+
+    Rather than following the first request's continuation, which would take
+    one more round trip per `EXLIMIT_MAX` pages, the second round runs in
+    parallel, with up to `workers` requests in flight."""
+    params = {
+        **PAGE_PROPS,
+        "generator": "geosearch",
+        "ggscoord": f"{coord.lat}|{coord.lon}",
+        "ggsradius": radius,
+        "ggslimit": limit,
+        "piprop": "name",
+    }
+    json = _query(params, limiter)
+    pages = json.get("query", {}).get("pages", [])
+    if not pages:
         return []
+    unfinished = _unfinished(pages, json.get("continue", {}))
+    pageids = [page["pageid"] for page in pages]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        images = [
+            pool.submit(_page_image_urls, chunk, limiter)
+            for chunk in _chunks(pageids, PAGEIDS_MAX)
+        ]
+        refetched = [
+            pool.submit(_get_pages, chunk, limiter)
+            for chunk in _chunks(sorted(unfinished), EXLIMIT_MAX)
+        ]
+        urls: Dict[str, str] = {}
+        seen: Set[str] = set()
+        for future in images:
+            chunk_urls, chunk_seen = future.result()
+            urls.update(chunk_urls)
+            seen |= chunk_seen
+        fresh = {page["pageid"]: page for f in refetched for page in f.result()}
 
-    return [page["imageinfo"][0]["url"] for page in json["query"]["pages"].values()]
+    pages = [fresh.get(page["pageid"], page) for page in pages]
+    titles = {page["pageid"]: _image_titles(page) for page in pages}
+
+    # a page image that isn't on the page itself (e.g. one from Wikidata)
+    missing = list(
+        dict.fromkeys(t for ts in titles.values() for t in ts if t not in seen)
+    )
+    if missing:
+        urls.update(resolve_image_urls(missing, workers, limiter))
+
+    return _monuments(pages, titles, urls)
 
 
 def search_monuments_nearby(
     coord: Coord, radius: float, limit=200
 ) -> Sequence[WikiMonument]:
-    """Searches for nearby monuments and returns them as a list."""
-    return get_monuments(geosearch_pages(coord, radius, limit))
+    """Searches for nearby monuments and returns them as a list, see
+    `geosearch_monuments`."""
+    return geosearch_monuments(coord, radius, limit)
+
+
+def iter_monuments_nearby(
+    coord: Coord, radius: float, limit=200
+) -> Iterator[WikiMonument]:
+    """Searches for nearby monuments and generates them, see
+    `geosearch_monuments`. They're all found in its two round trips, so they
+    come at once, after the second."""
+    yield from geosearch_monuments(coord, radius, limit)
+
+
+def crawl_polygon(
+    polygon: Sequence[Coord],
+    radius: int = GSRADIUS_MAX,
+    limit: int = GSLIMIT_MAX,
+    workers: int = 4,
+    rate: float = 10,
+) -> List[WikiMonument]:
+    """Finds every monument inside the polygon.
+
+    The polygon is covered with hexagonally packed search circles of the given
+    radius, which are searched concurrently under a shared limit of `rate`
+    requests per second. A circle that comes back with `limit` hits may have been
+    truncated, so it is split into circles of half the radius and searched again.
+    Each page found is hydrated exactly once, in batches."""
+    limiter = RateLimiter(rate, burst=workers)
+    pageids = list(_crawl_pageids(polygon, radius, limit, workers, limiter))
+    return list(get_monuments(pageids, workers, limiter))
+
+
+def iter_crawl_polygon(
+    polygon: Sequence[Coord],
+    radius: int = GSRADIUS_MAX,
+    limit: int = GSLIMIT_MAX,
+    workers: int = 4,
+    rate: float = 10,
+) -> Iterator[WikiMonument]:
+    """Like `crawl_polygon`, but generates monuments while the crawl is still going:
+    pages are hydrated as soon as a batch of them has been found."""
+    limiter = RateLimiter(rate, burst=workers)
+    pageids = _crawl_pageids(polygon, radius, limit, workers, limiter)
+    return iter_monuments(pageids, workers, limiter)
+
+
+def iter_crawl_batches(
+    polygon: Sequence[Coord],
+    radius: int = GSRADIUS_MAX,
+    limit: int = GSLIMIT_MAX,
+    workers: int = 4,
+    rate: float = 10,
+    skip: Container[int] = (),
+) -> Iterator[Tuple[List[int], List[WikiMonument]]]:
+    """Like `iter_crawl_polygon`, but generates batches of page IDs along with
+    their monuments (see `iter_monument_batches`), and leaves out the pages in
+    `skip`, so a crawl can record which pages are done and resume after them."""
+    limiter = RateLimiter(rate, burst=workers)
+    pageids = _crawl_pageids(polygon, radius, limit, workers, limiter)
+    return iter_monument_batches(
+        (pageid for pageid in pageids if pageid not in skip), workers, limiter
+    )
+
+
+def _crawl_pageids(
+    polygon: Sequence[Coord],
+    radius: int,
+    limit: int,
+    workers: int,
+    limiter: RateLimiter,
+) -> Iterator[int]:
+    """Generates the ID of every page inside the polygon, once each."""
+
+    def search(center: Coord, r: int):
+        limiter.acquire()
+        return center, r, geosearch(center, r, limit)
+
+    found: Set[int] = set()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(search, c, radius) for c in hex_cover(polygon, radius)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                center, r, pages = future.result()
+                metrics.count("tiles", stage="crawl")
+                if len(pages) >= limit and r // 2 >= GSRADIUS_MIN:
+                    metrics.count("tile_splits", stage="crawl")
+                    pending |= {
+                        pool.submit(search, c, r // 2) for c in split_tile(center, r)
+                    }
+
+                for page in pages:
+                    if page["pageid"] not in found and contains(
+                        polygon, Coord(page["lat"], page["lon"])
+                    ):
+                        found.add(page["pageid"])
+                        metrics.count("pages", stage="crawl")
+                        yield page["pageid"]
+
+
+def crawl_bbox(sw: Coord, ne: Coord, **kwargs) -> List[WikiMonument]:
+    """Finds every monument inside the box with the given south-west and north-east
+    corners. Takes the same options as `crawl_polygon`."""
+    return crawl_polygon(bbox_polygon(sw, ne), **kwargs)
+
+
+def iter_crawl_bbox(sw: Coord, ne: Coord, **kwargs) -> Iterator[WikiMonument]:
+    """Generating version of `crawl_bbox`. Takes the same options as `crawl_polygon`."""
+    return iter_crawl_polygon(bbox_polygon(sw, ne), **kwargs)
@@ -1,74 +1,61 @@
 #!/usr/bin/env python3
 
-from loca_vision.wiki_parser import search_monuments_nearby, geosearch_pages
+from loca_vision.wiki_parser import iter_crawl_bbox, search_monuments_nearby, geosearch_pages
 from loca_vision.coord import Coord
 from loca_vision.gcloud import *
 from loca_vision.wiki_monument import WikiMonument
-import numpy as np
-from tqdm import tqdm
-import json
+from loca_vision.monument_store import read_monuments, write_monuments
+from loca_vision import metrics
+import logging
+import os
 
+# show import statuses, failed images and search results as they happen
+logging.basicConfig(level=logging.INFO)
+metrics.add_sink(metrics.LoggingSink())
 
-def search_area():
 
-    objs = []
-    for lat in tqdm(np.linspace(41.27, 41.34, 10)):
-        for lon in np.linspace(-73, -72.8, 10):
-            coord = Coord(lat, lon)
-            for monument in search_monuments_nearby(coord, 1500, 10):
-                obj = {
-                    "name": monument.name,
-                    "desc": monument.desc,
-                    "coord": {"lat": monument.coord.lat, "lon": monument.coord.lon,},
-                    "image_urls": monument.image_urls,
-                }
-                if obj not in objs:
-                    objs.append(obj)
-
-    print(len(objs), "monuments")
-    with open("monuments.json", "w") as outfile:
-        json.dump(objs, outfile, indent=2)
+def search_area():
+    count = write_monuments(
+        "monuments.ndjson",
+        iter_crawl_bbox(Coord(41.27, -73), Coord(41.34, -72.8)),
+        append=False,
+    )
+    print(count, "monuments")
 
 
 def upload_google(infile: str, outfile: str):
-    with open(infile, "r") as mons_file:
-        mons = json.load(mons_file)
+    mons = read_monuments(infile)
+    write_monuments(
+        outfile + ".tmp", iter_upload_images_from_monuments(mons), append=False
+    )
+    os.replace(outfile + ".tmp", outfile)
 
-    mons = [WikiMonument.from_json(mon) for mon in mons]
 
-    upload_images_from_monuments(mons)
-    with open(outfile, "w") as out:
-        json.dump([mon.to_json() for mon in mons], out, indent=2)
+# upload_google('monuments.ndjson', 'monuments-google.ndjson')
+# upload_google("monuments-google.ndjson", "monuments-google.ndjson")
 
 
-# upload_google('monuments.json', 'monuments-google.json')
-# upload_google("monuments-google.json", "monuments-google.json")
+def test_csv():
+    print(monuments_to_csv(read_monuments("monuments-google.ndjson")))
 
 
-def test_csv():
-    with open("monuments-google.json", "r") as mons_file:
-        mons = json.load(mons_file)
+def upload_monuments():
+    upload_product_set(read_monuments("monuments-google.ndjson"))
 
-    mons = [WikiMonument.from_json(mon) for mon in mons]
-    print(monuments_to_csv(mons))
 
+# upload_monuments()
 
-def upload_monuments():
-    with open("monuments-google.json", "r") as mons_file:
-        mons = json.load(mons_file)
 
-    mons = [WikiMonument.from_json(mon) for mon in mons]
-    upload_product_set(mons)
+def sync_monuments():
+    from loca_vision.sync import sync_product_set
 
+    sync_product_set(read_monuments("monuments-google.ndjson"))
 
-# upload_monuments()
 
-get_similar_products_file(
-    "loca-346705",
-    "us-east1",
-    "monuments",
-    "general-v1",
-    "tests/lipstick4geo.jpg",
-    None,
-    3,
-)
+# sync_monuments()
+
+if __name__ == "__main__":
+    import base64
+
+    with open("tests/lipstick4geo.jpg", "rb") as f:
+        get_similar_products_file(base64.b64encode(f.read()).decode(), None, 3)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""`mutations.execute` through the CSV import, against in-memory stand-ins for
+Cloud Storage and Product Search. Run from the repository root with
+`python -m pytest tests`."""
+
+import csv
+import io
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from benchmarks.fakes import MemoryStorage
+from loca_vision import clients
+from loca_vision.mutations import (
+    AddToProductSet,
+    CreateProduct,
+    CreateReferenceImage,
+    execute,
+)
+
+
+class FakeProductSearch:
+    """Imports CSVs from `storage`, answering ALREADY_EXISTS (6) for the image
+    IDs in `existing` and OK (0) for the rest. Any online call is recorded."""
+
+    def __init__(self, storage: MemoryStorage, existing=()):
+        self.storage = storage
+        self.existing = set(existing)
+        self.rows = []
+        self.online = []
+
+    def import_product_sets(self, parent, input_config):
+        bucket, name = input_config.gcs_source.csv_file_uri[5:].split("/", 1)
+        data = self.storage.bucket(bucket).blobs[name].decode()
+        rows = list(csv.reader(io.StringIO(data)))
+        self.rows.extend(rows)
+        statuses = [
+            SimpleNamespace(code=6 if row[1] in self.existing else 0, message="")
+            for row in rows
+        ]
+        result = SimpleNamespace(statuses=statuses, reference_images=[None] * len(rows))
+        return SimpleNamespace(done=lambda: True, result=lambda: result)
+
+    def __getattr__(self, name):
+        # create_product, create_reference_image, add_product_to_product_set...
+        return lambda **kwargs: self.online.append((name, kwargs))
+
+
+@pytest.fixture
+def product_search():
+    for key in ["CSV_BUCKET", "PRODUCT_SET_ID", "PROJECT_ID"]:
+        os.environ.setdefault(key, f"test-{key.lower().replace('_', '-')}")
+    clients.config.reload()
+    storage = MemoryStorage(latency=0)
+    fake = FakeProductSearch(storage, existing={"a0", "b1"})
+    clients.register("storage", storage)
+    clients.register("product_search", fake)
+    yield fake
+    clients.reset()
+
+
+def test_import_accepts_already_exists(product_search):
+    batch = [
+        CreateProduct("a", "A", "cell=1"),
+        CreateProduct("b", "B", "cell=2"),
+        CreateReferenceImage("a", "gs://images/a/0.jpg", "a0"),
+        CreateReferenceImage("b", "gs://images/b/0.jpg", "b0"),
+        CreateReferenceImage("b", "gs://images/b/1.jpg", "b1"),
+    ]
+    results = execute(batch, import_threshold=1, poll=0)
+
+    by_image = {r.mutation.image_id: r.status for r in results[2:5]}
+    assert by_image == {"a0": "exists", "b0": "imported", "b1": "exists"}
+    assert all(r.ok for r in results)
+    # a product all of whose images already existed is still in the set, so
+    # nothing is left over for the online path
+    assert [type(r.mutation) for r in results[5:]] == [AddToProductSet] * 2
+    assert product_search.online == []
+
+
+def test_import_restates_existing_products(product_search):
+    batch = [
+        CreateReferenceImage("c", "gs://images/c/0.jpg", "c0", "C", "cell=3"),
+        # nothing to restate its product with, so it goes online
+        CreateReferenceImage("d", "gs://images/d/0.jpg", "d0"),
+    ]
+    results = execute(batch, import_threshold=1, poll=0)
+
+    assert [r.status for r in results] == ["imported", "done"]
+    (row,) = product_search.rows
+    assert (row[1], row[3], row[5], row[6]) == ("c0", "c", "C", "cell=3")
+    assert [name for name, _ in product_search.online] == ["create_reference_image"]